@@ -0,0 +1,72 @@
+import threading
+from collections import OrderedDict
+
+# cache de leitura do main para imagens quentes, com despejo LRU e limite em bytes
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_MAX_ENTRY_BYTES = 16 * 1024 * 1024
+
+class ImageCache:
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, max_entry_bytes: int = CACHE_MAX_ENTRY_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()  # nome -> bytes, do menos para o mais recente
+        self.size_bytes = 0
+        # versao por nome: um download que comecou antes de um DELETE/UPLOAD nao pode repor o conteudo antigo
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, file_name: str) -> bytes | None:
+        with self.lock:
+            data = self.entries.get(file_name)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(file_name)
+            self.hits += 1
+            return data
+
+    def version(self, file_name: str) -> int:
+        with self.lock:
+            return self.versions.get(file_name, 0)
+
+    def cacheable(self, size: int) -> bool:
+        return size <= self.max_entry_bytes
+
+    def put(self, file_name: str, data: bytes, version: int):
+        if not self.cacheable(len(data)):
+            return
+        with self.lock:
+            if self.versions.get(file_name, 0) != version:
+                return
+            old = self.entries.pop(file_name, None)
+            if old is not None:
+                self.size_bytes -= len(old)
+            self.entries[file_name] = data
+            self.size_bytes += len(data)
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size_bytes -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, file_name: str):
+        with self.lock:
+            self.versions[file_name] = self.versions.get(file_name, 0) + 1
+            old = self.entries.pop(file_name, None)
+            if old is not None:
+                self.size_bytes -= len(old)
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'bytes': self.size_bytes,
+            }
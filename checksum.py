@@ -0,0 +1,49 @@
+import zlib
+
+# checksum de ponta a ponta dos arquivos: CRC32 da zlib (em C), atualizado enquanto os chunks passam,
+# com a mesma interface (update/hexdigest) dos objetos de hashlib
+class Crc32:
+    def __init__(self, value: int = 0) -> None:
+        self.value = value
+
+    def update(self, data: bytes):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self) -> str:
+        return f'{self.value:08x}'
+
+def crc32_combine(crc1: int, crc2: int, len2: int) -> int:
+    # CRC32 de A+B a partir de crc(A), crc(B) e len(B), como o crc32_combine da zlib:
+    # permite conferir um arquivo baixado em intervalos paralelos sem reler nada
+    if len2 <= 0:
+        return crc1
+    odd = [0xEDB88320] + [1 << n for n in range(31)]  # operador de um bit zero
+    even = gf2_matrix_square(odd)  # dois bits zero
+    odd = gf2_matrix_square(even)  # quatro bits zero
+    while True:
+        even = gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+def gf2_matrix_times(mat: list[int], vec: int) -> int:
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+def gf2_matrix_square(mat: list[int]) -> list[int]:
+    return [gf2_matrix_times(mat, mat[n]) for n in range(32)]
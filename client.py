@@ -3,114 +3,743 @@ import socket
 import os
 import hashlib
 import time
+import urllib.parse
+import concurrent.futures
+import queue
+import logging
+import wire
+import compression
+from checksum import Crc32, crc32_combine
+
+log = logging.getLogger('client')
 
 MAIN_ADDR = 'localhost'
 MAIN_PORT = 5555
 
-CONTROL_MSG_SIZE_BYTES = 1024
-MAX_CHUNK_SIZE_BYTES = 1024 * 4
+# download listrado: arquivos menores que isso vem inteiros de uma replica so
+STRIPE_MIN_BYTES = 8 * 1024 * 1024
+
+# modo em blocos: arquivos divididos em blocos de tamanho fixo, enderecados pelo sha256 do conteudo
+BLOCK_SIZE_BYTES = 64 * 1024 * 1024
+BLOCK_TRANSFER_WORKERS = 4
+
+# upload_many/download_many: transferencias simultaneas (uma sessao BATCH por worker no modo pelo main)
+BATCH_WORKERS = 4
+
+# upload retomavel (upload_stream): o fluxo vai em pedacos confirmados pelo main; o pedaco atual fica
+# em memoria para ser reenviado do ultimo offset confirmado se a conexao cair
+UPLOAD_PIECE_BYTES = 8 * 1024 * 1024
+UPLOAD_RETRIES = 5
+UPLOAD_RETRY_DELAY_SECONDS = 1
+
+# lado maior padrao das miniaturas (THUMBNAIL); tiles tem 256x256 pixels
+THUMBNAIL_SIZE = 256
 
 class Client:
-    def __init__(self, host: str, port: int) -> None:
+    def __init__(self, host: str, port: int, direct: bool = False, striped: bool = False, blocks: bool = False, compress: bool = False) -> None:
         self.srv_addr = (host, port)
+        # no modo direto o main so informa os datanodes, os bytes vao direto para eles
+        self.direct = direct
+        # no modo listrado cada replica envia um intervalo diferente do arquivo em paralelo
+        self.striped = striped
+        # no modo em blocos so os blocos que o sistema ainda nao tem sao enviados
+        self.blocks = blocks
+        # oferece compressao nas transferencias pelo main e nos downloads diretos (o outro lado escolhe o codec)
+        self.compress = compress
         if not os.path.exists('client_dir/'):
             os.makedirs('client_dir/')
 
     def upload_image(self, file_path: str) -> None:
+        if self.blocks:
+            return self.upload_image_blocks(file_path)
+        if self.direct:
+            return self.upload_image_direct(file_path)
+
+        with wire.connect(self.srv_addr) as s:
+            self.upload_over(s, file_path)
+
+    def upload_over(self, s: socket.socket, file_path: str):
+        # upload pelo main em uma conexao ja aberta (avulsa ou sessao BATCH)
         file_size = os.path.getsize(file_path)
         file_name = os.path.basename(file_path)
 
-        control_msg = f'UPLOAD${file_name}${file_size}'
-        control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-        control_msg = control_msg.encode()
-
-        with open(file_path, 'rb') as f, socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(self.srv_addr)
-            print(f"# client to main: send UPLOAD control message")
-            s.sendall(control_msg)
+        codecs = self.codecs(file_name)
+        with open(file_path, 'rb') as f:
+            log.debug('# client to main: send UPLOAD control message')
+            self.send_control(s, f'UPLOAD${file_name}${file_size}${codecs}' if codecs else f'UPLOAD${file_name}${file_size}')
 
-            print(f"# client from main: recv READY message")
-            control_msg = self.recvall(s, CONTROL_MSG_SIZE_BYTES)
-            control_msg = control_msg.decode()
-            control_msg = control_msg.strip().split('$')
+            log.debug('# client from main: recv READY message')
+            control_msg = self.recv_control(s)
 
             if control_msg[0] != 'READY':
-                print("Server not ready")
-                return
+                raise RuntimeError(f"Server not ready for {file_name}: {control_msg}")
             
-            bytes_sent = 0
-            while bytes_sent < file_size:
-                chunk = f.read(min(MAX_CHUNK_SIZE_BYTES, file_size - bytes_sent))
-                s.sendall(chunk)
-                bytes_sent += len(chunk)
+            # READY$CODEC: o main aceitou receber comprimido
+            out = compression.FrameWriter(s.sendall, control_msg[1] if len(control_msg) > 1 else '')
+            crc = Crc32()
+            for chunk in wire.read_chunks(f, file_size):
+                out.write(chunk)
+                crc.update(chunk)
+            out.close()
+
+            log.debug('# client from main: recv DONE message')
+            control_msg = self.recv_control(s)
+            if control_msg[0] != 'DONE':
+                raise RuntimeError(f"Upload of {file_name} failed: {control_msg}")
+            verify_checksum(file_name, crc, control_msg[1] if len(control_msg) > 1 else None)
+
+        log.info('Upload of %s completed', file_name)
+
+    def upload_image_direct(self, file_path: str) -> None:
+        file_size = os.path.getsize(file_path)
+        file_name = os.path.basename(file_path)
+
+        with wire.connect(self.srv_addr) as s:
+            log.debug('# client to main: send LOCATE_UPLOAD control message')
+            self.send_control(s, f'LOCATE_UPLOAD${file_name}${file_size}')
+            log.debug('# client from main: recv TARGETS message')
+            control_msg = self.recv_control(s)
+        if control_msg[0] != 'TARGETS':
+            raise RuntimeError(f"Server refused upload of {file_name}: {control_msg}")
+        token = control_msg[1]
+        datanodes = control_msg[2]
+
+        # o primeiro datanode repassa os chunks para os demais (replicacao em cadeia)
+        datanode_addrs = parse_addrs(datanodes)
+        head_addr = datanode_addrs[0]
+        chain = datanodes.partition(',')[2]
+        with open(file_path, 'rb') as f, wire.connect(head_addr) as datanode_conn:
+            log.debug('# client to datanode: send UPLOAD control message to %s', head_addr)
+            self.send_control(datanode_conn, f'UPLOAD${file_name}${file_size}${chain}${token}')
+            log.debug('# client from datanode: recv READY message from %s', head_addr)
+            if self.recv_control(datanode_conn)[0] != 'READY':
+                raise RuntimeError(f"Datanode {head_addr} not ready")
+
+            crc = Crc32()
+            for chunk in wire.read_chunks(f, file_size):
+                datanode_conn.sendall(chunk)
+                crc.update(chunk)
+
+            log.debug('# client from datanode: recv DONE message from %s', head_addr)
+            control_msg = self.recv_control(datanode_conn)
+        stored = int(control_msg[1]) if control_msg[0] == 'DONE' else 0
+        if stored == 0:
+            raise RuntimeError(f"Datanodes failed to store {file_name}")
+        verify_checksum(file_name, crc, control_msg[2] if len(control_msg) > 2 else None)
+        datanodes = ','.join(datanodes.split(',')[:stored])
+
+        with wire.connect(self.srv_addr) as s:
+            log.debug('# client to main: send COMMIT control message')
+            self.send_control(s, f'COMMIT${file_name}${file_size}${token}${datanodes}${crc.hexdigest()}')
+            control_msg = self.recv_control(s)
+        if control_msg[0] != 'DONE':
+            raise RuntimeError(f"Commit of {file_name} failed: {control_msg}")
+        log.info('Direct upload of %s completed', file_name)
+
+    def upload_image_blocks(self, file_path: str) -> None:
+        file_size = os.path.getsize(file_path)
+        file_name = os.path.basename(file_path)
 
-        print(f"Upload of {file_name} completed")
+        blocks = []  # (hash, offset, size)
+        crc = Crc32()  # do arquivo inteiro, calculado na mesma leitura dos hashes
+        buf = bytearray(wire.CHUNK_SIZE_BYTES)
+        with open(file_path, 'rb') as f:
+            for offset in range(0, file_size, BLOCK_SIZE_BYTES):
+                block_size = min(BLOCK_SIZE_BYTES, file_size - offset)
+                hasher = hashlib.sha256()
+                for chunk in wire.read_chunks(f, block_size, buf):
+                    hasher.update(chunk)
+                    crc.update(chunk)
+                blocks.append((hasher.hexdigest(), offset, block_size))
+
+        body = ''.join(f'{block_hash} {block_size}\n' for block_hash, _, block_size in blocks).encode()
+        with wire.connect(self.srv_addr) as s:
+            log.debug('# client to main: send PUT_BLOCKS control message')
+            self.send_control(s, f'PUT_BLOCKS${file_name}${file_size}${len(body)}')
+            s.sendall(body)
+            log.debug('# client from main: recv BLOCK_TARGETS message')
+            control_msg = self.recv_control(s)
+            if control_msg[0] != 'BLOCK_TARGETS':
+                raise RuntimeError(f"Server refused upload of {file_name}: {control_msg}")
+            targets = [line.split() for line in self.recvall(s, int(control_msg[1])).decode().splitlines()]
+
+        # blocos novos vao em paralelo, cada um para a sua cadeia de datanodes
+        commit_lines = [f'{block_hash} {block_size} - -\n' for block_hash, _, block_size in blocks]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=BLOCK_TRANSFER_WORKERS) as executor:
+            futures = {}
+            for i, ((block_hash, offset, block_size), (_, token, datanodes)) in enumerate(zip(blocks, targets)):
+                if token != '-':
+                    futures[i] = executor.submit(self.upload_block, file_path, block_hash, offset, block_size, token, datanodes)
+            for i, future in futures.items():
+                block_hash, _, block_size = blocks[i]
+                commit_lines[i] = f'{block_hash} {block_size} {targets[i][1]} {future.result()}\n'
+
+        body = ''.join(commit_lines).encode()
+        with wire.connect(self.srv_addr) as s:
+            log.debug('# client to main: send COMMIT_BLOCKS control message')
+            self.send_control(s, f'COMMIT_BLOCKS${file_name}${file_size}${len(body)}${crc.hexdigest()}')
+            s.sendall(body)
+            control_msg = self.recv_control(s)
+        if control_msg[0] != 'DONE':
+            raise RuntimeError(f"Commit of {file_name} failed: {control_msg}")
+        log.info('Block upload of %s completed (%s/%s blocks sent)', file_name, len(futures), len(blocks))
+
+    def upload_block(self, file_path: str, block_hash: str, offset: int, block_size: int, token: str, datanodes: str) -> str:
+        # devolve os datanodes que confirmaram a gravacao do bloco
+        head_addr = parse_addrs(datanodes)[0]
+        chain = datanodes.partition(',')[2]
+        with open(file_path, 'rb') as f, wire.connect(head_addr) as datanode_conn:
+            log.debug('# client to datanode: send PUT_BLOCK control message to %s', head_addr)
+            self.send_control(datanode_conn, f'PUT_BLOCK${block_hash}${block_size}${chain}${token}')
+            if self.recv_control(datanode_conn)[0] != 'READY':
+                raise RuntimeError(f"Datanode {head_addr} not ready")
+            datanode_conn.sendfile(f, offset, block_size)
+            log.debug('# client from datanode: recv DONE message from %s', head_addr)
+            control_msg = self.recv_control(datanode_conn)
+        stored = int(control_msg[1]) if control_msg[0] == 'DONE' else 0
+        if stored == 0:
+            raise RuntimeError(f"Datanodes failed to store block {block_hash}: {control_msg}")
+        return ','.join(datanodes.split(',')[:stored])
+
+    def upload_stream(self, file_name: str, chunks, upload_id: str | None = None) -> str:
+        # upload de um fluxo de tamanho desconhecido (iteravel de bytes ou arquivo aberto) por uma sessao
+        # retomavel no main; se a conexao cai, o envio continua do ultimo offset confirmado.
+        # Para retomar a sessao de outro processo, passe upload_id e um fluxo que comece em upload_offset(upload_id).
+        # Devolve o checksum do arquivo gravado.
+        if hasattr(chunks, 'read'):
+            chunks = iter(lambda f=chunks: f.read(wire.CHUNK_SIZE_BYTES), b'')
+        session = UploadSession(self, upload_id)
+        try:
+            if upload_id is None:
+                upload_id = session.open(file_name)
+            offset = session.offset()
+            # o CRC32 so e conhecido se o fluxo inteiro passa por aqui
+            crc = Crc32() if offset == 0 else None
+            for piece in pieces(chunks, UPLOAD_PIECE_BYTES):
+                session.append(offset, piece)
+                offset += len(piece)
+                if crc is not None:
+                    crc.update(piece)
+            checksum = session.commit(crc.hexdigest() if crc is not None else '')
+        finally:
+            session.close()
+        if crc is not None:
+            verify_checksum(file_name, crc, checksum)
+        log.info('Resumable upload %s of %s completed (%s bytes)', upload_id, file_name, offset)
+        return checksum
+
+    def upload_offset(self, upload_id: str) -> int:
+        # bytes da sessao que o main ja recebeu
+        session = UploadSession(self, upload_id)
+        try:
+            return session.offset()
+        finally:
+            session.close()
+
+    def upload_many(self, file_paths: list[str], parallelism: int = BATCH_WORKERS) -> dict[str, Exception | None]:
+        # envia varios arquivos com ate `parallelism` transferencias ao mesmo tempo;
+        # devolve o erro de cada arquivo (None se deu certo) em vez de parar no primeiro
+        if self.direct or self.blocks:
+            return self.run_many(self.upload_image, file_paths, parallelism)
+        return self.run_batch(self.upload_over, file_paths, parallelism)
+
+    def download_many(self, file_names: list[str], parallelism: int = BATCH_WORKERS) -> dict[str, Exception | None]:
+        if self.direct or self.striped:
+            return self.run_many(self.download_image, file_names, parallelism)
+        return self.run_batch(self.download_over, file_names, parallelism)
+
+    def run_many(self, transfer, items: list[str], parallelism: int) -> dict[str, Exception | None]:
+        # modos em que os bytes vao direto para os datanodes: cada arquivo segue o caminho normal, em paralelo
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = {item: executor.submit(transfer, item) for item in items}
+            for item, future in futures.items():
+                results[item] = future.exception()
+        return results
+
+    def run_batch(self, transfer, items: list[str], parallelism: int) -> dict[str, Exception | None]:
+        # cada worker abre uma sessao BATCH no main e passa por ela os arquivos que ainda faltam,
+        # sem um connect e um handshake por arquivo
+        pending = queue.SimpleQueue()
+        for item in items:
+            pending.put(item)
+        results = {}
+
+        def worker():
+            s = None
+            try:
+                while True:
+                    try:
+                        item = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        if s is None:
+                            s = wire.connect(self.srv_addr)
+                            log.debug('# client to main: send BATCH control message')
+                            self.send_control(s, 'BATCH')
+                        transfer(s, item)
+                        results[item] = None
+                    except Exception as e:
+                        log.warning('Batch transfer of %s failed: %r', item, e)
+                        results[item] = e
+                        # o estado da sessao e desconhecido depois de uma falha: o proximo arquivo abre outra
+                        if s is not None:
+                            s.close()
+                        s = None
+            finally:
+                if s is not None:
+                    with s:
+                        try:
+                            self.send_control(s, 'END')
+                        except OSError:
+                            pass
+
+        workers = max(1, min(parallelism, len(items)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(worker) for _ in range(workers)]:
+                future.result()
+        return {item: results[item] for item in items}
 
     def list_images(self) -> str:
-        control_msg = 'LISTING'.ljust(CONTROL_MSG_SIZE_BYTES, ' ').encode()
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(self.srv_addr)
-            s.sendall(control_msg)
+        with wire.connect(self.srv_addr) as s:
+            self.send_control(s, 'LISTING')
 
-            control_msg = self.recvall(s, CONTROL_MSG_SIZE_BYTES)
-            control_msg = control_msg.decode().strip().split('$')
+            control_msg = self.recv_control(s)
             answer_size = int(control_msg[0])
 
             answer = self.recvall(s, answer_size)
         return answer.decode()
 
+    def iter_images(self, prefix: str = '', page_size: int = 1000):
+        # gera (nome, tamanho, replicas) pagina por pagina, sem guardar a listagem inteira
+        page_token = ''
+        while True:
+            with wire.connect(self.srv_addr) as s:
+                self.send_control(s, f'LISTING${urllib.parse.quote(prefix)}${page_size}${urllib.parse.quote(page_token)}')
+                control_msg = self.recv_control(s)
+                if control_msg[0] != 'PAGE':
+                    raise RuntimeError(f"Listing failed: {control_msg}")
+                count = int(control_msg[1])
+                page_token = urllib.parse.unquote(control_msg[2])
+                with s.makefile('rb') as f:
+                    for _ in range(count):
+                        name, size, replicas = f.readline().decode().split()
+                        yield urllib.parse.unquote(name), int(size), int(replicas)
+            if not page_token:
+                return
+
     def download_image(self, file_name: str) -> float:
+        if self.striped:
+            return self.download_image_striped(file_name)
+        if self.direct:
+            return self.download_image_direct(file_name)
+
+        with wire.connect(self.srv_addr) as s:
+            return self.download_over(s, file_name)
+
+    def download_over(self, s: socket.socket, file_name: str) -> float:
+        # download pelo main em uma conexao ja aberta (avulsa ou sessao BATCH)
         start_time = time.time()
-        
-        control_msg = f'DOWNLOAD${file_name}'
-        control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-        control_msg = control_msg.encode()
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(self.srv_addr)
-            print(f"# client to main: send DOWNLOAD control message")
-            s.sendall(control_msg)
+        codecs = self.codecs(file_name)
+        log.debug('# client to main: send DOWNLOAD control message')
+        self.send_control(s, f'DOWNLOAD${file_name}${codecs}' if codecs else f'DOWNLOAD${file_name}')
+
+        log.debug('# client from main: recv SIZE_BYTES')
+        control_msg = self.recv_control(s)
+        if control_msg[0] == 'ERROR':
+            raise FileNotFoundError(f"{file_name}: {control_msg[1]}")
+        file_size = int(control_msg[0])
+        checksum = (control_msg[1] or None) if len(control_msg) > 1 else None
+        codec = control_msg[2] if len(control_msg) > 2 else ''
+
+        # o checksum e conferido enquanto os chunks chegam, sem reler o arquivo
+        crc = Crc32()
+        with open(f'client_dir/{file_name}', 'wb') as f:
+            self.send_control(s, 'READY')
+            for chunk in compression.recv_stream(s, file_size, codec):
+                crc.update(chunk)
+                f.write(chunk)
+        verify_checksum(file_name, crc, checksum)
+
+        end_time = time.time()
+        download_time = end_time - start_time
+        log.info('Download of %s completed in %.4f seconds', file_name, download_time)
+        return download_time
+
+    def download_image_direct(self, file_name: str) -> float:
+        start_time = time.time()
 
-            print(f"# client from main: recv SIZE_BYTES")
-            control_msg = self.recvall(s, CONTROL_MSG_SIZE_BYTES)
-            control_msg = control_msg.decode().strip().split('$')
-            file_size = int(control_msg[0])
+        file_size, token, datanode_addrs, blocks, checksum = self.locate(file_name)
+        if blocks is not None:
+            return self.download_image_blocks(file_name, file_size, blocks, start_time)
+        # o main manda primeiro a replica menos carregada e por ultimo as fora do ar; se uma falha, o arquivo
+        # vem inteiro da proxima
+        for datanode_addr in datanode_addrs:
+            try:
+                crc = self.download_whole(file_name, file_size, token, datanode_addr)
+                break
+            except (OSError, ValueError) as e:
+                log.warning('Direct download of %s from %s failed: %r', file_name, datanode_addr, e)
+                if datanode_addr == datanode_addrs[-1]:
+                    raise
+        verify_checksum(file_name, crc, checksum)
 
-            control_msg = 'READY'
-            control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-            control_msg = control_msg.encode()
+        end_time = time.time()
+        download_time = end_time - start_time
+        log.info('Direct download of %s from %s completed in %.4f seconds', file_name, datanode_addr, download_time)
+        return download_time
 
-            s.sendall(control_msg)
+    def download_whole(self, file_name: str, file_size: int, token: str, datanode_addr: tuple[str, int]) -> Crc32:
+        with wire.connect(datanode_addr) as s:
+            codecs = self.codecs(file_name)
+            log.debug('# client to datanode: send DOWNLOAD control message to %s', datanode_addr)
+            self.send_control(s, f'DOWNLOAD${file_name}${codecs}${token}' if codecs else f'DOWNLOAD${file_name}${token}')
+            log.debug('# client from datanode: recv SIZE_BYTES from %s', datanode_addr)
+            control_msg = self.recv_control(s)
+            codec = control_msg[1] if len(control_msg) > 1 else ''
+            self.send_control(s, 'READY')
 
+            crc = Crc32()
             with open(f'client_dir/{file_name}', 'wb') as f:
-                bytes_saved = 0
-                while bytes_saved < file_size:
-                    chunk = self.recvall(s, min(MAX_CHUNK_SIZE_BYTES, file_size - bytes_saved))
-                    chunk_size = f.write(chunk)
-                    bytes_saved += chunk_size
+                for chunk in compression.recv_stream(s, file_size, codec):
+                    crc.update(chunk)
+                    f.write(chunk)
+        return crc
+
+    def download_image_striped(self, file_name: str) -> float:
+        start_time = time.time()
+        file_size, token, datanode_addrs, blocks, checksum = self.locate(file_name)
+        if blocks is not None:
+            return self.download_image_blocks(file_name, file_size, blocks, start_time)
+        if file_size < STRIPE_MIN_BYTES or len(datanode_addrs) == 1:
+            stripes = [(datanode_addrs[0], 0, file_size)]
+        else:
+            # intervalos disjuntos, um por replica
+            stripe_size = -(-file_size // len(datanode_addrs))
+            stripes = [(addr, offset, min(stripe_size, file_size - offset))
+                       for addr, offset in zip(datanode_addrs, range(0, file_size, stripe_size))]
+
+        fd = os.open(f'client_dir/{file_name}', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, file_size)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(stripes)) as executor:
+                # cada intervalo tenta as outras replicas se a sua falhar
+                futures = [executor.submit(self.download_range, fd, file_name, token,
+                                           [addr] + [other for other in datanode_addrs if other != addr], offset, length)
+                           for addr, offset, length in stripes]
+                # o CRC de cada intervalo e combinado em ordem no CRC do arquivo inteiro
+                crc = Crc32()
+                for future, (_, _, length) in zip(futures, stripes):
+                    crc.value = crc32_combine(crc.value, future.result(), length)
+        finally:
+            os.close(fd)
+        verify_checksum(file_name, crc, checksum)
+
+        end_time = time.time()
+        download_time = end_time - start_time
+        log.info('Striped download of %s from %s replicas completed in %.4f seconds', file_name, len(stripes), download_time)
+        return download_time
+
+    def download_range(self, fd: int, file_name: str, token: str, datanode_addrs: list[tuple[str, int]], offset: int, length: int) -> int:
+        # devolve o CRC32 do intervalo, lido da primeira replica de datanode_addrs que conseguir envia-lo
+        for datanode_addr in datanode_addrs:
+            try:
+                return self.download_range_from(fd, file_name, token, datanode_addr, offset, length)
+            except (OSError, RuntimeError) as e:
+                log.warning('Range %s-%s of %s from %s failed: %r', offset, offset + length, file_name, datanode_addr, e)
+                if datanode_addr == datanode_addrs[-1]:
+                    raise
+
+    def download_range_from(self, fd: int, file_name: str, token: str, datanode_addr: tuple[str, int], offset: int, length: int) -> int:
+        crc = Crc32()
+        with wire.connect(datanode_addr) as s:
+            log.debug('# client to datanode: send DOWNLOAD of bytes %s-%s to %s', offset, offset + length, datanode_addr)
+            self.send_control(s, f'DOWNLOAD${file_name}${offset}${length}${token}')
+            control_msg = self.recv_control(s)
+            if int(control_msg[0]) != length:
+                raise RuntimeError(f"Datanode {datanode_addr} answered {control_msg[0]} bytes for a {length} byte range")
+            self.send_control(s, 'READY')
+
+            # cada intervalo e escrito direto na sua posicao do arquivo final
+            bytes_saved = 0
+            for chunk in wire.recv_chunks(s, length):
+                crc.update(chunk)
+                os.pwrite(fd, chunk, offset + bytes_saved)
+                bytes_saved += len(chunk)
+        return crc.value
+
+    def download_image_blocks(self, file_name: str, file_size: int, blocks: list, start_time: float) -> float:
+        # blocos vem em paralelo, cada um da replica que o main indicou primeiro (as outras sao alternativas),
+        # e sao escritos na sua posicao
+        fd = os.open(f'client_dir/{file_name}', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, file_size)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=BLOCK_TRANSFER_WORKERS) as executor:
+                futures = []
+                offset = 0
+                for block_hash, block_size, token, datanode_addrs in blocks:
+                    futures.append(executor.submit(self.download_block, fd, block_hash, token, datanode_addrs, offset, block_size))
+                    offset += block_size
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
 
         end_time = time.time()
         download_time = end_time - start_time
-        print(f"Download of {file_name} completed in {download_time:.4f} seconds")
+        log.info('Block download of %s (%s blocks) completed in %.4f seconds', file_name, len(blocks), download_time)
         return download_time
 
+    def download_block(self, fd: int, block_hash: str, token: str, datanode_addrs: list[tuple[str, int]], offset: int, block_size: int):
+        # replicas na ordem do main: uma que nao responde ou manda bytes errados passa a vez para a proxima
+        for i, datanode_addr in enumerate(datanode_addrs):
+            try:
+                self.fetch_block(fd, block_hash, token, datanode_addr, offset, block_size)
+                return
+            except (OSError, RuntimeError, ValueError) as e:
+                if i == len(datanode_addrs) - 1:
+                    raise
+                log.warning('Block %s from %s failed: %s, trying next replica', block_hash, datanode_addr, e)
+
+    def fetch_block(self, fd: int, block_hash: str, token: str, datanode_addr: tuple[str, int], offset: int, block_size: int):
+        hasher = hashlib.sha256()
+        with wire.connect(datanode_addr) as s:
+            log.debug('# client to datanode: send GET_BLOCK control message to %s', datanode_addr)
+            self.send_control(s, f'GET_BLOCK${block_hash}${token}')
+            control_msg = self.recv_control(s)
+            if int(control_msg[0]) != block_size:
+                raise RuntimeError(f"Datanode {datanode_addr} answered {control_msg[0]} bytes for a {block_size} byte block")
+            self.send_control(s, 'READY')
+
+            bytes_saved = 0
+            for chunk in wire.recv_chunks(s, block_size):
+                hasher.update(chunk)
+                os.pwrite(fd, chunk, offset + bytes_saved)
+                bytes_saved += len(chunk)
+        if hasher.hexdigest() != block_hash:
+            raise RuntimeError(f"Block {block_hash} from {datanode_addr} is corrupted")
+
+    def locate(self, file_name: str) -> tuple[int, str | None, list[tuple[str, int]], list | None, str | None]:
+        # (size, token, datanodes, blocks, checksum); arquivos em blocos vem com
+        # blocks = [(hash, size, token, datanodes)] e sem token/datanodes do arquivo
+        with wire.connect(self.srv_addr) as s:
+            log.debug('# client to main: send LOCATE control message')
+            self.send_control(s, f'LOCATE${file_name}')
+            log.debug('# client from main: recv LOCATION message')
+            control_msg = self.recv_control(s)
+            if control_msg[0] == 'BLOCKS':
+                blocks = []
+                for line in self.recvall(s, int(control_msg[2])).decode().splitlines():
+                    block_hash, block_size, token, datanodes = line.split()
+                    blocks.append((block_hash, int(block_size), token, parse_addrs(datanodes)))
+                return int(control_msg[1]), None, [], blocks, control_msg[3] or None
+        if control_msg[0] != 'LOCATION':
+            raise FileNotFoundError(f"{file_name}: {control_msg}")
+        return int(control_msg[1]), control_msg[2], parse_addrs(control_msg[3]), None, control_msg[4] or None
+
+    def read_range(self, file_name: str, offset: int, length: int) -> bytes:
+        # so os bytes [offset, offset + length), lidos direto da replica recomendada pelo main
+        file_size, token, datanode_addrs, blocks, _ = self.locate(file_name)
+        if blocks is not None:
+            raise RuntimeError(f"{file_name} is stored in blocks, ranges are read per block")
+        length = max(0, min(length, file_size - offset))
+        with wire.connect(datanode_addrs[0]) as s:
+            log.debug('# client to datanode: send DOWNLOAD of bytes %s-%s to %s', offset, offset + length, datanode_addrs[0])
+            self.send_control(s, f'DOWNLOAD${file_name}${offset}${length}${token}')
+            length = int(self.recv_control(s)[0])
+            self.send_control(s, 'READY')
+            return self.recvall(s, length)
+
+    def get_tile(self, file_name: str, level: int, x: int, y: int) -> bytes:
+        # PNG do tile x, y do nivel level (0 = resolucao original, cada nivel com metade do anterior)
+        return self.fetch_derived(file_name, f'TILE${file_name}${level}${x}${y}')
+
+    def get_thumbnail(self, file_name: str, size: int = THUMBNAIL_SIZE) -> bytes:
+        # PNG com o lado maior de size pixels
+        return self.fetch_derived(file_name, f'THUMBNAIL${file_name}${size}')
+
+    def get_tiles(self, file_name: str, tiles: list[tuple[int, int, int]], parallelism: int = BATCH_WORKERS) -> dict[tuple[int, int, int], bytes | Exception]:
+        # varios tiles (level, x, y) de uma imagem; pelo main vao pelas sessoes BATCH de run_batch
+        data = {}
+
+        def fetch(s, tile):
+            level, x, y = tile
+            data[tile] = self.derived_over(s, f'TILE${file_name}${level}${x}${y}')
+
+        if self.direct or self.striped:
+            errors = self.run_many(lambda tile: data.__setitem__(tile, self.get_tile(file_name, *tile)), tiles, parallelism)
+        else:
+            errors = self.run_batch(fetch, tiles, parallelism)
+        return {tile: errors[tile] or data[tile] for tile in tiles}
+
+    def fetch_derived(self, file_name: str, request: str) -> bytes:
+        if self.direct or self.striped:
+            # direto da replica, com o token de leitura do LOCATE
+            _, token, datanode_addrs, blocks, _ = self.locate(file_name)
+            if blocks is not None:
+                raise RuntimeError(f"{file_name}: tiles unavailable for files stored in blocks")
+            with wire.connect(datanode_addrs[0]) as s:
+                return self.derived_over(s, f'{request}${token}')
+        with wire.connect(self.srv_addr) as s:
+            return self.derived_over(s, request)
+
+    def derived_over(self, s: socket.socket, request: str) -> bytes:
+        log.debug('# client to server: send %s control message', request.split('$')[0])
+        self.send_control(s, request)
+        log.debug('# client from server: recv SIZE_BYTES')
+        control_msg = self.recv_control(s)
+        if control_msg[0] == 'ERROR':
+            if control_msg[1] == 'not found':
+                raise FileNotFoundError(f"{request.split('$')[1]}: {control_msg[1]}")
+            raise RuntimeError(f"{request.split('$')[0]} failed: {control_msg[1]}")
+        self.send_control(s, 'READY')
+        return self.recvall(s, int(control_msg[0]))
+
     def delete_image(self, file_name) -> None:
-        control_msg = f'DELETE${file_name}'
-        control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-        control_msg = control_msg.encode()
+        with wire.connect(self.srv_addr) as s:
+            log.debug('# client to main: send DELETE control message')
+            self.send_control(s, f'DELETE${file_name}')
+            log.debug('# client from main: recv DONE message')
+            control_msg = self.recv_control(s)
+        if control_msg[0] == 'ERROR':
+            if control_msg[1] == 'not found':
+                raise FileNotFoundError(f"{file_name}: {control_msg[1]}")
+            raise RuntimeError(f"Deletion of {file_name} failed: {control_msg[1]}")
+
+    def cache_stats(self) -> dict:
+        with wire.connect(self.srv_addr) as s:
+            self.send_control(s, 'CACHE_STATS')
+            control_msg = self.recv_control(s)
+        return {k: int(v) for k, v in (field.split('=') for field in control_msg[1:])}
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect(self.srv_addr)
-            s.sendall(control_msg)
+    def codecs(self, file_name: str) -> str:
+        return compression.offer(file_name) if self.compress else ''
 
     def recvall(self, conn: socket.socket, msg_size: int) -> bytes:
-        bytes_recvd = 0
-        chunks = []
-        while bytes_recvd < msg_size:
-            chunk = conn.recv(msg_size)
-            chunks.append(chunk)
-            bytes_recvd += len(chunk)
-        return b''.join(chunks)
+        return wire.recvall(conn, msg_size)
+
+    def send_control(self, conn: socket.socket, msg: str):
+        wire.send_control(conn, msg)
+
+    def recv_control(self, conn: socket.socket) -> list[str]:
+        return wire.recv_control(conn)
+
+class UploadSession:
+    # conexao BATCH com o main para os comandos SESSION_*; reconecta e retoma quando a conexao cai
+    def __init__(self, client: Client, upload_id: str | None) -> None:
+        self.client = client
+        self.upload_id = upload_id
+        self.conn = None
+        self.failures = 0
+
+    def connect(self) -> socket.socket:
+        if self.conn is None:
+            self.conn = wire.connect(self.client.srv_addr)
+            self.client.send_control(self.conn, 'BATCH')
+        return self.conn
+
+    def lost(self, e: ConnectionError):
+        self.close()
+        self.failures += 1
+        if self.failures > UPLOAD_RETRIES:
+            raise e
+        log.warning('Upload session %s lost its connection (%r), retrying', self.upload_id, e)
+        time.sleep(UPLOAD_RETRY_DELAY_SECONDS * self.failures)
+
+    def request(self, send):
+        # send(conn) faz uma troca completa que pode ser repetida; erros de conexao reabrem a sessao
+        while True:
+            try:
+                result = send(self.connect())
+                self.failures = 0
+                return result
+            except ConnectionError as e:
+                self.lost(e)
+
+    def open(self, file_name: str) -> str:
+        def send(conn):
+            self.client.send_control(conn, f'SESSION_OPEN${file_name}')
+            return self.client.recv_control(conn)
+        control_msg = self.request(send)
+        if control_msg[0] != 'SESSION':
+            raise RuntimeError(f"Server refused upload of {file_name}: {control_msg}")
+        self.upload_id = control_msg[1]
+        return self.upload_id
+
+    def offset(self) -> int:
+        def send(conn):
+            self.client.send_control(conn, f'SESSION_STATUS${self.upload_id}')
+            return self.client.recv_control(conn)
+        control_msg = self.request(send)
+        if control_msg[0] not in ('OFFSET', 'COMMITTED'):
+            raise RuntimeError(f"Upload {self.upload_id}: {control_msg}")
+        return int(control_msg[1])
+
+    def append(self, offset: int, piece: bytes):
+        # envia piece a partir de offset; depois de uma queda pergunta ao main quanto chegou e manda so o resto
+        end = offset + len(piece)
+        received = offset
+        while received < end:
+            try:
+                conn = self.connect()
+                self.client.send_control(conn, f'SESSION_APPEND${self.upload_id}${received}${end - received}')
+                control_msg = self.client.recv_control(conn)
+                if control_msg[0] == 'ERROR' and control_msg[1] in ('busy', 'offset mismatch'):
+                    # a conexao anterior ainda esta sendo atendida: trata como queda
+                    raise ConnectionError(control_msg[1])
+                if control_msg[0] != 'READY':
+                    raise RuntimeError(f"Upload {self.upload_id}: {control_msg}")
+                conn.sendall(memoryview(piece)[received - offset:])
+                control_msg = self.client.recv_control(conn)
+                if control_msg[0] != 'ACK':
+                    raise RuntimeError(f"Upload {self.upload_id}: {control_msg}")
+                received = int(control_msg[1])
+                self.failures = 0
+            except ConnectionError as e:
+                self.lost(e)
+                received = self.offset()
+                if not offset <= received <= end:
+                    raise RuntimeError(f"Upload {self.upload_id} is at offset {received}, expected {offset}..{end}")
+
+    def commit(self, checksum: str) -> str:
+        # repetir o commit e seguro: o main responde DONE de novo para uma sessao ja confirmada
+        def send(conn):
+            self.client.send_control(conn, f'SESSION_COMMIT${self.upload_id}${checksum}')
+            return self.client.recv_control(conn)
+        control_msg = self.request(send)
+        if control_msg[0] != 'DONE':
+            raise RuntimeError(f"Commit of upload {self.upload_id} failed: {control_msg}")
+        return control_msg[1]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+def pieces(chunks, piece_size: int):
+    # junta os chunks em pedacos de pelo menos piece_size bytes (o ultimo pode ser menor)
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) >= piece_size:
+            yield bytes(buf)
+            buf.clear()
+    if buf:
+        yield bytes(buf)
+
+def parse_addrs(addrs: str) -> list[tuple[str, int]]:
+    parsed = []
+    for addr in addrs.split(','):
+        host, port = addr.rsplit(':', 1)
+        parsed.append((host, int(port)))
+    return parsed
+
+def verify_checksum(file_name: str, crc: Crc32, checksum: str | None):
+    # arquivos gravados antes dos checksums nao tem o que conferir
+    if checksum and crc.hexdigest() != checksum:
+        raise RuntimeError(f"Checksum mismatch for {file_name}: got {crc.hexdigest()}, expected {checksum}")
 
 def calculate_md5(file_path):
     md5_hash = hashlib.md5()
@@ -120,7 +749,9 @@ def calculate_md5(file_path):
     return md5_hash.hexdigest()
 
 if __name__ == '__main__':
-    c = Client(MAIN_ADDR, MAIN_PORT)
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    c = Client(MAIN_ADDR, MAIN_PORT, direct='--direct' in sys.argv, blocks='--blocks' in sys.argv, compress='--compress' in sys.argv)
     print(f"md5 of fake_img.jpg BEFORE:\n{calculate_md5('client_dir/fake_img.jpg')}")
 
     input('...')
@@ -0,0 +1,227 @@
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+import wire
+
+# compressao das transferencias (negociada por transferencia) e do armazenamento nos datanodes.
+# Um fluxo comprimido vai em frames: tamanho (uint32 big-endian) e os bytes comprimidos; um frame vazio
+# encerra o fluxo. Os tamanhos e checksums do protocolo continuam sendo os dos bytes originais.
+FRAME_HEADER = struct.Struct('!I')
+MAX_FRAME_OVERHEAD = 1024  # cabecalhos e checksums dos codecs, alem do que os bytes originais ocupam
+
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+
+# codecs em ordem de preferencia; zstd e lz4 so entram se o modulo estiver instalado
+CODECS = [codec for codec, available in (('zstd', zstandard is not None), ('lz4', lz4 is not None), ('zlib', True)) if available]
+
+# formatos que ja vem comprimidos: comprimir de novo so gasta CPU
+INCOMPRESSIBLE_EXTENSIONS = ('.jpg', '.jpeg', '.jp2', '.png', '.gif', '.webp', '.zip', '.gz', '.bz2', '.xz', '.zst', '.lz4', '.7z')
+
+# arquivos comprimidos no datanode: MAGIC, nome do codec (16 bytes, completado com NUL), tamanho original
+# (uint64) e o fluxo em frames
+STORED_MAGIC = b'MGEOZ\x00\x01\x00'
+STORED_HEADER = struct.Struct('!8s16sQ')
+
+def compressible(file_name: str) -> bool:
+    return not file_name.lower().endswith(INCOMPRESSIBLE_EXTENSIONS)
+
+def offer(file_name: str) -> str:
+    # campo CODECS dos pedidos: vazio para arquivos que nao vale a pena comprimir
+    return ','.join(CODECS) if compressible(file_name) else ''
+
+def negotiate(offered: str) -> str:
+    # primeiro codec da nossa preferencia que o outro lado oferece; vazio = sem compressao
+    offered = offered.split(',')
+    for codec in CODECS:
+        if codec in offered:
+            return codec
+    return ''
+
+def choose(offered: str, file_name: str) -> str:
+    # codec de uma transferencia pedida com CODECS (campo opcional; vazio para clientes antigos)
+    return negotiate(offered) if offered and compressible(file_name) else ''
+
+class Compressor:
+    def __init__(self, codec: str) -> None:
+        if codec == 'zstd':
+            self.obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif codec == 'lz4':
+            self.obj = lz4.frame.LZ4FrameCompressor()
+            self.header = self.obj.begin()
+        elif codec == 'zlib':
+            self.obj = zlib.compressobj(ZLIB_LEVEL)
+        else:
+            raise ValueError(f'unknown codec {codec!r}')
+        self.codec = codec
+
+    def compress(self, data) -> bytes:
+        out = self.obj.compress(data)
+        if self.codec == 'lz4' and self.header:
+            out, self.header = self.header + out, b''
+        return out
+
+    def flush(self) -> bytes:
+        return self.obj.flush()
+
+class Decompressor:
+    # zlib e lz4; o zstd passa por FrameReader, porque o decompressobj dele nao limita a saida
+    def __init__(self, codec: str) -> None:
+        if codec == 'lz4':
+            self.obj = lz4.frame.LZ4FrameDecompressor()
+        elif codec == 'zlib':
+            self.obj = zlib.decompressobj()
+        else:
+            raise ValueError(f'unknown codec {codec!r}')
+
+    def decompress(self, data, max_length: int) -> bytes:
+        # no maximo max_length bytes: passar disso e um fluxo errado ou uma bomba de descompressao,
+        # e para antes de ocupar a memoria
+        out = self.obj.decompress(data, max_length + 1)
+        if len(out) > max_length:
+            raise ValueError('decompressed data exceeds the announced size')
+        return out
+
+class FrameReader:
+    # os frames como um arquivo continuo, para o read_to_iter do zstd, que entrega a saida aos poucos
+    def __init__(self, frames) -> None:
+        self.frames = frames
+        self.buf = b''
+
+    def read(self, size: int) -> bytes:
+        if not self.buf:
+            self.buf = next(self.frames, b'')
+        out, self.buf = self.buf[:size], self.buf[size:]
+        return out
+
+class FrameWriter:
+    # write(chunk) comprime e passa os frames para o write de baixo (sendall de um socket ou write de um
+    # arquivo); com codec vazio os chunks passam como estao. close() escreve o frame final.
+    def __init__(self, write, codec: str) -> None:
+        self.write_frame = write
+        self.compressor = Compressor(codec) if codec else None
+        self.bytes_out = 0
+
+    def write(self, chunk):
+        if self.compressor is None:
+            self.write_frame(chunk)
+            self.bytes_out += len(chunk)
+            return
+        self.emit(self.compressor.compress(chunk))
+
+    def emit(self, data: bytes):
+        if data:
+            frame = FRAME_HEADER.pack(len(data)) + data
+            self.write_frame(frame)
+            self.bytes_out += len(frame)
+
+    def close(self):
+        if self.compressor is not None:
+            self.emit(self.compressor.flush())
+            self.write_frame(FRAME_HEADER.pack(0))
+            self.bytes_out += FRAME_HEADER.size
+
+def check_frame(length: int, size: int):
+    # um frame nao ocupa muito mais que os bytes originais que ele traz, que nao passam de size
+    if length > size + size // 64 + MAX_FRAME_OVERHEAD:
+        raise ValueError(f'compressed frame of {length} bytes for a {size} byte stream')
+
+def decompress_frames(frames, codec: str, size: int):
+    # gera os bytes originais de um fluxo de frames sem nunca passar de size
+    remaining = size
+    if codec == 'zstd':
+        reader = FrameReader(frames)
+        for data in zstandard.ZstdDecompressor().read_to_iter(reader):
+            remaining -= len(data)
+            if remaining < 0:
+                raise ValueError('decompressed data exceeds the announced size')
+            yield data
+        # o fluxo zstd termina antes do frame vazio, que ainda precisa ser lido
+        if reader.buf or next(frames, None) is not None:
+            raise ValueError('data after the end of the compressed stream')
+        return
+    decompressor = Decompressor(codec)
+    for frame in frames:
+        data = decompressor.decompress(frame, remaining)
+        remaining -= len(data)
+        if data:
+            yield data
+
+def recv_frames(conn, size: int):
+    while True:
+        (length,) = FRAME_HEADER.unpack(wire.recvall(conn, FRAME_HEADER.size))
+        if not length:
+            return
+        check_frame(length, size)
+        yield wire.recvall(conn, length)
+
+def recv_compressed(conn, codec: str, size: int):
+    # gera os bytes originais conforme os frames chegam
+    return decompress_frames(recv_frames(conn, size), codec, size)
+
+def exact(chunks, size: int):
+    # repassa um fluxo descomprimido conferindo que ele tem o tamanho anunciado no pedido
+    received = 0
+    for chunk in chunks:
+        received += len(chunk)
+        if received > size:
+            raise ValueError(f'compressed stream longer than {size} bytes')
+        yield chunk
+    if received != size:
+        raise ValueError(f'compressed stream has {received} bytes, expected {size}')
+
+def recv_stream(conn, size: int, codec: str):
+    # corpo de uma transferencia de size bytes (originais), comprimido ou nao
+    if codec:
+        return exact(recv_compressed(conn, codec, size), size)
+    return wire.recv_chunks(conn, size)
+
+def file_frames(f, size: int):
+    while True:
+        header = f.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            raise ValueError('truncated compressed file')
+        (length,) = FRAME_HEADER.unpack(header)
+        if not length:
+            return
+        check_frame(length, size)
+        yield f.read(length)
+
+def read_frames(f, codec: str, size: int):
+    # mesmo fluxo de recv_compressed, lendo de um arquivo comprimido do datanode (size vem do cabecalho)
+    return decompress_frames(file_frames(f, size), codec, size)
+
+def stored_header(codec: str, size: int) -> bytes:
+    return STORED_HEADER.pack(STORED_MAGIC, codec.encode(), size)
+
+def stored_info(file_path: str) -> tuple[str | None, int]:
+    # (codec, tamanho original) de um arquivo do datanode; codec None para arquivos sem compressao
+    with open(file_path, 'rb') as f:
+        header = f.read(STORED_HEADER.size)
+    if len(header) == STORED_HEADER.size:
+        magic, codec, size = STORED_HEADER.unpack(header)
+        if magic == STORED_MAGIC:
+            return codec.rstrip(b'\0').decode(), size
+    return None, os.path.getsize(file_path)
+
+def skip(chunks, offset: int, length: int):
+    # recorta [offset, offset + length) de um fluxo de chunks (intervalos de arquivos comprimidos)
+    position = 0
+    for chunk in chunks:
+        end = position + len(chunk)
+        if end > offset and position < offset + length:
+            yield chunk[max(0, offset - position):offset + length - position]
+        position = end
+        if position >= offset + length:
+            return
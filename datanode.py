@@ -4,120 +4,699 @@ import os
 import threading
 import hashlib
 import time
+import asyncio
+import concurrent.futures
+import contextlib
+import shutil
+import logging
+import wire
+import compression
+import metrics
+import tiles
+from checksum import Crc32
+from tokens import check_token, require_secret
+from wire import CONTROL_MSG_SIZE_BYTES
 
-CONTROL_MSG_SIZE_BYTES = 1024
-MAX_CHUNK_SIZE_BYTES = 1024 * 4
+log = logging.getLogger('datanode')
+
+# downloads vao direto do page cache para o socket quando o sistema tem sendfile(2)
+USE_SENDFILE = True
+SENDFILE_SUPPORTED = hasattr(os, 'sendfile')
+
+# --compress: imagens gravadas comprimidas (blocos ficam sem compressao, sao lidos por sendfile e hash)
+COMPRESS_AT_REST = False
+
+# comandos que exigem token; o nome (ou hash do bloco) e o segundo campo e o token o ultimo
+TOKEN_COMMANDS = ('UPLOAD', 'DOWNLOAD', 'DELETE', 'PUT_BLOCK', 'GET_BLOCK', 'DELETE_BLOCK', 'TILE', 'THUMBNAIL',
+                  'REPLICATE', 'REPLICATE_BLOCK', 'STAT_BLOCK')
+# TILE/THUMBNAIL sao leituras: valem com o mesmo token do DOWNLOAD (o que o LOCATE entrega)
+TOKEN_OPS = {'TILE': 'DOWNLOAD', 'THUMBNAIL': 'DOWNLOAD'}
+
+# gera miniatura e niveis de baixa resolucao (tiles.py) em segundo plano depois de cada upload de imagem
+PRERENDER_TILES = True
+PRERENDER_WORKERS = 1
+
+# taxa por transferencia reportada no HEARTBEAT: media movel exponencial, so de transferencias grandes
+# o bastante para a medida fazer sentido
+TRANSFER_RATE_ALPHA = 0.2
+TRANSFER_RATE_MIN_BYTES = 256 * 1024
+
+# fsync do arquivo recebido antes do rename: um upload confirmado sobrevive a queda da maquina, ao custo
+# de esperar o disco em cada upload
+FSYNC_UPLOADS = False
+
+# metricas (metrics.py): pedidos por comando e fases de cada transferencia, por comando. Nos recebimentos:
+# connect e handshake (abertura do proximo datanode da cadeia), first_byte (READY ate o primeiro chunk),
+# transfer (resto do corpo), fsync (com FSYNC_UPLOADS) e ack (DONE do proximo datanode); nos envios,
+# handshake (SIZE_BYTES ate o READY de quem pediu) e transfer; TILE/THUMBNAIL tambem tem render
+COMMANDS = ('UPLOAD', 'DOWNLOAD', 'DELETE', 'PUT_BLOCK', 'GET_BLOCK', 'DELETE_BLOCK', 'TILE', 'THUMBNAIL',
+            'REPLICATE', 'REPLICATE_BLOCK', 'PING', 'HEARTBEAT')
+REQUESTS = metrics.Requests('mygeoeye_datanode', COMMANDS)
+PHASE_SECONDS = metrics.Histogram('mygeoeye_datanode_phase_seconds', 'Phases of transfers served by the datanode', ('command', 'phase'))
+TRANSFER_BYTES = metrics.Counter('mygeoeye_datanode_bytes_total', 'Bytes received (in) and sent (out) in transfers', ('direction',))
+
+# modo asyncio: limite de conexoes simultaneas e threads para comandos bloqueantes
+LISTEN_BACKLOG = 4096
+MAX_CONCURRENT_CONNECTIONS = 10000
+BLOCKING_WORKERS = 64
+
+# uploads em andamento gravam aqui (temp_path); o que sobrar no inicio veio de um crash e e apagado
+PARTIAL_DIR = 'datanode_dir/partial'
 
 class Datanode:
-    def __init__(self, host, port) -> None:
+    def __init__(self, host, port, use_sendfile: bool = USE_SENDFILE, compress_at_rest: bool = COMPRESS_AT_REST) -> None:
         self.listen_addr = (host, port)
-        self.lock = threading.Lock()
+        self.use_sendfile = use_sendfile and SENDFILE_SUPPORTED
+        self.compress_at_rest = compress_at_rest
+        # carga informada ao main no HEARTBEAT
+        self.inflight = 0
+        self.transfer_rate = 0.0
+        self.stats_lock = threading.Lock()
+        # sem Pillow TILE/THUMBNAIL respondem ERROR e nada e gerado
+        self.prerender = concurrent.futures.ThreadPoolExecutor(max_workers=PRERENDER_WORKERS) \
+            if PRERENDER_TILES and tiles.AVAILABLE else None
         if not os.path.exists('datanode_dir/'):
             os.makedirs('datanode_dir/')
+        if not os.path.exists('datanode_dir/blocks/'):
+            os.makedirs('datanode_dir/blocks/')
+        if not os.path.exists(PARTIAL_DIR):
+            os.makedirs(PARTIAL_DIR)
+        self.discard_partial_files()
+        metrics.Gauge('mygeoeye_datanode_inflight', 'Transfers in progress (reported in HEARTBEAT)', lambda: self.inflight)
+        metrics.Gauge('mygeoeye_datanode_transfer_rate', 'Average bytes/s per transfer (reported in HEARTBEAT)', lambda: self.transfer_rate)
+
+    def discard_partial_files(self):
+        # temporarios de uploads interrompidos por um crash; no inicio nenhum upload esta em andamento.
+        # so PARTIAL_DIR e os .tmp de tiles.py: uma imagem do usuario chamada foo.tmp nao e temporario
+        discarded = 0
+        for name in os.listdir(PARTIAL_DIR):
+            discard(os.path.join(PARTIAL_DIR, name))
+            discarded += 1
+        for directory, _, files in os.walk(tiles.DERIVED_DIR):
+            for name in files:
+                if name.endswith('.tmp'):
+                    discard(os.path.join(directory, name))
+                    discarded += 1
+        if discarded:
+            log.info('Discarded %s partial files from interrupted uploads', discarded)
     
     def start(self):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind(self.listen_addr)
             s.listen(400)
-            print(f'Datanode is listening on {self.listen_addr}')
+            log.info('Datanode is listening on %s', self.listen_addr)
             while True:
                 try:
                     conn, addr = s.accept()
-                    print(f"Connected with {addr}")
+                    wire.tune(conn)
+                    log.debug('Connected with %s', addr)
                     t = threading.Thread(target=self.process_connection, args=(conn, addr), daemon=True)
                     t.start()
                 except KeyboardInterrupt:
-                    print('\tauf wiedersehen...')
+                    log.info('auf wiedersehen...')
                     s.close()
                     quit()
 
+    def start_async(self):
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            log.info('auf wiedersehen...')
+
+    async def serve_async(self):
+        # um event loop atende todas as conexoes; comandos sem versao async vao para um pool limitado de threads
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=BLOCKING_WORKERS))
+        raise_fd_limit(MAX_CONCURRENT_CONNECTIONS + LISTEN_BACKLOG)
+        slots = asyncio.Semaphore(MAX_CONCURRENT_CONNECTIONS)
+        tasks = set()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(self.listen_addr)
+            s.listen(LISTEN_BACKLOG)
+            s.setblocking(False)
+            log.info('Datanode is listening on %s (asyncio, max %s connections)', self.listen_addr, MAX_CONCURRENT_CONNECTIONS)
+            while True:
+                # backpressure: com todos os slots ocupados paramos de aceitar e o backlog do kernel segura o resto
+                await slots.acquire()
+                conn, addr = await loop.sock_accept(s)
+                wire.tune(conn)
+                log.debug('Connected with %s', addr)
+                task = asyncio.create_task(self.process_connection_async(conn, addr))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+
+    async def process_connection_async(self, conn: socket.socket, addr: tuple[str, int]):
+        loop = asyncio.get_running_loop()
+        with conn:
+            try:
+                # conexao persistente: atende pedidos em sequencia ate o outro lado fechar
+                while True:
+                    conn.setblocking(False)
+                    log.debug('# datanode from main: recv control message from %s', addr)
+                    try:
+                        control_msg = await wire.recv_control_async(loop, conn)
+                    except ConnectionError:
+                        break
+                    if control_msg[0] == 'DOWNLOAD' and check_token(control_msg[-1], control_msg[0], control_msg[1]):
+                        log.debug('%s requesting download of %s', addr, control_msg[1])
+                        offset, length, codecs = parse_download(control_msg)
+                        with REQUESTS.measure('DOWNLOAD'), self.transfer():
+                            await self.send_file_async(conn, addr, f'datanode_dir/{control_msg[1]}', offset, length, codecs)
+                    elif control_msg[0] == 'GET_BLOCK' and check_token(control_msg[-1], control_msg[0], control_msg[1]):
+                        log.debug('%s requesting download of block %s', addr, control_msg[1])
+                        offset, length, _ = parse_download(control_msg)
+                        with REQUESTS.measure('GET_BLOCK'), self.transfer():
+                            await self.send_file_async(conn, addr, block_path(control_msg[1]), offset, length, command='GET_BLOCK')
+                    else:
+                        conn.setblocking(True)
+                        await loop.run_in_executor(None, self.handle, conn, addr, control_msg)
+            except Exception as e:
+                log.warning('Connection with %s failed: %r', addr, e)
+
     def process_connection(self, conn: socket.socket, addr: tuple[str, int]):
         with conn:
-            print(f"# datanode from main: recv control message from {addr}")
-            control_msg = self.recvall(conn, CONTROL_MSG_SIZE_BYTES)
-            control_msg = control_msg.decode()
-            control_msg = control_msg.strip().split('$')
-            if control_msg[0] == 'UPLOAD':
-                print(f'{addr} requesting upload')
-                file_name = control_msg[1]
-                file_size = int(control_msg[2])
-                self.save_image(conn, addr, file_name, file_size)
-            elif control_msg[0] == 'DOWNLOAD':
-                print(f'{addr} requesting download of {control_msg[1]}')
-                self.send_image(conn, addr, control_msg[1])
-            elif control_msg[0] == 'DELETE':
-                print(f'{addr} requesting deletion of {control_msg[1]}')
-                self.delete_image(conn, addr, control_msg[1])
-
-    def save_image(self, conn: socket.socket, addr: tuple[str, int], file_name: str, file_size: int):
-        print(f"# datanode to main: send READY message to {addr}")
-        control_msg = 'READY'.ljust(CONTROL_MSG_SIZE_BYTES ,' ').encode()
-        conn.sendall(control_msg)
+            # conexao persistente: atende pedidos em sequencia ate o outro lado fechar
+            while True:
+                log.debug('# datanode from main: recv control message from %s', addr)
+                try:
+                    control_msg = self.recv_control(conn)
+                except ConnectionError:
+                    break
+                try:
+                    self.handle(conn, addr, control_msg)
+                except Exception as e:
+                    # como no modo asyncio, o pedido falha e a thread nao. Nao da para saber quanto do pedido ainda
+                    # esta no socket (um PUT_BLOCK ja recebeu READY), entao responde ERROR e fecha a conexao
+                    log.warning('%s from %s failed: %r', control_msg[0], addr, e)
+                    if not isinstance(e, ConnectionError):
+                        with contextlib.suppress(OSError):
+                            self.send_control(conn, f'ERROR${e}')
+                    break
+
+    def handle(self, conn: socket.socket, addr: tuple[str, int], control_msg: list[str]):
+        with REQUESTS.measure(control_msg[0]):
+            self.dispatch(conn, addr, control_msg)
+
+    def dispatch(self, conn: socket.socket, addr: tuple[str, int], control_msg: list[str]):
+        if control_msg[0] in TOKEN_COMMANDS and not check_token(control_msg[-1], TOKEN_OPS.get(control_msg[0], control_msg[0]), control_msg[1]):
+            log.warning('%s sent an invalid token for %s of %s', addr, control_msg[0], control_msg[1])
+            self.send_control(conn, 'ERROR$invalid token')
+            return
+        if control_msg[0] == 'UPLOAD':
+            log.debug('%s requesting upload', addr)
+            file_name = control_msg[1]
+            file_size = int(control_msg[2])
+            with self.transfer():
+                self.save_image(conn, addr, file_name, file_size, control_msg[3], control_msg[4])
+        elif control_msg[0] == 'DOWNLOAD':
+            log.debug('%s requesting download of %s', addr, control_msg[1])
+            offset, length, codecs = parse_download(control_msg)
+            with self.transfer():
+                self.send_image(conn, addr, control_msg[1], offset, length, codecs)
+        elif control_msg[0] == 'DELETE':
+            log.debug('%s requesting deletion of %s', addr, control_msg[1])
+            self.delete_image(conn, addr, control_msg[1])
+        elif control_msg[0] == 'PUT_BLOCK':
+            log.debug('%s requesting upload of block %s', addr, control_msg[1])
+            with self.transfer():
+                self.save_block(conn, addr, control_msg[1], int(control_msg[2]), control_msg[3], control_msg[4])
+        elif control_msg[0] == 'GET_BLOCK':
+            log.debug('%s requesting download of block %s', addr, control_msg[1])
+            offset, length, _ = parse_download(control_msg)
+            with self.transfer():
+                self.send_file(conn, addr, block_path(control_msg[1]), offset, length, command='GET_BLOCK')
+        elif control_msg[0] == 'DELETE_BLOCK':
+            log.debug('%s requesting deletion of block %s', addr, control_msg[1])
+            self.delete_block(conn, addr, control_msg[1])
+        elif control_msg[0] == 'STAT_BLOCK':
+            self.stat_block(conn, control_msg[1])
+        elif control_msg[0] == 'TILE':
+            log.debug('%s requesting tile %s/%s/%s of %s', addr, control_msg[2], control_msg[3], control_msg[4], control_msg[1])
+            with self.transfer():
+                self.send_derived(conn, addr, 'TILE', control_msg[1],
+                                  lambda path: tiles.tile(path, control_msg[1], int(control_msg[2]), int(control_msg[3]), int(control_msg[4])))
+        elif control_msg[0] == 'THUMBNAIL':
+            log.debug('%s requesting thumbnail of %s', addr, control_msg[1])
+            with self.transfer():
+                self.send_derived(conn, addr, 'THUMBNAIL', control_msg[1], lambda path: tiles.thumbnail(path, control_msg[1], int(control_msg[2])))
+        elif control_msg[0] in ('REPLICATE', 'REPLICATE_BLOCK'):
+            log.debug('%s requesting copy of %s to %s', addr, control_msg[1], control_msg[2])
+            with self.transfer():
+                self.replicate(conn, addr, control_msg[0], control_msg[1], control_msg[2], int(control_msg[3]), control_msg[4])
+        elif control_msg[0] == 'PING':
+            self.send_control(conn, 'PONG')
+        elif control_msg[0] == 'HEARTBEAT':
+            self.send_heartbeat(conn)
+
+    def send_heartbeat(self, conn: socket.socket):
+        # HEARTBEAT$FREE_BYTES$INFLIGHT$RATE: o main usa para escolher onde gravar e de onde ler
+        free_bytes = shutil.disk_usage('datanode_dir').free
+        with self.stats_lock:
+            inflight, rate = self.inflight, self.transfer_rate
+        self.send_control(conn, f'HEARTBEAT${free_bytes}${inflight}${rate:.0f}')
+
+    @contextlib.contextmanager
+    def transfer(self):
+        with self.stats_lock:
+            self.inflight += 1
+        try:
+            yield
+        finally:
+            with self.stats_lock:
+                self.inflight -= 1
+
+    def record_transfer(self, num_bytes: int, seconds: float):
+        if num_bytes < TRANSFER_RATE_MIN_BYTES or seconds <= 0:
+            return
+        with self.stats_lock:
+            rate = num_bytes / seconds
+            self.transfer_rate = rate if not self.transfer_rate else \
+                TRANSFER_RATE_ALPHA * rate + (1 - TRANSFER_RATE_ALPHA) * self.transfer_rate
+
+    def save_image(self, conn: socket.socket, addr: tuple[str, int], file_name: str, file_size: int, chain: str, token: str):
+        # replicacao em cadeia: repassa cada chunk para o proximo datanode enquanto grava
+        trace = metrics.Trace(PHASE_SECONDS, 'UPLOAD')
+        downstream = self.open_downstream('UPLOAD', file_name, file_size, chain, token, trace)
+
+        log.debug('# datanode to upstream: send READY message to %s', addr)
+        self.send_control(conn, 'READY')
+        # cada upload grava no seu arquivo temporario e so troca pelo definitivo no fim (rename atomico):
+        # uploads simultaneos nao se esperam e um download nunca ve um arquivo pela metade
         file_path = f'datanode_dir/{file_name}'
+        tmp_path = temp_path()
+        crc = Crc32()
+        # replicas seguintes recebem os bytes originais e decidem sozinhas se comprimem
+        codec = compression.CODECS[0] if self.compress_at_rest and compression.compressible(file_name) else ''
+        start_time = time.time()
+        try:
+            with open(tmp_path, 'wb') as f:
+                if codec:
+                    f.write(compression.stored_header(codec, file_size))
+                out = compression.FrameWriter(f.write, codec)
+                downstream = self.receive_chunks(conn, out, file_size, downstream, file_name, trace, crc)
+                out.close()
+                if FSYNC_UPLOADS:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    trace.mark('fsync')
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            discard(tmp_path)
+            raise
+        end_time = time.time()
+        self.record_transfer(file_size, end_time - start_time)
+        self.derive(file_path, file_name)
+
+        # DONE$N$CHECKSUM: quantos datanodes a partir deste gravaram o arquivo e o CRC32 do que foi gravado;
+        # replicas seguintes com outro checksum nao contam
+        checksum = crc.hexdigest()
+        stored, downstream_checksum = self.finish_pipeline(downstream, file_name, trace)
+        if stored and downstream_checksum != checksum:
+            log.warning('Downstream replica of %s has checksum %s, expected %s', file_name, downstream_checksum, checksum)
+            stored = 0
+        stored += 1
+        log.debug('# datanode to upstream: send DONE message to %s', addr)
+        self.send_control(conn, f'DONE${stored}${checksum}')
+        log.debug('Upload for %s from %s completed in %.4f seconds (%s replicas, crc32 %s)', file_name, addr, end_time - start_time, stored, checksum)
+        trace.done(log, file_name)
+
+    def save_block(self, conn: socket.socket, addr: tuple[str, int], block_hash: str, block_size: int, chain: str, token: str):
+        # blocos sao enderecados pelo sha256 do conteudo: um bloco que ja existe nao e gravado de novo
+        trace = metrics.Trace(PHASE_SECONDS, 'PUT_BLOCK')
+        downstream = self.open_downstream('PUT_BLOCK', block_hash, block_size, chain, token, trace)
+
+        log.debug('# datanode to upstream: send READY message to %s', addr)
+        self.send_control(conn, 'READY')
+        path = block_path(block_hash)
+        exists = os.path.exists(path)
+        tmp_path = temp_path()
+        hasher = hashlib.sha256()
         start_time = time.time()
-        with open(file_path, 'wb') as f, self.lock:
-            bytes_saved = 0
-            while bytes_saved < file_size:
-                chunk = self.recvall(conn, min(MAX_CHUNK_SIZE_BYTES, file_size - bytes_saved))
-                chunk_size = f.write(chunk)
-                bytes_saved += chunk_size
-                #print(f"Saved {bytes_saved}/{file_size} bytes of {file_name}")
+        try:
+            with open(os.devnull if exists else tmp_path, 'wb') as f:
+                downstream = self.receive_chunks(conn, f, block_size, downstream, block_hash, trace, hasher)
+                if FSYNC_UPLOADS and not exists:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    trace.mark('fsync')
+        except BaseException:
+            discard(tmp_path)
+            raise
         end_time = time.time()
-        print(f"md5 of {file_name}:\n{calculate_md5(file_path)}")
-        print(f'Upload for {file_name} from {addr} completed in {end_time - start_time:.4f} seconds')
+        self.record_transfer(block_size, end_time - start_time)
 
-    def send_image(self, conn: socket.socket, addr: tuple[str, int], file_name: str):
-        file_size = os.path.getsize(f'datanode_dir/{file_name}')
-        control_msg = f'{file_size}'
-        control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-        control_msg = control_msg.encode()
+        stored, _ = self.finish_pipeline(downstream, block_hash, trace)
+        if hasher.hexdigest() != block_hash:
+            log.warning('Block %s from %s does not match its hash', block_hash, addr)
+            discard(tmp_path)
+            self.send_control(conn, 'ERROR$hash mismatch')
+            return
+        if not exists:
+            os.replace(tmp_path, path)
+        stored += 1
+        log.debug('# datanode to upstream: send DONE message to %s', addr)
+        self.send_control(conn, f'DONE${stored}')
+        state = 'already stored' if exists else 'stored'
+        log.debug('Block %s from %s %s in %.4f seconds (%s replicas)', block_hash, addr, state, end_time - start_time, stored)
+        trace.done(log, block_hash)
+
+    def receive_chunks(self, conn: socket.socket, f, file_size: int, downstream: socket.socket | None, name: str,
+                       trace: metrics.Trace, hasher=None) -> socket.socket | None:
+        # grava e repassa cada chunk; devolve o downstream, ou None se ele caiu no meio
+        trace.skip()
+        for chunk in trace.first_byte(wire.recv_chunks(conn, file_size)):
+            if downstream is not None:
+                try:
+                    downstream.sendall(chunk)
+                except OSError as e:
+                    log.warning('Downstream replica of %s failed: %s', name, e)
+                    downstream.close()
+                    downstream = None
+            if hasher is not None:
+                hasher.update(chunk)
+            f.write(chunk)
+        trace.mark('transfer')
+        TRANSFER_BYTES.inc('in', amount=file_size)
+        return downstream
 
-        print(f"# datanode to main: send SIZE_BYTES to {addr}")
-        conn.sendall(control_msg)
+    def finish_pipeline(self, downstream: socket.socket | None, name: str, trace: metrics.Trace) -> tuple[int, str | None]:
+        # quantos datanodes depois deste confirmaram a gravacao, e o checksum que informaram
+        if downstream is None:
+            return 0, None
+        with downstream:
+            try:
+                log.debug('# datanode from downstream: recv DONE message for %s', name)
+                trace.skip()
+                msg = self.recv_control(downstream)
+                trace.mark('ack')
+                if msg[0] == 'DONE':
+                    return int(msg[1]), msg[2] if len(msg) > 2 else None
+            except OSError as e:
+                log.warning('Downstream replica of %s failed: %s', name, e)
+        return 0, None
 
-        print(f"# datanode from main: recv READY message from {addr}")
-        control_msg = self.recvall(conn, CONTROL_MSG_SIZE_BYTES)
+    def open_downstream(self, op: str, name: str, size: int, chain: str, token: str, trace: metrics.Trace) -> socket.socket | None:
+        if not chain:
+            return None
+        next_addr, _, rest = chain.partition(',')
+        host, port = next_addr.rsplit(':', 1)
+        downstream = wire.prepare(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+        try:
+            downstream.connect((host, int(port)))
+            trace.mark('connect')
+            log.debug('# datanode to downstream: send %s control message to %s', op, next_addr)
+            self.send_control(downstream, f'{op}${name}${size}${rest}${token}')
+            log.debug('# datanode from downstream: recv READY message from %s', next_addr)
+            if self.recv_control(downstream)[0] == 'READY':
+                trace.mark('handshake')
+                return downstream
+            log.warning('Downstream datanode %s not ready', next_addr)
+        except OSError as e:
+            log.warning('Could not reach downstream datanode %s: %s', next_addr, e)
+        downstream.close()
+        return None
 
+    def derive(self, file_path: str, file_name: str):
+        # derivados da versao anterior saem; os da nova sao gerados fora do caminho do upload
+        tiles.discard(file_name)
+        if self.prerender is not None and tiles.is_image(file_name):
+            self.prerender.submit(self.prerender_tiles, file_path, file_name)
+
+    def prerender_tiles(self, file_path: str, file_name: str):
+        start_time = time.time()
+        try:
+            tiles.prerender(file_path, file_name)
+        except Exception as e:
+            log.warning('Could not prerender tiles of %s: %r', file_name, e)
+            return
+        log.debug('Prerendered tiles of %s in %.4f seconds', file_name, time.time() - start_time)
+
+    def send_derived(self, conn: socket.socket, addr: tuple[str, int], command: str, file_name: str, derive):
+        # TILE/THUMBNAIL: SIZE_BYTES e o PNG guardado (gerado agora se ainda nao existia), ou ERROR$MSG
         file_path = f'datanode_dir/{file_name}'
+        if not tiles.AVAILABLE:
+            self.send_control(conn, 'ERROR$tiles unavailable: Pillow not installed')
+            return
+        start_time = time.time()
+        try:
+            with PHASE_SECONDS.time(command, 'render'):
+                derived_path = derive(file_path)
+        except FileNotFoundError:
+            self.send_control(conn, 'ERROR$not found')
+            return
+        except ValueError as e:
+            self.send_control(conn, f'ERROR${e}')
+            return
+        except Exception as e:
+            # PIL.UnidentifiedImageError, DecompressionBombError...: o arquivo nao e uma imagem que o Pillow saiba ler
+            log.warning('Could not derive from %s: %r', file_name, e)
+            self.send_control(conn, 'ERROR$unsupported image')
+            return
+        log.debug('Derived %s of %s ready in %.4f seconds', os.path.basename(derived_path), file_name, time.time() - start_time)
+        self.send_file(conn, addr, derived_path, command=command)
+
+    def replicate(self, conn: socket.socket, addr: tuple[str, int], op: str, name: str, target: str, rate: int, target_token: str):
+        # reparo/rebalanceamento pedido pelo main: envia a copia local para target como um UPLOAD (ou PUT_BLOCK)
+        # sem cadeia, a no maximo rate bytes/s, e responde com o DONE do destino ou ERROR$MSG
+        file_path = f'datanode_dir/{name}' if op == 'REPLICATE' else block_path(name)
+        target_op = 'UPLOAD' if op == 'REPLICATE' else 'PUT_BLOCK'
+        host, port = target.rsplit(':', 1)
+        start_time = time.time()
+        trace = metrics.Trace(PHASE_SECONDS, op)
+        try:
+            stored_codec, file_size = compression.stored_info(file_path)
+            with open(file_path, 'rb') as f, wire.connect((host, int(port))) as target_conn:
+                trace.mark('connect')
+                log.debug('# datanode to datanode: send %s control message to %s', target_op, target)
+                self.send_control(target_conn, f'{target_op}${name}${file_size}$${target_token}')
+                msg = self.recv_control(target_conn)
+                if msg[0] != 'READY':
+                    raise ConnectionError(f'{target} not ready')
+                trace.mark('handshake')
+                for chunk in throttle(read_stored(f, stored_codec, 0, file_size), rate):
+                    target_conn.sendall(chunk)
+                trace.mark('transfer')
+                TRANSFER_BYTES.inc('out', amount=file_size)
+                msg = self.recv_control(target_conn)
+                trace.mark('ack')
+        except (OSError, ValueError) as e:
+            log.warning('Copy of %s to %s failed: %r', name, target, e)
+            self.send_control(conn, f'ERROR${e}')
+            return
+        end_time = time.time()
+        log.info('Copy of %s to %s completed in %.4f seconds', name, target, end_time - start_time)
+        self.send_control(conn, '$'.join(msg))
+
+    def send_image(self, conn: socket.socket, addr: tuple[str, int], file_name: str, offset: int = 0, length: int | None = None, codecs: str = ''):
+        self.send_file(conn, addr, f'datanode_dir/{file_name}', offset, length, codecs)
+
+    def send_file(self, conn: socket.socket, addr: tuple[str, int], file_path: str, offset: int = 0, length: int | None = None, codecs: str = '',
+                  command: str = 'DOWNLOAD'):
+        # com offset/length envia so o intervalo pedido; SIZE_BYTES e o tamanho do intervalo.
+        # Com CODECS a resposta e SIZE_BYTES$CODEC e, se CODEC nao e vazio, os bytes vao comprimidos em frames
+        file_name = os.path.basename(file_path)
+        stored_codec, stored_size = compression.stored_info(file_path)
+        file_size = clamp_range(stored_size, offset, length)
+        codec = compression.choose(codecs, file_name)
+
+        trace = metrics.Trace(PHASE_SECONDS, command)
+        log.debug('# datanode to main: send SIZE_BYTES to %s', addr)
+        self.send_control(conn, f'{file_size}${codec}' if codecs else f'{file_size}')
+
+        log.debug('# datanode from main: recv READY message from %s', addr)
+        self.recv_control(conn)
+        trace.mark('handshake')
+
         start_time = time.time()
         with open(file_path, 'rb') as f:
-            bytes_sent = 0
-            while bytes_sent < file_size:
-                chunk = f.read(min(MAX_CHUNK_SIZE_BYTES, file_size - bytes_sent))
-                conn.sendall(chunk)
-                bytes_sent += len(chunk)
-                print(f"Sent {bytes_sent}/{file_size} bytes of {file_name}")
+            if stored_codec is not None and stored_codec == codec and offset == 0 and file_size == stored_size:
+                # o arquivo ja esta gravado em frames do codec pedido: vai direto do disco
+                mode = f'stored {codec}'
+                header_size = compression.STORED_HEADER.size
+                self.send_file_zero_copy(conn, f, header_size, os.path.getsize(file_path) - header_size)
+            elif stored_codec is not None or codec:
+                mode = f'{stored_codec or "raw"} -> {codec or "raw"}'
+                out = compression.FrameWriter(conn.sendall, codec)
+                for chunk in read_stored(f, stored_codec, offset, file_size):
+                    out.write(chunk)
+                out.close()
+            elif self.use_sendfile:
+                mode = 'sendfile'
+                self.send_file_zero_copy(conn, f, offset, file_size)
+            else:
+                mode = 'buffered'
+                f.seek(offset)
+                self.send_file_buffered(conn, f, file_size)
         end_time = time.time()
-        print(f'Sending of {file_name} to {addr} completed in {end_time - start_time:.4f} seconds')
+        trace.mark('transfer')
+        TRANSFER_BYTES.inc('out', amount=file_size)
+        self.record_transfer(file_size, end_time - start_time)
+        log.debug('Sending of %s to %s (%s) completed in %.4f seconds', file_name, addr, mode, end_time - start_time)
+        trace.done(log, file_name)
+
+    async def send_file_async(self, conn: socket.socket, addr: tuple[str, int], file_path: str, offset: int = 0, length: int | None = None, codecs: str = '',
+                              command: str = 'DOWNLOAD'):
+        loop = asyncio.get_running_loop()
+        file_name = os.path.basename(file_path)
+        stored_codec, stored_size = compression.stored_info(file_path)
+        if stored_codec is not None or compression.choose(codecs, file_name):
+            # comprimir ou descomprimir gasta CPU: fica no caminho bloqueante, em uma thread do pool
+            conn.setblocking(True)
+            await loop.run_in_executor(None, self.send_file, conn, addr, file_path, offset, length, codecs, command)
+            return
+        file_size = clamp_range(stored_size, offset, length)
+
+        trace = metrics.Trace(PHASE_SECONDS, command)
+        log.debug('# datanode to main: send SIZE_BYTES to %s', addr)
+        await wire.send_control_async(loop, conn, f'{file_size}')
+
+        log.debug('# datanode from main: recv READY message from %s', addr)
+        await wire.recv_control_async(loop, conn)
+        trace.mark('handshake')
+
+        start_time = time.time()
+        with open(file_path, 'rb') as f:
+            if self.use_sendfile and file_size:
+                # sendfile nao bloqueante: o loop espera o socket esvaziar entre as chamadas
+                await loop.sock_sendfile(conn, f, offset, file_size)
+            else:
+                f.seek(offset)
+                for chunk in wire.read_chunks(f, file_size):
+                    await loop.sock_sendall(conn, chunk)
+        end_time = time.time()
+        trace.mark('transfer')
+        TRANSFER_BYTES.inc('out', amount=file_size)
+        self.record_transfer(file_size, end_time - start_time)
+        mode = 'sendfile' if self.use_sendfile else 'buffered'
+        log.debug('Sending of %s to %s (%s, async) completed in %.4f seconds', file_name, addr, mode, end_time - start_time)
+        trace.done(log, file_name)
+
+    def send_file_zero_copy(self, conn: socket.socket, f, offset: int, file_size: int):
+        # o kernel copia direto do page cache, nenhum chunk passa pelo python;
+        # sendfile recusa count 0 (arquivo vazio ou intervalo alem do fim)
+        if file_size:
+            conn.sendfile(f, offset, file_size)
+
+    def send_file_buffered(self, conn: socket.socket, f, file_size: int):
+        for chunk in wire.read_chunks(f, file_size):
+            conn.sendall(chunk)
 
     def delete_image(self, conn: socket.socket, addr: tuple[str, int], file_name: str):
         start_time = time.time()
-        os.remove(f'datanode_dir/{file_name}')
+        try:
+            os.remove(f'datanode_dir/{file_name}')
+        except FileNotFoundError:
+            log.debug('%s was already deleted', file_name)
+        tiles.discard(file_name)
         end_time = time.time()
-        print(f'Deletion of {file_name} requested by {addr} completed in {end_time - start_time:.4f} seconds')
-
-    def recvall(self, conn: socket.socket, msg_size: int) -> bytes:
-        bytes_recvd = 0
-        chunks = []
-        while bytes_recvd < msg_size:
-            chunk = conn.recv(msg_size)
-            chunks.append(chunk)
-            bytes_recvd += len(chunk)
-        return b''.join(chunks)
-
-def calculate_md5(file_path):
-    md5_hash = hashlib.md5()
-    with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest()
+        log.debug('# datanode to main: send DONE message to %s', addr)
+        self.send_control(conn, 'DONE')
+        log.debug('Deletion of %s requested by %s completed in %.4f seconds', file_name, addr, end_time - start_time)
+
+    def delete_block(self, conn: socket.socket, addr: tuple[str, int], block_hash: str):
+        try:
+            os.remove(block_path(block_hash))
+        except FileNotFoundError:
+            log.debug('Block %s was already deleted', block_hash)
+        log.debug('# datanode to main: send DONE message to %s', addr)
+        self.send_control(conn, 'DONE')
+
+    def stat_block(self, conn: socket.socket, block_hash: str):
+        # SIZE$N se o bloco esta aqui: o main confere as replicas que o cliente informa no COMMIT_BLOCKS
+        try:
+            block_size = os.path.getsize(block_path(block_hash))
+        except FileNotFoundError:
+            self.send_control(conn, 'ERROR$missing block')
+            return
+        self.send_control(conn, f'SIZE${block_size}')
+
+    def send_control(self, conn: socket.socket, msg: str):
+        # responde no formato (texto ou binario) em que o outro lado falou
+        wire.send_control(conn, msg)
+
+    def recv_control(self, conn: socket.socket) -> list[str]:
+        return wire.recv_control(conn)
+
+def temp_path() -> str:
+    # um temporario por thread em PARTIAL_DIR: dois uploads do mesmo arquivo nao escrevem no mesmo lugar
+    # e nenhum temporario divide o diretorio com as imagens; os.replace funciona (mesmo sistema de arquivos)
+    return f'{PARTIAL_DIR}/{threading.get_ident()}'
+
+def discard(file_path: str):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+def block_path(block_hash: str) -> str:
+    # blocos em datanode_dir/blocks/<2 primeiros hex>/<sha256>
+    if len(block_hash) != 64 or any(c not in '0123456789abcdef' for c in block_hash):
+        raise ValueError(f'invalid block hash {block_hash!r}')
+    directory = f'datanode_dir/blocks/{block_hash[:2]}'
+    os.makedirs(directory, exist_ok=True)
+    return f'{directory}/{block_hash}'
+
+def read_stored(f, stored_codec: str | None, offset: int, length: int):
+    # bytes originais [offset, offset + length) de um arquivo gravado comprimido ou nao
+    if stored_codec is not None:
+        f.seek(0)
+        _, _, stored_size = compression.STORED_HEADER.unpack(f.read(compression.STORED_HEADER.size))
+        return compression.skip(compression.read_frames(f, stored_codec, stored_size), offset, length)
+    f.seek(offset)
+    return wire.read_chunks(f, length)
+
+def throttle(chunks, rate: int):
+    # segura um fluxo em rate bytes/s (0 = sem limite): copias de fundo nao disputam banda com os clientes
+    start_time = time.monotonic()
+    sent = 0
+    for chunk in chunks:
+        yield chunk
+        sent += len(chunk)
+        ahead = sent / rate - (time.monotonic() - start_time) if rate else 0
+        if ahead > 0:
+            time.sleep(ahead)
+
+def parse_download(control_msg: list[str]) -> tuple[int, int | None, str]:
+    # DOWNLOAD$FILENAME$TOKEN, DOWNLOAD$FILENAME$CODECS$TOKEN ou DOWNLOAD$FILENAME$OFFSET$LENGTH$TOKEN
+    # (GET_BLOCK aceita as mesmas formas sem CODECS)
+    if len(control_msg) == 5:
+        return int(control_msg[2]), int(control_msg[3]), ''
+    if len(control_msg) == 4:
+        return 0, None, control_msg[2]
+    return 0, None, ''
+
+def clamp_range(file_size: int, offset: int, length: int | None) -> int:
+    remaining = max(0, file_size - offset)
+    return remaining if length is None else min(length, remaining)
+
+def raise_fd_limit(wanted: int):
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < wanted:
+            new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            log.info('Raised open file limit from %s to %s', soft, new_soft)
+    except (ImportError, ValueError, OSError) as e:
+        log.warning('Could not raise open file limit: %s', e)
 
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) != 3:
-        print("Usage: python datanode.py <host> <port>")
+    flags = sys.argv[3:]
+    if len(sys.argv) < 3 or any(flag not in ('--no-sendfile', '--async', '--compress') for flag in flags):
+        print("Usage: python datanode.py <host> <port> [--no-sendfile] [--async] [--compress]")
         sys.exit(1)
     host = sys.argv[1]
     port = int(sys.argv[2])
-    s = Datanode(host, port)
-    s.start()
+    use_sendfile = '--no-sendfile' not in flags
+    metrics.configure_logging()
+    require_secret()
+    s = Datanode(host, port, use_sendfile, '--compress' in flags)
+    metrics.serve(port)
+    if '--async' in flags:
+        s.start_async()
+    else:
+        s.start()
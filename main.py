@@ -2,235 +2,1543 @@
 import socket
 import os
 import threading
-import random
 import time
+import hashlib
+import asyncio
+import concurrent.futures
+import contextlib
+import urllib.parse
+import uuid
+import logging
+import fcntl
+import signal
+import wire
+import compression
+import metrics
+from metadata import MetadataStore, FileEntry
+from cache import ImageCache
+from placement import Placement
+from checksum import Crc32
+from tokens import TOKEN_TTL_SECONDS, make_token, check_token, require_secret
+
+log = logging.getLogger('main')
 
 MAIN_ADDR = ''
 MAIN_PORT = 5555
 
-CONTROL_MSG_SIZE_BYTES = 1024
-MAX_CHUNK_SIZE_BYTES = 1024 * 4
+# listagem paginada: tamanho maximo de pagina e quantas linhas vao por sendall
+MAX_LISTING_PAGE_SIZE = 10000
+LISTING_BATCH_LINES = 256
+
+# PUT_BLOCKS/COMMIT_BLOCKS: tamanho maximo da lista de blocos (~150 bytes por bloco de 64 MiB, ou seja, arquivos
+# de varios TiB); um tamanho maior e recusado antes de alocar qualquer coisa
+MAX_BLOCK_LIST_BYTES = 16 * 1024 * 1024
+
+# sessao BATCH: comandos aceitos em sequencia na mesma conexao
+BATCH_COMMANDS = ('UPLOAD', 'DOWNLOAD', 'DELETE', 'SESSION_OPEN', 'SESSION_APPEND', 'SESSION_STATUS', 'SESSION_COMMIT', 'TILE', 'THUMBNAIL')
+
+# metricas (metrics.py): pedidos por comando e fases das conversas com os datanodes, por datanode e comando
+# do datanode. Fases: connect (conexao do pool, reaproveitada ou nova), handshake (pedido ate a resposta),
+# first_byte (pronto ate o primeiro chunk), transfer (resto do corpo) e ack (ultimo chunk ate o DONE)
+COMMANDS = ('UPLOAD', 'LISTING', 'DOWNLOAD', 'DELETE', 'LOCATE_UPLOAD', 'COMMIT', 'LOCATE', 'PUT_BLOCKS', 'COMMIT_BLOCKS',
+            'SESSION_OPEN', 'SESSION_APPEND', 'SESSION_STATUS', 'SESSION_COMMIT', 'TILE', 'THUMBNAIL', 'BATCH', 'CACHE_STATS')
+REQUESTS = metrics.Requests('mygeoeye_main', COMMANDS)
+DATANODE_PHASE_SECONDS = metrics.Histogram('mygeoeye_main_datanode_phase_seconds', 'Phases of requests from main to datanodes',
+                                           ('datanode', 'command', 'phase'))
+DATANODE_BYTES = metrics.Counter('mygeoeye_main_datanode_bytes_total', 'Bytes sent to (out) and read from (in) datanodes',
+                                 ('datanode', 'direction'))
+DATANODE_FAILURES = metrics.Counter('mygeoeye_main_datanode_failures_total', 'Failed reads, uploads and heartbeats, by datanode', ('datanode',))
+POOL_CONNECTIONS = metrics.Counter('mygeoeye_main_pool_connections_total', 'Datanode connections reused from the pool or opened',
+                                   ('datanode', 'result'))
 
 REPLICATION_FACTOR = 2  # Pode ser alterado conforme necessário
 
+# blocos sem referencia so sao apagados dos datanodes depois de um prazo maior que a validade dos tokens,
+# para que um upload em andamento que conte com eles ainda consiga fazer o commit
+BLOCK_GC_GRACE_SECONDS = TOKEN_TTL_SECONDS + 60
+BLOCK_GC_INTERVAL_SECONDS = 30
+
+# heartbeats: o main consulta cada datanode e alimenta a escolha de replicas (placement.py)
+HEARTBEAT_INTERVAL_SECONDS = 2
+HEARTBEAT_TIMEOUT_SECONDS = 2
+
+# datanodes listados em workers.txt; datanodes novos no arquivo entram sem reiniciar o main
+WORKERS_FILE = 'main_dir/workers.txt'
+
+# UPLOAD pelo main: quantas cabecas de cadeia tentar enquanto nenhum byte do cliente foi consumido
+UPLOAD_CHAIN_HEAD_ATTEMPTS = 3
+
+# reparo: um datanode fora do ar (placement.py) sai das leituras e gravacoes na hora; se continua fora por
+# REPAIR_AFTER_SECONDS as replicas dele sao recriadas em outros datanodes, copiadas direto de uma replica viva
+# (arquivos que ficaram com menos replicas que o fator num upload tambem)
+REPAIR_AFTER_SECONDS = 30
+REPLICATION_INTERVAL_SECONDS = 10
+# taxa de cada copia de fundo (reparo ou rebalanceamento), uma copia por vez; 0 = sem limite
+REPLICATION_RATE_BYTES = 32 * 1024 * 1024
+
+# rebalanceamento (quando nao ha reparo pendente): move replicas do datanode com mais bytes para o com menos,
+# por exemplo um datanode novo, enquanto a diferenca passar de REBALANCE_MIN_GAP_BYTES
+REBALANCE_MIN_GAP_BYTES = 1024 * 1024 * 1024
+REBALANCE_MAX_BYTES_PER_ROUND = 1024 * 1024 * 1024
+# a copia antiga de uma replica movida so e apagada depois que os tokens de leitura ja entregues expiram
+MOVED_REPLICA_GRACE_SECONDS = TOKEN_TTL_SECONDS + 60
+
+# uploads retomaveis: os bytes ficam em UPLOAD_STAGING_DIR ate o commit; sessoes sem atividade
+# por mais que o TTL sao apagadas
+UPLOAD_STAGING_DIR = 'main_dir/staging'
+UPLOAD_SESSION_TTL_SECONDS = 24 * 3600
+UPLOAD_GC_INTERVAL_SECONDS = 300
+UPLOAD_COMMIT_ATTEMPTS = 3
+# SESSION_APPEND segura a sessao enquanto recebe: uma conexao meio aberta que fica esse tempo sem mandar
+# nada solta a sessao, e o cliente retoma sem receber ERROR$busy ate esgotar as tentativas
+UPLOAD_SESSION_RECV_TIMEOUT_SECONDS = 60
+
+# modo asyncio: limite de conexoes simultaneas e threads para comandos bloqueantes
+LISTEN_BACKLOG = 4096
+MAX_CONCURRENT_CONNECTIONS = 10000
+BLOCKING_WORKERS = 64
+
+# varios processos Main (--workers N) na mesma porta com SO_REUSEPORT; um worker que morre volta depois desse tempo
+WORKER_RESTART_DELAY_SECONDS = 1
+
+# pool de conexoes persistentes com os datanodes
+POOL_MAX_IDLE_PER_DATANODE = 16
+POOL_IDLE_TIMEOUT_SECONDS = 60
+POOL_HEALTHCHECK_AFTER_SECONDS = 5
+POOL_CONNECT_TIMEOUT_SECONDS = 5
+
 class Main:
-    def __init__(self, host: str, port: int, replication_factor: int) -> None:
+    def __init__(self, host: str, port: int, replication_factor: int, worker: int | None = None) -> None:
         self.listen_addr = (host, port)
-        self.workers = []
         self.replication_factor = replication_factor
-        self.lock = threading.Lock()
-        with open('main_dir/workers.txt', 'r') as f:
-            workers = f.readlines()
-            for line in workers:
-                line = line.split()
-                self.workers.append((line[0], int(line[1])))
+        # worker: indice deste processo com --workers (None com um processo so). O worker 0 e o lider: so ele
+        # grava snapshots e roda as tarefas de fundo (coleta de blocos e de uploads, reparo e rebalanceamento)
+        self.worker = worker
+        self.leader = worker in (None, 0)
+        self.cache = ImageCache()
+        self.metadata = MetadataStore('main_dir', shared=worker is not None, leader=self.leader, on_change=self.cache.invalidate)
+        self.pool = DatanodePool()
+        self.stale_replicas = []  # (prazo, tipo, nome, datanode): copias que sobraram de reparos, movimentos e DELETEs
+        os.makedirs(UPLOAD_STAGING_DIR, exist_ok=True)
+        self.workers = read_workers()
+        self.workers_mtime = os.path.getmtime(WORKERS_FILE)
         
-        print(f"Main server initialized with {len(self.workers)} workers and replication factor {self.replication_factor}")
+        self.placement = Placement(self.workers)
+        metrics.Gauge('mygeoeye_main_datanode_up', 'Datanodes in service (1) or down (0)',
+                      lambda: {(node_label(addr),): int(self.placement.alive(addr)) for addr in list(self.workers)}, ('datanode',))
+        metrics.Gauge('mygeoeye_main_cache', 'Image cache counters and sizes (CACHE_STATS)',
+                      lambda: {(key,): value for key, value in self.cache.stats().items()}, ('stat',))
+
+        log.info('Main server initialized with %s workers and replication factor %s', len(self.workers), self.replication_factor)
+        t = threading.Thread(target=self.heartbeat_loop, daemon=True)
+        t.start()
+        if self.leader:
+            t = threading.Thread(target=self.block_gc_loop, daemon=True)
+            t.start()
+            t = threading.Thread(target=self.upload_gc_loop, daemon=True)
+            t.start()
+            t = threading.Thread(target=self.replication_loop, daemon=True)
+            t.start()
+        else:
+            # copias de DELETEs atendidos por este worker com algum datanode fora do ar
+            t = threading.Thread(target=self.stale_replica_loop, daemon=True)
+            t.start()
+
+    def listen(self, backlog: int) -> socket.socket:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.worker is not None:
+            # todos os workers escutam na mesma porta e o kernel distribui as conexoes entre eles
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(self.listen_addr)
+        s.listen(backlog)
+        return s
 
     def start(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(self.listen_addr)
-            s.listen(400)
-            print(f'Server is listening on {self.listen_addr}')
+        with self.listen(400) as s:
+            log.info('Server is listening on %s', self.listen_addr)
             while True:
                 try:
                     conn, addr = s.accept()
-                    print(f"Connected with {addr}")
+                    wire.tune(conn)
+                    log.debug('Connected with %s', addr)
                     t = threading.Thread(target=self.process_connection, args=(conn, addr), daemon=True)
                     t.start()
                 except KeyboardInterrupt:
-                    print('\tauf wiedersehen...')
+                    log.info('auf wiedersehen...')
                     s.close()
                     quit()
 
+    def start_async(self):
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            log.info('auf wiedersehen...')
+
+    async def serve_async(self):
+        # um event loop atende todas as conexoes; comandos sem versao async vao para um pool limitado de threads
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=BLOCKING_WORKERS))
+        raise_fd_limit(MAX_CONCURRENT_CONNECTIONS + LISTEN_BACKLOG)
+        slots = asyncio.Semaphore(MAX_CONCURRENT_CONNECTIONS)
+        tasks = set()
+        with self.listen(LISTEN_BACKLOG) as s:
+            s.setblocking(False)
+            log.info('Server is listening on %s (asyncio, max %s connections)', self.listen_addr, MAX_CONCURRENT_CONNECTIONS)
+            while True:
+                # backpressure: com todos os slots ocupados paramos de aceitar e o backlog do kernel segura o resto
+                await slots.acquire()
+                conn, addr = await loop.sock_accept(s)
+                wire.tune(conn)
+                log.debug('Connected with %s', addr)
+                task = asyncio.create_task(self.process_connection_async(conn, addr))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+
+    async def process_connection_async(self, conn: socket.socket, addr: tuple[str, int]):
+        loop = asyncio.get_running_loop()
+        with conn:
+            try:
+                conn.setblocking(False)
+                log.debug('# main from client: recv control message from %s', addr)
+                control_msg = await wire.recv_control_async(loop, conn)
+                if control_msg[0] == 'DOWNLOAD':
+                    log.debug('%s requesting download of %s', addr, control_msg[1])
+                    with REQUESTS.measure('DOWNLOAD'):
+                        self.metadata.refresh()
+                        await self.download_from_datanodes_async(conn, addr, control_msg[1], control_msg[2] if len(control_msg) > 2 else '')
+                else:
+                    conn.setblocking(True)
+                    await loop.run_in_executor(None, self.handle, conn, addr, control_msg)
+            except Exception as e:
+                log.warning('Connection with %s failed: %r', addr, e)
+
     def process_connection(self, conn: socket.socket, addr: tuple[str, int]):
         with conn:
-            print(f"# main from client: recv control message from {addr}")
-            control_msg = self.recvall(conn, CONTROL_MSG_SIZE_BYTES)
-            control_msg = control_msg.decode()
-            control_msg = control_msg.strip().split('$')
-            if control_msg[0] == 'UPLOAD':
-                print(f'{addr} requesting upload of {control_msg[1]}')
-                file_name = control_msg[1]
-                file_size = int(control_msg[2])
-                self.upload_to_datanodes(conn, addr, file_name, file_size)
-            elif control_msg[0] == 'LISTING':
-                print(f'{addr} requesting listing')
-                self.list_images(conn, addr)
-            elif control_msg[0] == 'DOWNLOAD':
-                print(f'{addr} requesting download of {control_msg[1]}')
-                self.download_from_datanodes(conn, addr, control_msg[1])
-            elif control_msg[0] == 'DELETE':
-                print(f'{addr} requesting deletion of {control_msg[1]}')
-                self.delete_in_datanodes(control_msg[1])
-
-    def upload_to_datanodes(self, client_conn: socket.socket, client_addr: tuple[str, int], file_name: str, file_size: int):
-        selected_datanodes = random.sample(self.workers, min(self.replication_factor, len(self.workers)))
-        print(f"Selected datanodes for upload of {file_name}: {selected_datanodes}")
-        
+            log.debug('# main from client: recv control message from %s', addr)
+            try:
+                control_msg = self.recv_control(conn)
+            except OSError as e:
+                # conexao fechada antes do pedido (health checks, clientes que desistiram): nao e erro
+                log.debug('Connection with %s closed before a request: %r', addr, e)
+                return
+            self.handle(conn, addr, control_msg)
+
+    def handle(self, conn: socket.socket, addr: tuple[str, int], control_msg: list[str]):
+        with REQUESTS.measure(control_msg[0]):
+            # com --workers: o que os outros workers gravaram ate agora vale para este pedido
+            self.metadata.refresh()
+            self.dispatch(conn, addr, control_msg)
+
+    def dispatch(self, conn: socket.socket, addr: tuple[str, int], control_msg: list[str]):
+        if control_msg[0] == 'UPLOAD':
+            log.debug('%s requesting upload of %s', addr, control_msg[1])
+            file_name = control_msg[1]
+            file_size = int(control_msg[2])
+            codecs = control_msg[3] if len(control_msg) > 3 else ''
+            self.upload_to_datanodes(conn, addr, file_name, file_size, codecs)
+        elif control_msg[0] == 'LISTING' and len(control_msg) > 1:
+            log.debug('%s requesting listing page', addr)
+            self.list_images_page(conn, addr, control_msg[1], int(control_msg[2]), control_msg[3])
+        elif control_msg[0] == 'LISTING':
+            log.debug('%s requesting listing', addr)
+            self.list_images(conn, addr)
+        elif control_msg[0] == 'DOWNLOAD':
+            log.debug('%s requesting download of %s', addr, control_msg[1])
+            self.download_from_datanodes(conn, addr, control_msg[1], control_msg[2] if len(control_msg) > 2 else '')
+        elif control_msg[0] == 'DELETE':
+            log.debug('%s requesting deletion of %s', addr, control_msg[1])
+            self.delete_image(conn, addr, control_msg[1])
+        elif control_msg[0] == 'LOCATE_UPLOAD':
+            log.debug('%s requesting upload targets for %s', addr, control_msg[1])
+            self.locate_upload(conn, addr, control_msg[1], int(control_msg[2]))
+        elif control_msg[0] == 'COMMIT':
+            log.debug('%s committing %s', addr, control_msg[1])
+            checksum = control_msg[5] if len(control_msg) > 5 else None
+            self.commit_upload(conn, addr, control_msg[1], int(control_msg[2]), control_msg[3], control_msg[4], checksum)
+        elif control_msg[0] == 'LOCATE':
+            log.debug('%s requesting location of %s', addr, control_msg[1])
+            self.locate(conn, addr, control_msg[1])
+        elif control_msg[0] == 'PUT_BLOCKS':
+            log.debug('%s requesting block targets for %s', addr, control_msg[1])
+            self.put_blocks(conn, addr, control_msg[1], int(control_msg[2]), int(control_msg[3]))
+        elif control_msg[0] == 'COMMIT_BLOCKS':
+            log.debug('%s committing blocks of %s', addr, control_msg[1])
+            checksum = control_msg[4] if len(control_msg) > 4 else None
+            self.commit_blocks(conn, addr, control_msg[1], int(control_msg[2]), int(control_msg[3]), checksum)
+        elif control_msg[0] == 'SESSION_OPEN':
+            log.debug('%s opening upload session for %s', addr, control_msg[1])
+            self.open_upload(conn, addr, control_msg[1])
+        elif control_msg[0] == 'SESSION_APPEND':
+            log.debug('%s appending to upload %s', addr, control_msg[1])
+            self.append_upload(conn, addr, control_msg[1], int(control_msg[2]), int(control_msg[3]))
+        elif control_msg[0] == 'SESSION_STATUS':
+            self.upload_status(conn, addr, control_msg[1])
+        elif control_msg[0] == 'SESSION_COMMIT':
+            log.debug('%s committing upload %s', addr, control_msg[1])
+            self.commit_upload_session(conn, addr, control_msg[1], control_msg[2] or None)
+        elif control_msg[0] in ('TILE', 'THUMBNAIL'):
+            log.debug('%s requesting %s of %s', addr, control_msg[0].lower(), control_msg[1])
+            self.download_derived(conn, addr, control_msg)
+        elif control_msg[0] == 'BATCH':
+            log.debug('%s opening batch session', addr)
+            self.serve_batch(conn, addr)
+        elif control_msg[0] == 'CACHE_STATS':
+            log.debug('%s requesting cache stats', addr)
+            self.send_control(conn, 'CACHE_STATS$' + '$'.join(f'{k}={v}' for k, v in self.cache.stats().items()))
+
+    def serve_batch(self, conn: socket.socket, addr: tuple[str, int]):
+        # varios arquivos na mesma conexao, ate END ou o cliente fechar; todo pedido tem resposta
+        # e erros anteriores a transferencia viram ERROR$MSG sem derrubar a sessao
+        served = 0
+        while True:
+            try:
+                control_msg = self.recv_control(conn)
+            except ConnectionError:
+                break
+            if control_msg[0] == 'END':
+                break
+            served += 1
+            if control_msg[0] not in BATCH_COMMANDS:
+                self.send_control(conn, f'ERROR$unsupported in batch: {control_msg[0]}')
+                continue
+            try:
+                self.handle(conn, addr, control_msg)
+            except FileNotFoundError:
+                log.debug('%s requested by %s not found', control_msg[1], addr)
+                self.send_control(conn, 'ERROR$not found')
+        log.debug('Batch session with %s done (%s requests)', addr, served)
+
+    def upload_to_datanodes(self, client_conn: socket.socket, client_addr: tuple[str, int], file_name: str, file_size: int, codecs: str = ''):
         start_time = time.time()
-        #################################
+        # com CODECS o cliente manda o arquivo comprimido em frames (READY$CODEC); para os datanodes vai sem compressao
+        codec = compression.choose(codecs, file_name)
+        chunks = compression.recv_stream(client_conn, file_size, codec)
+
+        def ready():
+            log.debug('# main to client: send READY message to %s', client_addr)
+            self.send_control(client_conn, f'READY${codec}' if codec else 'READY')
+
+        # enquanto nenhum byte do cliente foi consumido da para trocar a cabeca da cadeia
+        failed = []
+        for attempt in range(UPLOAD_CHAIN_HEAD_ATTEMPTS):
+            result = self.push_to_datanodes(file_name, file_size, chunks, ready, exclude=failed)
+            if result is not None:
+                break
+        if result is None:
+            self.send_control(client_conn, 'ERROR$datanode not ready')
+            return
+        stored_datanodes, checksum = result
+        if not stored_datanodes:
+            self.send_control(client_conn, 'ERROR$replication failed')
+            return
+
+        self.save_metadata(file_name, file_size, stored_datanodes, checksum)
+        log.debug('# main to client: send DONE message to %s', client_addr)
+        self.send_control(client_conn, f'DONE${checksum}')
         
+        end_time = time.time()
+        log.debug('Upload of %s completed in %.4f seconds', file_name, end_time - start_time)
 
-        datanode_conn_list = []
-        for datanode_addr in selected_datanodes:
-            control_msg = f'UPLOAD${file_name}${file_size}'
-            control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-            control_msg = control_msg.encode()
-            #self.upload_to_datanode(client_conn, client_addr, datanode_addr, file_name, file_size)
-            datanode_conn_temp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            datanode_conn_temp.connect(datanode_addr)
-            print(f"# main to datanode: send UPLOAD control message to {datanode_addr}")
-            datanode_conn_temp.sendall(control_msg)
-
-            print(f"# main from datanode: recv READY message from {datanode_addr}")
-            control_msg = self.recvall(datanode_conn_temp, CONTROL_MSG_SIZE_BYTES)
-            msg = control_msg.decode()
-            msg = msg.strip().split('$')
-
-            if msg[0] != 'READY':
-                print(f"Datanode {datanode_addr} not ready")
-                datanode_conn_temp.close()
-                for datanode_conn in datanode_conn_list:
-                    datanode_conn.close()
+    def push_to_datanodes(self, file_name: str, file_size: int, chunks, ready=None,
+                          exclude: list[tuple[str, int]] | None = None) -> tuple[list[tuple[str, int]], str] | None:
+        # envia os chunks pela cadeia de replicacao; devolve as replicas gravadas (vazia se falhou) e o CRC32,
+        # ou None se o primeiro datanode nao ficou pronto (nesse caso nenhum chunk foi consumido).
+        # exclude: datanodes a evitar; o que falhou nesta tentativa entra na lista para a proxima
+        if exclude is None:
+            exclude = []
+        selected_datanodes = self.placement.choose_targets(self.replication_factor, file_size, exclude=exclude)
+        if not selected_datanodes:
+            log.warning('No datanode available for upload of %s', file_name)
+            return None
+        log.debug('Selected datanodes for upload of %s: %s', file_name, selected_datanodes)
+
+        # replicacao em cadeia: main so envia para o primeiro datanode,
+        # cada datanode repassa os chunks para o proximo da cadeia
+        token = make_token('UPLOAD', file_name)
+        head_addr = selected_datanodes[0]
+        chain = format_addrs(selected_datanodes[1:])
+        label = node_label(head_addr)
+        trace = metrics.Trace(DATANODE_PHASE_SECONDS, label, 'UPLOAD')
+        sending = False
+        try:
+            with self.pool.connection(head_addr) as datanode_conn:
+                trace.mark('connect')
+                log.debug('# main to datanode: send UPLOAD control message to %s', head_addr)
+                self.send_control(datanode_conn, f'UPLOAD${file_name}${file_size}${chain}${token}')
+
+                log.debug('# main from datanode: recv READY message from %s', head_addr)
+                msg = self.recv_control(datanode_conn)
+                trace.mark('handshake')
+                if msg[0] != 'READY':
+                    log.warning('Datanode %s not ready', head_addr)
+                    exclude.append(head_addr)
+                    return None
+                sending = True
+                if ready is not None:
+                    ready()
+
+                crc = Crc32()
+                for chunk in trace.first_byte(source_chunks(chunks)):
+                    datanode_conn.sendall(chunk)
+                    crc.update(chunk)
+                trace.mark('transfer')
+                DATANODE_BYTES.inc(label, 'out', amount=file_size)
+
+                log.debug('# main from datanode: recv DONE message from %s', head_addr)
+                msg = self.recv_control(datanode_conn)
+                trace.mark('ack')
+        except OSError as e:
+            # erros de leitura da origem viram ClientDisconnected (source_chunks): aqui so falhas do datanode
+            log.warning('Upload of %s to %s failed: %r', file_name, head_addr, e)
+            self.placement.failed(head_addr)
+            DATANODE_FAILURES.inc(label)
+            exclude.append(head_addr)
+            if not sending:
+                return None
+            # a cabeca descarta o que recebeu; o resto da cadeia pode ter gravado
+            self.discard_copies(file_name, selected_datanodes[1:])
+            return [], ''
+        trace.done(log, file_name)
+
+        # DONE$N$CHECKSUM: os N primeiros datanodes da cadeia gravaram o arquivo
+        stored = int(msg[1]) if msg[0] == 'DONE' else 0
+        checksum = crc.hexdigest()
+        leftover = selected_datanodes[stored:]
+        if stored and len(msg) > 2 and msg[2] != checksum:
+            log.warning('Datanode %s stored %s with checksum %s, expected %s', head_addr, file_name, msg[2], checksum)
+            leftover = selected_datanodes
+            stored = 0
+        if stored < len(selected_datanodes):
+            # o primeiro da cadeia que nao gravou fica de fora da proxima tentativa
+            exclude.append(selected_datanodes[stored])
+        if stored == 0:
+            log.warning('Pipeline failed to store %s', file_name)
+        elif stored < len(selected_datanodes):
+            log.warning('Only %s/%s replicas of %s were stored', stored, len(selected_datanodes), file_name)
+        if leftover:
+            self.discard_copies(file_name, leftover)
+        return selected_datanodes[:stored], checksum
+
+    def open_upload(self, conn: socket.socket, addr: tuple[str, int], file_name: str):
+        # upload retomavel: os bytes ficam em main_dir/staging ate o SESSION_COMMIT
+        upload_id = uuid.uuid4().hex
+        with open(staging_path(upload_id, 'name'), 'w') as f:
+            f.write(file_name)
+        open(staging_path(upload_id), 'wb').close()
+        log.debug('# main to client: send SESSION %s for %s to %s', upload_id, file_name, addr)
+        self.send_control(conn, f'SESSION${upload_id}')
+
+    def upload_state(self, upload_id: str) -> tuple[str, int, str | None] | None:
+        # (nome, bytes recebidos, checksum se o upload ja foi confirmado), ou None para sessao desconhecida
+        try:
+            with open(staging_path(upload_id, 'name'), 'r') as f:
+                fields = f.read().split('\n')
+            if len(fields) == 3:
+                return fields[0], int(fields[1]), fields[2]
+            return fields[0], os.path.getsize(staging_path(upload_id)), None
+        except (ValueError, FileNotFoundError):
+            return None
+
+    @contextlib.contextmanager
+    def claim_upload(self, upload_id: str):
+        # uma operacao por sessao de cada vez; um cliente que reconecta antes da conexao antiga
+        # ser derrubada recebe ERROR$busy e tenta de novo. O flock no arquivo de nome da sessao vale
+        # entre threads e entre workers
+        try:
+            f = open(staging_path(upload_id, 'name'), 'rb')
+        except FileNotFoundError:
+            f = None
+        if f is None:
+            yield True  # sessao desconhecida: upload_state responde
+            return
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
                 return
-            datanode_conn_list.append(datanode_conn_temp)
+            yield True
 
-        print(f"# main to client: send READY message to {client_addr}")
-        client_conn.sendall(control_msg)
+    def append_upload(self, conn: socket.socket, addr: tuple[str, int], upload_id: str, offset: int, size: int):
+        with self.claim_upload(upload_id) as claimed:
+            if not claimed:
+                self.send_control(conn, 'ERROR$busy')
+                return
+            state = self.upload_state(upload_id)
+            if state is None or state[2] is not None:
+                self.send_control(conn, 'ERROR$unknown upload')
+                return
+            if offset != state[1]:
+                self.send_control(conn, f'ERROR$offset mismatch${state[1]}')
+                return
+            log.debug('# main to client: send READY message to %s', addr)
+            self.send_control(conn, 'READY')
+            # se a conexao cair no meio, o que ja chegou fica gravado e o cliente continua dali
+            conn.settimeout(UPLOAD_SESSION_RECV_TIMEOUT_SECONDS)
+            try:
+                with open(staging_path(upload_id), 'ab') as f:
+                    for chunk in wire.recv_chunks(conn, size):
+                        f.write(chunk)
+            except TimeoutError:
+                # sem ACK: o cliente (se ainda existe) pergunta o offset com SESSION_STATUS e continua dali
+                log.warning('Upload %s from %s idle for %s seconds, releasing the session', upload_id, addr, UPLOAD_SESSION_RECV_TIMEOUT_SECONDS)
+                return
+            finally:
+                conn.settimeout(None)
+            log.debug('# main to client: send ACK message to %s', addr)
+            self.send_control(conn, f'ACK${offset + size}')
 
-        bytes_sent = 0
-        while bytes_sent < file_size:
-            chunk = self.recvall(client_conn, min(MAX_CHUNK_SIZE_BYTES, file_size - bytes_sent))
-            #datanode_conn.sendall(chunk)
-            for datanode_conn in datanode_conn_list:
-                datanode_conn.sendall(chunk)
-            bytes_sent += len(chunk)
-            #print(f"Sent {bytes_sent}/{file_size} bytes of {file_name} to {datanode_addr}")
+    def upload_status(self, conn: socket.socket, addr: tuple[str, int], upload_id: str):
+        state = self.upload_state(upload_id)
+        if state is None:
+            self.send_control(conn, 'ERROR$unknown upload')
+        elif state[2] is not None:
+            self.send_control(conn, f'COMMITTED${state[1]}${state[2]}')
+        else:
+            self.send_control(conn, f'OFFSET${state[1]}')
 
-        
+    def commit_upload_session(self, conn: socket.socket, addr: tuple[str, int], upload_id: str, checksum: str | None):
+        with self.claim_upload(upload_id) as claimed:
+            if not claimed:
+                self.send_control(conn, 'ERROR$busy')
+                return
+            state = self.upload_state(upload_id)
+            if state is None:
+                self.send_control(conn, 'ERROR$unknown upload')
+                return
+            file_name, file_size, committed = state
+            if committed is not None:
+                # commit repetido (o cliente nao viu o DONE): mesma resposta
+                self.send_control(conn, f'DONE${committed}')
+                return
 
-        #################################
-        with open(f'main_dir/{file_name}', 'w') as f, self.lock:
-            f.write(f"{file_size},{','.join([f'{addr[0]}:{addr[1]}' for addr in selected_datanodes])}")
-        
-        end_time = time.time()
-        print(f"Upload of {file_name} completed in {end_time - start_time:.4f} seconds")
+            # o arquivo inteiro esta no main: se a cadeia falha, tenta outros datanodes sem pedir nada ao cliente
+            stored_datanodes = []
+            failed = []
+            for attempt in range(UPLOAD_COMMIT_ATTEMPTS):
+                with open(staging_path(upload_id), 'rb') as f:
+                    result = self.push_to_datanodes(file_name, file_size, wire.read_chunks(f, file_size), exclude=failed)
+                if result is not None and result[0]:
+                    stored_datanodes, crc = result
+                    break
+                log.warning('Attempt %s/%s to replicate upload %s failed', attempt + 1, UPLOAD_COMMIT_ATTEMPTS, upload_id)
+            if not stored_datanodes:
+                self.send_control(conn, 'ERROR$replication failed')
+                return
+            if checksum and crc != checksum:
+                log.warning('Upload %s of %s has checksum %s, client sent %s', upload_id, file_name, crc, checksum)
+                for datanode_addr in stored_datanodes:
+                    self.delete_in_datanode(datanode_addr, file_name)
+                discard_upload(upload_id)
+                self.send_control(conn, 'ERROR$checksum mismatch')
+                return
 
-    def upload_to_datanode(self, client_conn: socket.socket, client_addr: tuple[str, int], datanode_addr: tuple[str, int], file_name: str, file_size: int):
-        control_msg = f'UPLOAD${file_name}${file_size}'
-        control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-        control_msg = control_msg.encode()
-        
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as datanode_conn:
-            print(f"# main to datanode: send UPLOAD control message to {datanode_addr}")
-            datanode_conn.connect(datanode_addr)
-            datanode_conn.sendall(control_msg)
-
-            print(f"# main from datanode: recv READY message from {datanode_addr}")
-            control_msg = self.recvall(datanode_conn, CONTROL_MSG_SIZE_BYTES)
-            msg = control_msg.decode()
-            msg = msg.strip().split('$')
-
-            if msg[0] != 'READY':
-                print(f"Datanode {datanode_addr} not ready")
+            self.save_metadata(file_name, file_size, stored_datanodes, crc)
+            # a sessao fica marcada como confirmada ate expirar, para um commit repetido nao falhar
+            with open(staging_path(upload_id, 'name'), 'w') as f:
+                f.write(f'{file_name}\n{file_size}\n{crc}')
+            os.remove(staging_path(upload_id))
+        log.debug('# main to client: send DONE message to %s', addr)
+        self.send_control(conn, f'DONE${crc}')
+        log.debug('Upload %s of %s committed (%s bytes)', upload_id, file_name, file_size)
+
+    def upload_gc_loop(self):
+        while True:
+            time.sleep(UPLOAD_GC_INTERVAL_SECONDS)
+            try:
+                self.expire_uploads()
+            except Exception as e:
+                log.warning('Upload session cleanup failed: %r', e)
+
+    def expire_uploads(self):
+        # ultima atividade de cada sessao: o mais recente entre os dados e o nome
+        last_active = {}
+        for entry in os.scandir(UPLOAD_STAGING_DIR):
+            upload_id = entry.name.partition('.')[0]
+            if not valid_upload_id(upload_id):
+                continue  # nao e de uma sessao (.DS_Store, arquivo de editor): fica como esta
+            try:
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue  # sessao confirmada ou apagada enquanto percorria
+            last_active[upload_id] = max(last_active.get(upload_id, 0), mtime)
+        expired = 0
+        for upload_id, mtime in last_active.items():
+            if time.time() - mtime < UPLOAD_SESSION_TTL_SECONDS:
+                continue
+            with self.claim_upload(upload_id) as claimed:
+                if claimed:
+                    discard_upload(upload_id)
+                    expired += 1
+        if expired:
+            log.info('Deleted %s expired upload sessions', expired)
+
+    def download_from_datanodes(self, client_conn: socket.socket, client_addr: tuple[str, int], file_name: str, codecs: str = ''):
+        # com CODECS o main comprime o que envia ao cliente (SIZE_BYTES$CHECKSUM$CODEC); datanodes e cache
+        # continuam com os bytes originais
+        codec = compression.choose(codecs, file_name)
+        entry = self.load_entry(file_name)
+        file_size, datanode_addrs = entry.size, entry.replicas
+        data = self.cache.get(file_name)
+        if data is not None:
+            self.send_cached_image(client_conn, client_addr, file_name, data, entry.checksum, codec)
+            return
+        version = self.cache.version(file_name)
+        if entry.blocks is not None:
+            data = self.download_blocks(client_conn, client_addr, file_name, entry, self.cache.cacheable(file_size), codec)
+            if data is not None:
+                self.cache.put(file_name, data, version)
+            return
+        datanode_addrs = self.placement.rank(datanode_addrs)
+
+        log.debug('Selected datanode for download of %s: %s', file_name, datanode_addrs[0])
+        data = self.download_from_datanode(client_conn, client_addr, datanode_addrs, file_name, file_size,
+                                           self.cache.cacheable(file_size), entry.checksum, codec)
+        if data is not None:
+            self.cache.put(file_name, data, version)
+
+    def send_cached_image(self, client_conn: socket.socket, client_addr: tuple[str, int], file_name: str, data: bytes, checksum: str | None, codec: str = ''):
+        log.debug('# main to client: send SIZE_BYTES of cached %s to %s', file_name, client_addr)
+        self.send_control(client_conn, size_msg(len(data), checksum, codec))
+        log.debug('# main from client: recv READY message from %s', client_addr)
+        self.recv_control(client_conn)
+        out = compression.FrameWriter(client_conn.sendall, codec)
+        out.write(data)
+        out.close()
+
+    def download_from_datanode(self, client_conn: socket.socket, client_addr: tuple[str, int], datanode_addrs: list[tuple[str, int]], file_name: str, file_size: int,
+                               keep: bool = False, checksum: str | None = None, codec: str = '') -> bytes | None:
+        # datanode_addrs em ordem de preferencia; com keep=True os chunks repassados tambem sao guardados para o cache
+        log.debug('# main to client: send SIZE_BYTES to %s', client_addr)
+        self.send_control(client_conn, size_msg(file_size, checksum, codec))
+        log.debug('# main from client: recv READY message from %s', client_addr)
+        self.recv_control(client_conn)
+
+        out = compression.FrameWriter(client_conn.sendall, codec)
+        chunks = [] if keep else None
+        self.relay_from_replicas(out, datanode_addrs, 'DOWNLOAD', file_name, file_size, chunks)
+        out.close()
+        return b''.join(chunks) if keep else None
+
+    def relay_from_replicas(self, out, datanode_addrs: list[tuple[str, int]], op: str, name: str, size: int, chunks: list | None = None):
+        # repassa os size bytes de name (DOWNLOAD de um arquivo ou GET_BLOCK) para out, lendo da primeira replica
+        # que responder; se ela cai no meio, o resto vem da proxima pedindo so o intervalo que falta
+        sent = 0
+        for datanode_addr in datanode_addrs:
+            label = node_label(datanode_addr)
+            trace = metrics.Trace(DATANODE_PHASE_SECONDS, label, op)
+            start = sent
+            try:
+                with self.pool.connection(datanode_addr) as datanode_conn:
+                    trace.mark('connect')
+                    log.debug('# main to datanode: send %s control message to %s', op, datanode_addr)
+                    self.send_control(datanode_conn, read_request(op, name, sent, size))
+                    log.debug('# main from datanode: recv SIZE_BYTES from %s', datanode_addr)
+                    if int(self.recv_control(datanode_conn)[0]) != size - sent:
+                        raise ValueError(f'replica does not have the {size} bytes in metadata')
+                    trace.mark('handshake')
+                    log.debug('# main to datanode: send READY message to %s', datanode_addr)
+                    self.send_control(datanode_conn, 'READY')
+                    for chunk in trace.first_byte(wire.recv_chunks(datanode_conn, size - sent)):
+                        try:
+                            out.write(chunk)
+                        except OSError as e:
+                            raise ClientDisconnected(e) from e
+                        sent += len(chunk)
+                        if chunks is not None:
+                            chunks.append(bytes(chunk))
+                    trace.mark('transfer')
+                trace.done(log, name)
+                return
+            except (OSError, ValueError) as e:
+                log.warning('Read of %s from %s failed after %s bytes: %r', name, datanode_addr, sent, e)
+                self.placement.failed(datanode_addr)
+                DATANODE_FAILURES.inc(label)
+            finally:
+                DATANODE_BYTES.inc(label, 'in', amount=sent - start)
+        raise ConnectionError(f'no replica of {name} could be read')
+
+    def download_blocks(self, client_conn: socket.socket, client_addr: tuple[str, int], file_name: str, entry: FileEntry, keep: bool = False, codec: str = '') -> bytes | None:
+        # arquivo em blocos: o main busca cada bloco em uma replica e repassa tudo como um fluxo so
+        blocks = [(block_hash, self.metadata.get_block(block_hash)) for block_hash in entry.blocks]
+        # confere antes de responder: depois de SIZE_BYTES o cliente so espera os bytes
+        for block_hash, block in blocks:
+            if block is None:
+                raise FileNotFoundError(f'block {block_hash} of {file_name}')
+        log.debug('# main to client: send SIZE_BYTES of %s (%s blocks) to %s', file_name, len(blocks), client_addr)
+        self.send_control(client_conn, size_msg(entry.size, entry.checksum, codec))
+        log.debug('# main from client: recv READY message from %s', client_addr)
+        self.recv_control(client_conn)
+
+        out = compression.FrameWriter(client_conn.sendall, codec)
+        chunks = [] if keep else None
+        for block_hash, block in blocks:
+            self.relay_from_replicas(out, self.placement.rank(block.replicas), 'GET_BLOCK', block_hash, block.size, chunks)
+        out.close()
+        return b''.join(chunks) if keep else None
+
+    def download_derived(self, client_conn: socket.socket, client_addr: tuple[str, int], control_msg: list[str]):
+        # TILE/THUMBNAIL: a replica escolhida gera (ou ja tem guardado) o recorte e o main so repassa os bytes;
+        # erros do datanode (ERROR$MSG) vao para o cliente como vieram
+        file_name = control_msg[1]
+        entry = self.metadata.get(file_name)
+        if entry is None:
+            self.send_control(client_conn, 'ERROR$not found')
+            return
+        if entry.blocks is not None:
+            self.send_control(client_conn, 'ERROR$tiles unavailable for files stored in blocks')
+            return
+        # passa para a proxima replica enquanto nada foi respondido ao cliente
+        for datanode_addr in self.placement.rank(entry.replicas):
+            label = node_label(datanode_addr)
+            trace = metrics.Trace(DATANODE_PHASE_SECONDS, label, control_msg[0])
+            answered = False
+            try:
+                with self.pool.connection(datanode_addr) as datanode_conn:
+                    trace.mark('connect')
+                    log.debug('# main to datanode: send %s control message to %s', control_msg[0], datanode_addr)
+                    self.send_control(datanode_conn, '$'.join(control_msg + [make_token('DOWNLOAD', file_name)]))
+                    log.debug('# main from datanode: recv SIZE_BYTES from %s', datanode_addr)
+                    reply = self.recv_control(datanode_conn)
+                    # inclui a geracao do tile quando ele ainda nao estava guardado
+                    trace.mark('handshake')
+                    answered = True
+                    log.debug('# main to client: send SIZE_BYTES to %s', client_addr)
+                    self.send_control(client_conn, '$'.join(reply))
+                    if reply[0] == 'ERROR':
+                        return
+                    log.debug('# main from client: recv READY message from %s', client_addr)
+                    self.recv_control(client_conn)
+                    trace.skip()
+                    self.send_control(datanode_conn, 'READY')
+                    for chunk in trace.first_byte(wire.recv_chunks(datanode_conn, int(reply[0]))):
+                        client_conn.sendall(chunk)
+                    trace.mark('transfer')
+                    DATANODE_BYTES.inc(label, 'in', amount=int(reply[0]))
+                trace.done(log, file_name)
                 return
-            
-            print(f"# main to client: send READY message to {client_addr}")
-            client_conn.sendall(control_msg)
-            
-            bytes_sent = 0
-            while bytes_sent < file_size:
-                chunk = self.recvall(client_conn, min(MAX_CHUNK_SIZE_BYTES, file_size - bytes_sent))
-                datanode_conn.sendall(chunk)
-                bytes_sent += len(chunk)
-                #print(f"Sent {bytes_sent}/{file_size} bytes of {file_name} to {datanode_addr}")
-
-    def download_from_datanodes(self, client_conn: socket.socket, client_addr: tuple[str, int], file_name: str):
-        with open(f'main_dir/{file_name}', 'r') as f:
-            file_info = f.read().split(',')
-            file_size = int(file_info[0])
-            datanode_addrs = [addr.split(':') for addr in file_info[1:]]
-            datanode_addr = random.choice(datanode_addrs)
-            datanode_addr = (datanode_addr[0], int(datanode_addr[1]))
-
-        print(f"Selected datanode for download of {file_name}: {datanode_addr}")
-        self.download_from_datanode(client_conn, client_addr, datanode_addr, file_name, file_size)
-
-    def download_from_datanode(self, client_conn: socket.socket, client_addr: tuple[str, int], datanode_addr: tuple[str, int], file_name: str, file_size: int):
-        control_msg = f'DOWNLOAD${file_name}'
-        control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-        control_msg = control_msg.encode()
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as datanode_conn:
-            print(f"# main to datanode: send DOWNLOAD control message to {datanode_addr}")
-            datanode_conn.connect(datanode_addr)
-            datanode_conn.sendall(control_msg)
-
-            print(f"# main from datanode: recv SIZE_BYTES from {datanode_addr}")
-            control_msg = self.recvall(datanode_conn, CONTROL_MSG_SIZE_BYTES)
-            print(f"# main to client: send SIZE_BYTES to {client_addr}")
-            client_conn.sendall(control_msg)
-
-            print(f"# main from client: recv READY message from {client_addr}")
-            control_msg = self.recvall(client_conn, CONTROL_MSG_SIZE_BYTES)
-            print(f"# main to datanode: send READY message to {datanode_addr}")
-            datanode_conn.sendall(control_msg)
-
-            bytes_sent = 0
-            while bytes_sent < file_size:
-                chunk = self.recvall(datanode_conn, min(MAX_CHUNK_SIZE_BYTES, file_size - bytes_sent))
-                client_conn.sendall(chunk)
-                bytes_sent += len(chunk)
-                #print(f"Sent {bytes_sent}/{file_size} bytes of {file_name} to {client_addr}")
+            except OSError as e:
+                if answered:
+                    raise
+                log.warning('%s of %s from %s failed: %r', control_msg[0], file_name, datanode_addr, e)
+                self.placement.failed(datanode_addr)
+                DATANODE_FAILURES.inc(label)
+        self.send_control(client_conn, 'ERROR$no replica available')
+
+    async def download_from_datanodes_async(self, client_conn: socket.socket, client_addr: tuple[str, int], file_name: str, codecs: str = ''):
+        loop = asyncio.get_running_loop()
+        if compression.choose(codecs, file_name):
+            # comprimir gasta CPU: fica no caminho bloqueante, em uma thread do pool
+            client_conn.setblocking(True)
+            await loop.run_in_executor(None, self.download_from_datanodes, client_conn, client_addr, file_name, codecs)
+            return
+        entry = self.load_entry(file_name)
+        file_size, datanode_addrs = entry.size, entry.replicas
+        data = self.cache.get(file_name)
+        if data is not None:
+            log.debug('# main to client: send SIZE_BYTES of cached %s to %s', file_name, client_addr)
+            await wire.send_control_async(loop, client_conn, size_msg(len(data), entry.checksum))
+            log.debug('# main from client: recv READY message from %s', client_addr)
+            await wire.recv_control_async(loop, client_conn)
+            await loop.sock_sendall(client_conn, data)
+            return
+        if entry.blocks is not None:
+            # arquivos em blocos usam o caminho bloqueante, em uma thread do pool
+            client_conn.setblocking(True)
+            await loop.run_in_executor(None, self.download_from_datanodes, client_conn, client_addr, file_name)
+            return
+        version = self.cache.version(file_name)
+        keep = self.cache.cacheable(file_size)
+        datanode_addrs = self.placement.rank(datanode_addrs)
+        log.debug('Selected datanode for download of %s: %s', file_name, datanode_addrs[0])
+
+        log.debug('# main to client: send SIZE_BYTES to %s', client_addr)
+        await wire.send_control_async(loop, client_conn, size_msg(file_size, entry.checksum))
+        log.debug('# main from client: recv READY message from %s', client_addr)
+        await wire.recv_control_async(loop, client_conn)
+        chunks = [] if keep else None
+        await self.relay_from_replicas_async(loop, client_conn, datanode_addrs, file_name, file_size, chunks)
+        if keep:
+            self.cache.put(file_name, b''.join(chunks), version)
+
+    async def relay_from_replicas_async(self, loop, client_conn: socket.socket, datanode_addrs: list[tuple[str, int]], file_name: str, size: int, chunks: list | None = None):
+        # mesmo failover de relay_from_replicas, sem bloquear o loop
+        sent = 0
+        for datanode_addr in datanode_addrs:
+            label = node_label(datanode_addr)
+            trace = metrics.Trace(DATANODE_PHASE_SECONDS, label, 'DOWNLOAD')
+            start = sent
+            # reaproveita uma conexao ociosa do pool; conexoes novas sao abertas sem bloquear o loop
+            datanode_conn = self.pool.acquire_idle(datanode_addr)
+            try:
+                if datanode_conn is None:
+                    POOL_CONNECTIONS.inc(label, 'new')
+                    datanode_conn = wire.prepare(socket.socket(socket.AF_INET, socket.SOCK_STREAM))
+                    datanode_conn.setblocking(False)
+                    await asyncio.wait_for(loop.sock_connect(datanode_conn, datanode_addr), POOL_CONNECT_TIMEOUT_SECONDS)
+                trace.mark('connect')
+                datanode_conn.setblocking(False)
+                log.debug('# main to datanode: send DOWNLOAD control message to %s', datanode_addr)
+                await wire.send_control_async(loop, datanode_conn, read_request('DOWNLOAD', file_name, sent, size))
+
+                log.debug('# main from datanode: recv SIZE_BYTES from %s', datanode_addr)
+                control_msg = await wire.recv_control_async(loop, datanode_conn)
+                if int(control_msg[0]) != size - sent:
+                    raise ValueError(f'replica does not have the {size} bytes in metadata')
+                trace.mark('handshake')
+                log.debug('# main to datanode: send READY message to %s', datanode_addr)
+                await wire.send_control_async(loop, datanode_conn, 'READY')
+
+                # sock_sendall so retorna quando o cliente consome os bytes, entao um cliente lento freia o datanode
+                async for chunk in trace.first_byte_async(wire.recv_chunks_async(loop, datanode_conn, size - sent)):
+                    try:
+                        await loop.sock_sendall(client_conn, chunk)
+                    except OSError as e:
+                        raise ClientDisconnected(e) from e
+                    sent += len(chunk)
+                    if chunks is not None:
+                        chunks.append(bytes(chunk))
+                trace.mark('transfer')
+            except BaseException as e:
+                if datanode_conn is not None:
+                    datanode_conn.close()
+                DATANODE_BYTES.inc(label, 'in', amount=sent - start)
+                if not isinstance(e, (OSError, ValueError)):
+                    raise
+                log.warning('Read of %s from %s failed after %s bytes: %r', file_name, datanode_addr, sent, e)
+                self.placement.failed(datanode_addr)
+                DATANODE_FAILURES.inc(label)
+                continue
+            DATANODE_BYTES.inc(label, 'in', amount=sent - start)
+            trace.done(log, file_name)
+            datanode_conn.setblocking(True)
+            self.pool.release(datanode_addr, datanode_conn)
+            return
+        raise ConnectionError(f'no replica of {file_name} could be read')
+
+    def delete_image(self, conn: socket.socket, addr: tuple[str, int], file_name: str):
+        # DONE depois de apagado dos metadados, mesmo com algum datanode fora do ar; ERROR$not found
+        try:
+            self.delete_in_datanodes(file_name)
+        except FileNotFoundError:
+            log.debug('%s requested by %s not found', file_name, addr)
+            self.send_control(conn, 'ERROR$not found')
+            return
+        log.debug('# main to client: send DONE message to %s', addr)
+        self.send_control(conn, 'DONE')
 
     def delete_in_datanodes(self, file_name: str):
-        with open(f'main_dir/{file_name}', 'r') as f:
-            file_info = f.read().split(',')
-            datanode_addrs = [addr.split(':') for addr in file_info[1:]]
+        entry = self.load_entry(file_name)
+        datanode_addrs = entry.replicas
+        if entry.blocks is not None:
+            # blocos podem ser compartilhados: so os que ficam sem referencia vao para a coleta
+            self.metadata.delete(file_name)
+            self.cache.invalidate(file_name)
+            log.debug('Deleted %s from main server', file_name)
+            return
 
-        print(f"Deleting {file_name} from datanodes: {datanode_addrs}")
+        log.debug('Deleting %s from datanodes: %s', file_name, datanode_addrs)
+        unreachable = []
         for datanode_addr in datanode_addrs:
-            datanode_addr = (datanode_addr[0], int(datanode_addr[1]))
-            self.delete_in_datanode(datanode_addr, file_name)
+            if not self.placement.alive(datanode_addr):
+                unreachable.append(datanode_addr)
+                continue
+            try:
+                self.delete_in_datanode(datanode_addr, file_name)
+            except OSError as e:
+                log.warning('Could not delete %s from %s, will retry when it is back: %r', file_name, datanode_addr, e)
+                unreachable.append(datanode_addr)
 
-        os.remove(f'main_dir/{file_name}')
-        print(f"Deleted {file_name} from main server")
+        self.metadata.delete(file_name)
+        self.cache.invalidate(file_name)
+        # fora dos metadados a copia e como as que sobram de um reparo: delete_stale_replicas apaga quando o datanode voltar
+        for datanode_addr in unreachable:
+            self.stale_replicas.append((time.time(), 'file', file_name, datanode_addr))
+        log.debug('Deleted %s from main server', file_name)
+
+    def discard_copies(self, file_name: str, datanode_addrs: list[tuple[str, int]]):
+        # copias que nenhum commit vai referenciar (cadeia curta, checksum errado). Apagadas antes de uma nova
+        # tentativa, que pode escolher o mesmo datanode; os que tem a versao anterior do arquivo ficam como estao
+        entry = self.metadata.get(file_name)
+        for datanode_addr in datanode_addrs:
+            if entry is not None and datanode_addr in entry.replicas or not self.placement.alive(datanode_addr):
+                continue
+            try:
+                self.delete_in_datanode(datanode_addr, file_name)
+            except OSError as e:
+                log.warning('Could not delete leftover copy of %s from %s: %s', file_name, datanode_addr, e)
 
     def delete_in_datanode(self, datanode_addr: tuple[str, int], file_name: str):
-        control_msg = f'DELETE${file_name}'
-        control_msg = control_msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ')
-        control_msg = control_msg.encode()
+        trace = metrics.Trace(DATANODE_PHASE_SECONDS, node_label(datanode_addr), 'DELETE')
+        with self.pool.connection(datanode_addr) as datanode_conn:
+            trace.mark('connect')
+            log.debug('# main to datanode: send DELETE control message to %s', datanode_addr)
+            self.send_control(datanode_conn, f'DELETE${file_name}${make_token("DELETE", file_name)}')
+            log.debug('# main from datanode: recv DONE message from %s', datanode_addr)
+            self.recv_control(datanode_conn)
+            trace.mark('ack')
+
+    def delete_block_in_datanode(self, datanode_addr: tuple[str, int], block_hash: str):
+        with self.pool.connection(datanode_addr) as datanode_conn:
+            log.debug('# main to datanode: send DELETE_BLOCK control message to %s', datanode_addr)
+            self.send_control(datanode_conn, f'DELETE_BLOCK${block_hash}${make_token("DELETE_BLOCK", block_hash)}')
+            log.debug('# main from datanode: recv DONE message from %s', datanode_addr)
+            self.recv_control(datanode_conn)
+
+    def put_blocks(self, conn: socket.socket, addr: tuple[str, int], file_name: str, file_size: int, body_size: int):
+        # upload em blocos: o cliente manda o sha256 de cada bloco e so envia os que o sistema ainda nao guarda
+        lines = self.recv_block_list(conn, addr, file_name, body_size)
+        if lines is None:
+            return
+        answer = []
+        pending = []
+        seen = set()
+        for line in lines:
+            block_hash, block_size = line.split()
+            if block_hash in seen or self.block_exists(block_hash):
+                answer.append(f'{block_hash} - -\n')
+            else:
+                # um bloco sendo coletado vai para outros datanodes: a coleta pode apagar as copias antigas a qualquer momento
+                selected_datanodes = self.placement.choose_targets(self.replication_factor, int(block_size),
+                                                                   exclude=self.metadata.collecting_replicas(block_hash))
+                answer.append(f'{block_hash} {make_token("PUT_BLOCK", block_hash)} {format_addrs(selected_datanodes)}\n')
+                pending.append((block_hash, int(block_size), selected_datanodes))
+            seen.add(block_hash)
+        # gravados antes da resposta: o que o commit nao confirmar (cliente caiu, cadeia curta) a coleta apaga
+        if pending:
+            self.metadata.add_pending(pending)
+        answer = ''.join(answer).encode()
+        log.debug('# main to client: send BLOCK_TARGETS for %s blocks of %s to %s', len(lines), file_name, addr)
+        self.send_control(conn, f'BLOCK_TARGETS${len(answer)}')
+        conn.sendall(answer)
+
+    def commit_blocks(self, conn: socket.socket, addr: tuple[str, int], file_name: str, file_size: int, body_size: int, checksum: str | None = None):
+        # uma linha por bloco: HASH SIZE TOKEN DATANODES, ou HASH SIZE - - para blocos que ja existiam
+        lines = self.recv_block_list(conn, addr, file_name, body_size)
+        if lines is None:
+            return
+        try:
+            blocks, reused = self.resolve_blocks(lines)
+            if sum(block_size for _, block_size, _ in blocks) != file_size:
+                raise ValueError('size mismatch')
+            # os blocos que ja existiam tem que continuar la no commit: a coleta pode ter apagado algum nesse meio tempo
+            if self.metadata.put(file_name, file_size, [], checksum, blocks,
+                                 check=lambda: all(self.metadata.known_block(block_hash) for block_hash in reused)) is None:
+                raise ValueError('missing block')
+        except ValueError as e:
+            log.warning('Rejected commit of %s from %s: %s', file_name, addr, e)
+            self.send_control(conn, f'ERROR${e}')
+            return
+        self.cache.invalidate(file_name)
+        log.debug('# main to client: send DONE message to %s', addr)
+        self.send_control(conn, 'DONE')
+        log.debug('Committed %s with %s blocks', file_name, len(blocks))
+
+    def recv_block_list(self, conn: socket.socket, addr: tuple[str, int], file_name: str, body_size: int) -> list[str] | None:
+        if not 0 <= body_size <= MAX_BLOCK_LIST_BYTES:
+            log.warning('Rejected block list of %s bytes for %s from %s', body_size, file_name, addr)
+            self.send_control(conn, 'ERROR$block list too large')
+            return None
+        return self.recvall(conn, body_size).decode().splitlines()
+
+    def resolve_blocks(self, lines: list[str]) -> tuple[list[tuple[str, int, list[tuple[str, int]]]], set[str]]:
+        # devolve os blocos do commit e os hashes dos que ja estavam guardados
+        blocks = []
+        resolved = {}
+        reused = set()
+        for line in lines:
+            block_hash, block_size, token, datanodes = line.split()
+            if token != '-':
+                replicas = parse_addrs(datanodes)
+                if not check_token(token, 'PUT_BLOCK', block_hash) or not all(a in self.workers for a in replicas):
+                    raise ValueError('invalid token')
+                # as replicas vem do cliente: so entram as que de fato guardam o bloco
+                replicas = resolved.get(block_hash) or [a for a in replicas if self.block_stored_in(a, block_hash, int(block_size))]
+                if not replicas:
+                    raise ValueError(f'missing block {block_hash}')
+            else:
+                replicas = resolved.get(block_hash) or self.known_block_replicas(block_hash)
+                if replicas is None:
+                    raise ValueError(f'missing block {block_hash}')
+                reused.add(block_hash)
+            resolved[block_hash] = replicas
+            blocks.append((block_hash, int(block_size), replicas))
+        return blocks, reused
+
+    def block_stored_in(self, datanode_addr: tuple[str, int], block_hash: str, block_size: int) -> bool:
+        try:
+            with self.pool.connection(datanode_addr) as datanode_conn:
+                log.debug('# main to datanode: send STAT_BLOCK control message to %s', datanode_addr)
+                self.send_control(datanode_conn, f'STAT_BLOCK${block_hash}${make_token("STAT_BLOCK", block_hash)}')
+                answer = self.recv_control(datanode_conn)
+        except OSError as e:
+            log.warning('Could not check block %s on %s: %s', block_hash, datanode_addr, e)
+            return False
+        if answer[0] != 'SIZE' or int(answer[1]) != block_size:
+            log.warning('%s does not hold block %s reported by the client', datanode_addr, block_hash)
+            return False
+        return True
+
+    def block_exists(self, block_hash: str) -> bool:
+        if self.metadata.get_block(block_hash) is not None:
+            return True
+        if self.metadata.known_block(block_hash) is None:
+            return False
+        # bloco esperando coleta volta a ser util: adia a remocao para o cliente ter tempo de fazer o commit
+        return self.metadata.keep_orphan(block_hash)
+
+    def known_block_replicas(self, block_hash: str) -> list[tuple[str, int]] | None:
+        block = self.metadata.known_block(block_hash)
+        return block.replicas if block is not None else None
+
+    def block_gc_loop(self):
+        while True:
+            time.sleep(BLOCK_GC_INTERVAL_SECONDS)
+            # apaga sem segurar os metadados: um datanode lento ou fora do ar nao trava as gravacoes dos workers
+            collecting = self.metadata.start_collect(BLOCK_GC_GRACE_SECONDS)
+            deleted = [block_hash for block_hash, block in collecting if self.delete_orphan_block(block_hash, block)]
+            if deleted:
+                self.metadata.drop_collected(deleted)
+                log.info('Deleted %s unreferenced blocks from datanodes', len(deleted))
+
+    def delete_orphan_block(self, block_hash: str, block) -> bool:
+        # True se todas as copias sairam; datanodes fora do ar ficam para a proxima coleta
+        done = True
+        for datanode_addr in block.replicas:
+            current = self.metadata.get_block(block_hash)
+            if current is not None and datanode_addr in current.replicas:
+                continue  # o bloco foi reenviado e voltou para esse datanode (reparo, rebalanceamento)
+            if datanode_addr not in self.workers:
+                continue  # saiu de workers.txt: nao tem mais de quem apagar
+            if not self.placement.alive(datanode_addr):
+                done = False
+                continue
+            try:
+                self.delete_block_in_datanode(datanode_addr, block_hash)
+            except OSError as e:
+                log.warning('Could not delete block %s from %s: %s', block_hash, datanode_addr, e)
+                done = False
+        return done
+
+    def heartbeat_loop(self):
+        while True:
+            self.reload_workers()
+            for datanode_addr in list(self.workers):
+                try:
+                    free_bytes, inflight, rate = self.heartbeat(datanode_addr)
+                except (OSError, ValueError) as e:
+                    log.warning('Heartbeat from %s failed: %s', datanode_addr, e)
+                    self.placement.failed(datanode_addr)
+                    DATANODE_FAILURES.inc(node_label(datanode_addr))
+                    continue
+                self.placement.update(datanode_addr, free_bytes, inflight, rate)
+            time.sleep(HEARTBEAT_INTERVAL_SECONDS)
+
+    def reload_workers(self):
+        # datanodes novos entram na escolha de destinos; os que sairam de workers.txt deixam de receber
+        # replicas e o que estava neles e recriado em outros pelo reparo (nada e apagado neles)
+        try:
+            mtime = os.path.getmtime(WORKERS_FILE)
+            if mtime == self.workers_mtime:
+                return
+            workers = read_workers()
+        except (OSError, ValueError, IndexError) as e:
+            log.warning('Could not reload %s: %r', WORKERS_FILE, e)
+            return
+        self.workers_mtime = mtime
+        for datanode_addr in workers:
+            if datanode_addr not in self.workers:
+                log.info('New datanode %s in %s', datanode_addr, WORKERS_FILE)
+                self.workers.append(datanode_addr)
+                self.placement.add_worker(datanode_addr)
+        for datanode_addr in list(self.workers):
+            if datanode_addr not in workers:
+                log.warning('Datanode %s removed from %s, its replicas will be repaired', datanode_addr, WORKERS_FILE)
+                self.placement.remove_worker(datanode_addr)
+        self.workers = [addr for addr in self.workers if addr in workers]
+
+    def replication_loop(self):
+        # uma copia por vez: o reparo vem antes, o rebalanceamento so roda quando nada falta
+        while True:
+            time.sleep(REPLICATION_INTERVAL_SECONDS)
+            self.metadata.refresh()
+            if not self.repair_replicas():
+                self.rebalance()
+            self.delete_stale_replicas()
+
+    def stale_replica_loop(self):
+        while True:
+            time.sleep(REPLICATION_INTERVAL_SECONDS)
+            self.metadata.refresh()
+            self.delete_stale_replicas()
+
+    def stored_items(self):
+        # (tipo, nome, entrada) de tudo que tem replicas nos datanodes: arquivos inteiros e blocos
+        for file_name, entry in self.metadata.entries():
+            if entry.blocks is None:
+                yield 'file', file_name, entry
+        for block_hash, block in self.metadata.block_entries():
+            yield 'block', block_hash, block
+
+    def repair_replicas(self) -> int:
+        # recria replicas perdidas (datanode fora do ar ha mais de REPAIR_AFTER_SECONDS ou fora de workers.txt)
+        # e as que faltaram no upload; devolve quantas copias foram feitas
+        repaired = 0
+        for kind, name, entry in self.stored_items():
+            lost = [addr for addr in entry.replicas if self.placement.down_for(addr) >= REPAIR_AFTER_SECONDS]
+            replicas = [addr for addr in entry.replicas if addr not in lost]
+            missing = self.replication_factor - len(replicas)
+            copied = []
+            if missing > 0:
+                sources = [addr for addr in replicas if self.placement.alive(addr)]
+                if not sources:
+                    log.warning('No live replica of %s %s to repair from', kind, name)
+                    continue
+                discarded = self.metadata.discarded_replicas(name) if kind == 'block' else []
+                for target in self.placement.choose_targets(missing, entry.size, exclude=entry.replicas + discarded):
+                    if self.copy_replica(kind, name, entry, self.placement.choose_replica(sources), target):
+                        copied.append(target)
+                # sem nenhuma copia nova as replicas perdidas continuam listadas: podem voltar
+                if not copied:
+                    continue
+            elif not lost:
+                continue
+            if self.set_replicas(kind, name, entry, replicas + copied):
+                repaired += len(copied)
+                log.info('Repaired %s %s: replicas %s', kind, name, format_addrs(replicas + copied))
+                # a copia do datanode perdido sai se ele voltar
+                for addr in lost:
+                    self.stale_replicas.append((time.time(), kind, name, addr))
+            else:
+                for addr in copied:
+                    self.stale_replicas.append((time.time(), kind, name, addr))
+        return repaired
+
+    def rebalance(self):
+        # bytes guardados em cada datanode vivo, pelos metadados
+        usage = {addr: 0 for addr in self.workers if self.placement.alive(addr)}
+        if len(usage) < 2:
+            return
+        items = list(self.stored_items())
+        for _, _, entry in items:
+            for addr in entry.replicas:
+                if addr in usage:
+                    usage[addr] += entry.size
+        moved = 0
+        while moved < REBALANCE_MAX_BYTES_PER_ROUND:
+            fullest = max(usage, key=usage.get)
+            emptiest = min(usage, key=usage.get)
+            gap = usage[fullest] - usage[emptiest]
+            if gap < REBALANCE_MIN_GAP_BYTES:
+                break
+            # maior item que cabe na metade da diferenca: uma movimentacao nunca inverte o desequilibrio
+            candidates = [(kind, name, entry) for kind, name, entry in items
+                          if fullest in entry.replicas and emptiest not in entry.replicas and 0 < entry.size <= gap // 2
+                          and not (kind == 'block' and emptiest in self.metadata.discarded_replicas(name))]
+            if not candidates:
+                break
+            kind, name, entry = max(candidates, key=lambda item: item[2].size)
+            if not self.copy_replica(kind, name, entry, fullest, emptiest):
+                break
+            replicas = [emptiest if addr == fullest else addr for addr in entry.replicas]
+            if self.set_replicas(kind, name, entry, replicas):
+                log.info('Moved %s %s (%s bytes) from %s to %s', kind, name, entry.size, fullest, emptiest)
+                self.stale_replicas.append((time.time() + MOVED_REPLICA_GRACE_SECONDS, kind, name, fullest))
+            else:
+                self.stale_replicas.append((time.time(), kind, name, emptiest))
+            usage[fullest] -= entry.size
+            usage[emptiest] += entry.size
+            moved += entry.size
+
+    def copy_replica(self, kind: str, name: str, entry, source: tuple[str, int], target: tuple[str, int]) -> bool:
+        # o datanode de origem envia a copia direto para o destino, a no maximo REPLICATION_RATE_BYTES
+        op, target_op = ('REPLICATE', 'UPLOAD') if kind == 'file' else ('REPLICATE_BLOCK', 'PUT_BLOCK')
+        start_time = time.time()
+        trace = metrics.Trace(DATANODE_PHASE_SECONDS, node_label(source), op)
+        try:
+            with wire.connect(source, timeout=POOL_CONNECT_TIMEOUT_SECONDS) as conn:
+                trace.mark('connect')
+                log.debug('# main to datanode: send %s control message to %s', op, source)
+                self.send_control(conn, f'{op}${name}${format_addrs([target])}${REPLICATION_RATE_BYTES}'
+                                        f'${make_token(target_op, name)}${make_token(op, name)}')
+                log.debug('# main from datanode: recv DONE message from %s', source)
+                msg = self.recv_control(conn)
+                # o datanode so responde depois de enviar a copia inteira
+                trace.mark('transfer')
+        except OSError as e:
+            log.warning('Copy of %s %s from %s to %s failed: %r', kind, name, source, target, e)
+            return False
+        if msg[0] != 'DONE' or int(msg[1]) < 1:
+            log.warning('Copy of %s %s from %s to %s failed: %s', kind, name, source, target, '$'.join(msg))
+            return False
+        if kind == 'file' and entry.checksum and len(msg) > 2 and msg[2] != entry.checksum:
+            log.warning('Copy of %s on %s has checksum %s, expected %s', name, target, msg[2], entry.checksum)
+            self.stale_replicas.append((time.time(), kind, name, target))
+            return False
+        log.info('Copied %s %s from %s to %s in %.4f seconds', kind, name, source, target, time.time() - start_time)
+        return True
+
+    def set_replicas(self, kind: str, name: str, entry, replicas: list[tuple[str, int]]) -> bool:
+        # False se o arquivo foi sobrescrito ou apagado durante a copia
+        if kind == 'file':
+            return self.metadata.set_replicas(name, entry, replicas)
+        return self.metadata.set_block_replicas(name, entry, replicas)
+
+    def delete_stale_replicas(self):
+        # copias fora dos metadados: apagadas depois do prazo, quando o datanode responde.
+        # DELETEs acrescentam de outras threads: a lista e trocada antes de percorrer e o que sobra volta no fim
+        now = time.time()
+        remaining = []
+        stale, self.stale_replicas = self.stale_replicas, []
+        for deadline, kind, name, addr in stale:
+            if addr not in self.workers:
+                continue  # saiu de workers.txt
+            if deadline > now or not self.placement.alive(addr):
+                remaining.append((deadline, kind, name, addr))
+                continue
+            current = self.metadata.get(name) if kind == 'file' else self.metadata.get_block(name)
+            if current is not None and addr in current.replicas:
+                continue
+            try:
+                if kind == 'file':
+                    self.delete_in_datanode(addr, name)
+                else:
+                    self.delete_block_in_datanode(addr, name)
+            except OSError as e:
+                log.warning('Could not delete stale copy of %s from %s: %s', name, addr, e)
+                remaining.append((deadline, kind, name, addr))
+        self.stale_replicas.extend(remaining)
+
+    def heartbeat(self, datanode_addr: tuple[str, int]) -> tuple[int, int, float]:
+        trace = metrics.Trace(DATANODE_PHASE_SECONDS, node_label(datanode_addr), 'HEARTBEAT')
+        with self.pool.connection(datanode_addr) as datanode_conn:
+            trace.mark('connect')
+            datanode_conn.settimeout(HEARTBEAT_TIMEOUT_SECONDS)
+            self.send_control(datanode_conn, 'HEARTBEAT')
+            msg = self.recv_control(datanode_conn)
+            trace.mark('handshake')
+            datanode_conn.settimeout(None)
+        if msg[0] != 'HEARTBEAT':
+            raise ValueError(f'unexpected reply {msg[0]}')
+        return int(msg[1]), int(msg[2]), float(msg[3])
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as datanode_conn:
-            print(f"# main to datanode: send DELETE control message to {datanode_addr}")
-            datanode_conn.connect(datanode_addr)
-            datanode_conn.sendall(control_msg)
+    def locate_upload(self, conn: socket.socket, addr: tuple[str, int], file_name: str, file_size: int):
+        # modo direto: main so escolhe os datanodes, o cliente envia os bytes
+        selected_datanodes = self.placement.choose_targets(self.replication_factor, file_size)
+        log.debug('Selected datanodes for direct upload of %s: %s', file_name, selected_datanodes)
+        token = make_token('UPLOAD', file_name)
+        log.debug('# main to client: send TARGETS message to %s', addr)
+        self.send_control(conn, f'TARGETS${token}${format_addrs(selected_datanodes)}')
+
+    def commit_upload(self, conn: socket.socket, addr: tuple[str, int], file_name: str, file_size: int, token: str, datanodes: str, checksum: str | None = None):
+        datanode_addrs = parse_addrs(datanodes) if datanodes else []
+        if not check_token(token, 'UPLOAD', file_name) or not datanode_addrs or not all(a in self.workers for a in datanode_addrs):
+            log.warning('Rejected commit of %s from %s', file_name, addr)
+            self.send_control(conn, 'ERROR$invalid token')
+            return
+        self.save_metadata(file_name, file_size, datanode_addrs, checksum)
+        log.debug('# main to client: send DONE message to %s', addr)
+        self.send_control(conn, 'DONE')
+
+    def locate(self, conn: socket.socket, addr: tuple[str, int], file_name: str):
+        entry = self.metadata.get(file_name)
+        if entry is None:
+            self.send_control(conn, 'ERROR$not found')
+            return
+        file_size, datanode_addrs = entry.size, entry.replicas
+        if entry.blocks is not None:
+            # uma linha por bloco: HASH SIZE TOKEN DATANODES
+            lines = []
+            for block_hash in entry.blocks:
+                block = self.metadata.get_block(block_hash)
+                replicas = self.placement.rank(block.replicas)
+                lines.append(f'{block_hash} {block.size} {make_token("GET_BLOCK", block_hash)} {format_addrs(replicas)}\n')
+            answer = ''.join(lines).encode()
+            log.debug('# main to client: send BLOCKS message to %s', addr)
+            self.send_control(conn, f'BLOCKS${file_size}${len(answer)}${entry.checksum or ""}')
+            conn.sendall(answer)
+            return
+        token = make_token('DOWNLOAD', file_name)
+        # a replica recomendada para leitura vai primeiro
+        datanode_addrs = self.placement.rank(datanode_addrs)
+        log.debug('# main to client: send LOCATION message to %s', addr)
+        self.send_control(conn, f'LOCATION${file_size}${token}${format_addrs(datanode_addrs)}${entry.checksum or ""}')
+
+    def save_metadata(self, file_name: str, file_size: int, datanode_addrs: list[tuple[str, int]], checksum: str | None = None):
+        # sobrescrever um arquivo em blocos solta os blocos antigos (vao para a coleta)
+        self.metadata.put(file_name, file_size, datanode_addrs, checksum)
+        self.cache.invalidate(file_name)
+
+    def load_entry(self, file_name: str) -> FileEntry:
+        entry = self.metadata.get(file_name)
+        if entry is None:
+            raise FileNotFoundError(file_name)
+        return entry
 
     def list_images(self, conn: socket.socket, client_addr: tuple[str, int]):
         with conn:
-            msg = os.listdir('main_dir')
-            msg.remove('workers.txt')
-            msg.remove('main_endpoint.txt')
+            msg = self.metadata.names()
             msg = ' '.join(msg).encode()
 
             msg_size = len(msg)
-            print(f"# main to client: send listing size {msg_size} to {client_addr}")
-            conn.sendall(str(msg_size).ljust(1024, ' ').encode())
+            log.debug('# main to client: send listing size %s to %s', msg_size, client_addr)
+            self.send_control(conn, str(msg_size))
 
-            print(f"# main to client: send listing to {client_addr}")
+            log.debug('# main to client: send listing to %s', client_addr)
             conn.sendall(msg)
-            print(f'Listing for {client_addr} done')
+            log.debug('Listing for %s done', client_addr)
+
+    def list_images_page(self, conn: socket.socket, client_addr: tuple[str, int], prefix: str, page_size: int, page_token: str):
+        # prefixo e token chegam com quote() para aceitar qualquer caractere no nome
+        prefix = urllib.parse.unquote(prefix)
+        after = urllib.parse.unquote(page_token)
+        page_size = max(1, min(page_size, MAX_LISTING_PAGE_SIZE))
+        page, next_token = self.metadata.list_page(prefix, page_size, after)
+
+        log.debug('# main to client: send PAGE with %s entries to %s', len(page), client_addr)
+        self.send_control(conn, f'PAGE${len(page)}${urllib.parse.quote(next_token)}')
+
+        # uma linha por arquivo: NOME SIZE_BYTES REPLICAS, enviadas em lotes sem montar a pagina inteira
+        lines = []
+        for name, entry in page:
+            lines.append(f'{urllib.parse.quote(name)} {entry.size} {self.metadata.replica_count(entry)}\n')
+            if len(lines) == LISTING_BATCH_LINES:
+                conn.sendall(''.join(lines).encode())
+                lines = []
+        if lines:
+            conn.sendall(''.join(lines).encode())
 
     def recvall(self, conn: socket.socket, msg_size: int) -> bytes:
-        bytes_recvd = 0
-        chunks = []
-        while bytes_recvd < msg_size:
-            chunk = conn.recv(msg_size)
-            chunks.append(chunk)
-            bytes_recvd += len(chunk)
-        return b''.join(chunks)
+        return wire.recvall(conn, msg_size)
+
+    def send_control(self, conn: socket.socket, msg: str):
+        # responde no formato (texto ou binario) em que o outro lado falou
+        wire.send_control(conn, msg)
+
+    def recv_control(self, conn: socket.socket) -> list[str]:
+        return wire.recv_control(conn)
+
+def staging_path(upload_id: str, suffix: str = 'data') -> str:
+    # o id vem do cliente: so hex, para nao sair de UPLOAD_STAGING_DIR
+    if not valid_upload_id(upload_id):
+        raise ValueError(f'invalid upload id {upload_id!r}')
+    return f'{UPLOAD_STAGING_DIR}/{upload_id}.{suffix}'
+
+def valid_upload_id(upload_id: str) -> bool:
+    return len(upload_id) == 32 and all(c in '0123456789abcdef' for c in upload_id)
+
+def discard_upload(upload_id: str):
+    for suffix in ('data', 'name'):
+        try:
+            os.remove(staging_path(upload_id, suffix))
+        except FileNotFoundError:
+            pass
+
+class DatanodePool:
+    # conexoes persistentes por datanode; cada conexao atende um pedido por vez e volta para o pool
+    def __init__(self) -> None:
+        self.idle = {}  # addr -> [(conn, last_used)]
+        self.lock = threading.Lock()
+        t = threading.Thread(target=self.evict_idle_loop, daemon=True)
+        t.start()
+
+    @contextlib.contextmanager
+    def connection(self, addr: tuple[str, int]):
+        conn = self.acquire(addr)
+        try:
+            yield conn
+        except BaseException:
+            # o estado do protocolo nessa conexao e desconhecido, nao pode voltar para o pool
+            conn.close()
+            raise
+        self.release(addr, conn)
+
+    def acquire(self, addr: tuple[str, int]) -> socket.socket:
+        conn = self.acquire_idle(addr)
+        if conn is not None:
+            return conn
+        log.debug('# main to datanode: open pooled connection to %s', addr)
+        POOL_CONNECTIONS.inc(node_label(addr), 'new')
+        return wire.connect(addr, timeout=POOL_CONNECT_TIMEOUT_SECONDS)
+
+    def acquire_idle(self, addr: tuple[str, int]) -> socket.socket | None:
+        while True:
+            with self.lock:
+                conns = self.idle.get(addr)
+                if not conns:
+                    return None
+                conn, last_used = conns.pop()
+            if time.time() - last_used > POOL_IDLE_TIMEOUT_SECONDS or not self.is_healthy(conn, last_used):
+                conn.close()
+                continue
+            POOL_CONNECTIONS.inc(node_label(addr), 'reused')
+            return conn
+
+    def release(self, addr: tuple[str, int], conn: socket.socket):
+        with self.lock:
+            conns = self.idle.setdefault(addr, [])
+            if len(conns) < POOL_MAX_IDLE_PER_DATANODE:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+    def is_healthy(self, conn: socket.socket, last_used: float) -> bool:
+        try:
+            conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+            # o datanode nunca manda nada sem pedido: qualquer byte ou EOF aqui significa conexao inutilizavel
+            return False
+        except BlockingIOError:
+            pass
+        except OSError:
+            return False
+        if time.time() - last_used < POOL_HEALTHCHECK_AFTER_SECONDS:
+            return True
+        try:
+            conn.settimeout(POOL_CONNECT_TIMEOUT_SECONDS)
+            wire.send_control(conn, 'PING')
+            reply = wire.recv_control(conn)
+            conn.settimeout(None)
+            return reply[0] == 'PONG'
+        except OSError:
+            return False
+
+    def evict_idle_loop(self):
+        while True:
+            time.sleep(POOL_IDLE_TIMEOUT_SECONDS / 2)
+            now = time.time()
+            expired = []
+            with self.lock:
+                for addr, conns in self.idle.items():
+                    expired.extend(conn for conn, last_used in conns if now - last_used > POOL_IDLE_TIMEOUT_SECONDS)
+                    conns[:] = [(conn, last_used) for conn, last_used in conns if now - last_used <= POOL_IDLE_TIMEOUT_SECONDS]
+            for conn in expired:
+                conn.close()
+            if expired:
+                log.info('Evicted %s idle datanode connections', len(expired))
+
+class ClientDisconnected(Exception):
+    # o cliente (ou a origem dos bytes de um upload) falhou no meio da transferencia: tentar outra replica nao adianta
+    pass
+
+def source_chunks(chunks):
+    # chunks de um upload; um erro na origem nao pode ser confundido com falha do datanode
+    try:
+        yield from chunks
+    except OSError as e:
+        raise ClientDisconnected(e) from e
+
+def read_workers() -> list[tuple[str, int]]:
+    workers = []
+    with open(WORKERS_FILE, 'r') as f:
+        for line in f:
+            line = line.split()
+            if line:
+                workers.append((line[0], int(line[1])))
+    return workers
+
+def read_request(op: str, name: str, offset: int, size: int) -> str:
+    # DOWNLOAD/GET_BLOCK do arquivo inteiro, ou so do que falta a partir de offset depois de uma falha
+    token = make_token(op, name)
+    return f'{op}${name}${token}' if not offset else f'{op}${name}${offset}${size - offset}${token}'
+
+def size_msg(file_size: int, checksum: str | None, codec: str = '') -> str:
+    # SIZE_BYTES$CHECKSUM para o cliente conferir o download; arquivos antigos nao tem checksum.
+    # Com compressao negociada: SIZE_BYTES$CHECKSUM$CODEC
+    if codec:
+        return f'{file_size}${checksum or ""}${codec}'
+    return f'{file_size}${checksum}' if checksum else f'{file_size}'
+
+def format_addrs(addrs: list[tuple[str, int]]) -> str:
+    return ','.join([f'{addr[0]}:{addr[1]}' for addr in addrs])
+
+def node_label(addr: tuple[str, int]) -> str:
+    # label datanode das metricas
+    return f'{addr[0]}:{addr[1]}'
+
+def parse_addrs(addrs: str) -> list[tuple[str, int]]:
+    parsed = []
+    for addr in addrs.split(','):
+        host, port = addr.rsplit(':', 1)
+        parsed.append((host, int(port)))
+    return parsed
+
+def raise_fd_limit(wanted: int):
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < wanted:
+            new_soft = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            log.info('Raised open file limit from %s to %s', soft, new_soft)
+    except (ImportError, ValueError, OSError) as e:
+        log.warning('Could not raise open file limit: %s', e)
+
+def serve_workers(host: str, port: int, replication_factor: int, count: int, use_async: bool = False):
+    # pre-fork: cada worker e um Main completo num processo proprio (um GIL por worker), escutando na mesma porta
+    # com SO_REUSEPORT. Eles se coordenam pelos metadados em main_dir (WAL com flock); cache, pool de conexoes e
+    # heartbeats sao de cada worker. Este processo so cria os workers, recria os que morrem e repassa o SIGTERM.
+    children = {}  # pid -> indice do worker
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            status = 1
+            try:
+                s = Main(host, port, replication_factor, worker=index)
+                # metricas de cada worker na porta dele: porta + METRICS_PORT_OFFSET + indice
+                metrics.serve(port + index)
+                log.info('Worker %s running with pid %s', index, os.getpid())
+                if use_async:
+                    s.start_async()
+                else:
+                    s.start()
+                status = 0
+            except (KeyboardInterrupt, SystemExit):
+                status = 0
+            except BaseException:
+                log.exception('Worker %s failed', index)
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        children[pid] = index
+
+    # SIGTERM vira KeyboardInterrupt: para os workers do mesmo jeito que um Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for index in range(count):
+            spawn(index)
+        log.info('Started %s workers on port %s', count, port)
+        while True:
+            pid, status = os.wait()
+            index = children.pop(pid, None)
+            if index is None:
+                continue
+            log.warning('Worker %s (pid %s) exited with status %s, restarting', index, pid, os.waitstatus_to_exitcode(status))
+            time.sleep(WORKER_RESTART_DELAY_SECONDS)
+            spawn(index)
+    except KeyboardInterrupt:
+        log.info('Stopping %s workers', len(children))
+        for pid in children:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        for pid in children:
+            with contextlib.suppress(ChildProcessError):
+                os.waitpid(pid, 0)
 
 if __name__ == '__main__':
-    s = Main(MAIN_ADDR, MAIN_PORT, REPLICATION_FACTOR)
-    s.start()
+    import sys
+    metrics.configure_logging()
+    require_secret()
+    workers = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else 1
+    if workers > 1:
+        serve_workers(MAIN_ADDR, MAIN_PORT, REPLICATION_FACTOR, workers, '--async' in sys.argv)
+    else:
+        s = Main(MAIN_ADDR, MAIN_PORT, REPLICATION_FACTOR)
+        metrics.serve(MAIN_PORT)
+        if '--async' in sys.argv:
+            s.start_async()
+        else:
+            s.start()
@@ -0,0 +1,565 @@
+import os
+import json
+import bisect
+import threading
+import time
+import contextlib
+import fcntl
+import logging
+import metrics
+
+log = logging.getLogger('metadata')
+
+# metadados dos arquivos ficam em memoria; cada alteracao vai para um log append-only (WAL)
+# e de tempos em tempos o estado inteiro e gravado em um snapshot, que permite truncar o log
+SNAPSHOT_FILE = 'metadata.snapshot'
+WAL_FILE = 'metadata.wal'
+OLD_WAL_FILE = 'metadata.wal.old'
+# com varios processos no mesmo diretorio (main --workers): flock para gravar no WAL e para trocar o snapshot
+WAL_LOCK_FILE = 'metadata.wal.lock'
+SNAPSHOT_LOCK_FILE = 'metadata.snapshot.lock'
+
+WAL_FSYNC = True
+SNAPSHOT_EVERY_OPS = 10000
+SNAPSHOT_VERSION = 2
+SNAPSHOT_INTERVAL_SECONDS = 300
+
+WAL_FSYNC_SECONDS = metrics.Histogram('mygeoeye_metadata_wal_fsync_seconds', 'Time to fsync a metadata WAL record, by operation', ('op',))
+
+# arquivos de main_dir que nao sao metadados de imagens
+RESERVED_FILES = {'workers.txt', 'main_endpoint.txt', SNAPSHOT_FILE, WAL_FILE, OLD_WAL_FILE, SNAPSHOT_FILE + '.tmp',
+                  WAL_LOCK_FILE, SNAPSHOT_LOCK_FILE}
+
+class FileEntry:
+    __slots__ = ('size', 'replicas', 'checksum', 'blocks')
+
+    def __init__(self, size: int, replicas: list[tuple[str, int]], checksum: str | None = None, blocks: list[str] | None = None) -> None:
+        self.size = size
+        self.replicas = replicas
+        self.checksum = checksum
+        # arquivos guardados em blocos: sha256 de cada bloco, em ordem (as replicas ficam na tabela de blocos)
+        self.blocks = blocks
+
+    def to_record(self) -> dict:
+        record = {'size': self.size, 'replicas': format_replicas(self.replicas), 'checksum': self.checksum}
+        if self.blocks is not None:
+            record['blocks'] = self.blocks
+        return record
+
+    @staticmethod
+    def from_record(record: dict) -> 'FileEntry':
+        blocks = record.get('blocks')
+        if blocks is not None:
+            # no WAL cada bloco vem como [hash, size, replicas]; no snapshot so o hash
+            blocks = [block if isinstance(block, str) else block[0] for block in blocks]
+        return FileEntry(record['size'], parse_replicas(record['replicas']), record.get('checksum'), blocks)
+
+class BlockEntry:
+    __slots__ = ('size', 'replicas', 'refs')
+
+    def __init__(self, size: int, replicas: list[tuple[str, int]]) -> None:
+        self.size = size
+        self.replicas = replicas
+        self.refs = 0  # quantas posicoes de arquivos apontam para o bloco; recalculado na recuperacao
+
+    def to_record(self) -> dict:
+        return {'size': self.size, 'replicas': format_replicas(self.replicas)}
+
+    @staticmethod
+    def from_record(record: dict) -> 'BlockEntry':
+        return BlockEntry(record['size'], parse_replicas(record['replicas']))
+
+class MetadataStore:
+    # shared: outros processos usam o mesmo diretorio (main --workers). Cada um grava no WAL com flock e aplica
+    # o que os outros gravaram antes de gravar e em refresh(); on_change(nome) avisa desses arquivos alterados
+    # por outro processo. So o leader grava snapshots e troca o WAL.
+    def __init__(self, directory: str, shared: bool = False, leader: bool = True, on_change=None) -> None:
+        self.directory = directory
+        self.shared = shared
+        self.leader = leader
+        self.on_change = on_change
+        self.files = {}  # nome -> FileEntry
+        self.blocks = {}  # sha256 -> BlockEntry, com contagem de referencias
+        self.orphans = {}  # sha256 -> (BlockEntry, desde quando): blocos sem referencia esperando a coleta
+        # sha256 -> (BlockEntry, desde quando): destinos de PUT_BLOCKS que o commit ainda nao confirmou; nao sao
+        # reaproveitados (o bloco pode nunca ter chegado) e o que sobrar neles vai para a coleta como um orfao
+        self.pending = {}
+        self.collecting = {}  # sha256 -> BlockEntry: blocos sendo apagados dos datanodes, nao voltam a ser usados
+        self.sorted_names = None  # nomes em ordem, para listagem paginada por prefixo; montado depois da recuperacao
+        self.lock = threading.Lock()
+        # uma gravacao no WAL por vez; entre processos tambem o flock de WAL_LOCK_FILE
+        self.wal_lock = threading.Lock()
+        self.wal_lock_file = open(self.path(WAL_LOCK_FILE), 'a') if shared else None
+        self.snapshot_lock_file = open(self.path(SNAPSHOT_LOCK_FILE), 'a') if shared else None
+        self.ops_since_snapshot = 0
+        self.snapshot_running = False
+
+        start_time = time.time()
+        # outro worker pode estar no meio de um snapshot: a recuperacao espera ele terminar
+        with self.locked(self.snapshot_lock_file), self.locked(self.wal_lock_file):
+            self.recover()
+            migrated = self.migrate_legacy_entries()
+            if leader and (migrated or os.path.exists(self.path(OLD_WAL_FILE))):
+                # snapshot interrompido ou migracao: grava o estado antes de apagar qualquer coisa
+                self.write_snapshot(self.files, self.block_records(), self.waiting_records())
+                if os.path.exists(self.path(OLD_WAL_FILE)):
+                    os.remove(self.path(OLD_WAL_FILE))
+                for name in migrated:
+                    os.remove(self.path(name))
+            self.sorted_names = sorted(self.files)
+            self.open_wal()
+        log.info('Metadata recovered with %s files and %s blocks in %.4f seconds', len(self.files), len(self.blocks), time.time() - start_time)
+
+        if leader:
+            t = threading.Thread(target=self.snapshot_loop, daemon=True)
+            t.start()
+
+    def path(self, file_name: str) -> str:
+        return os.path.join(self.directory, file_name)
+
+    def get(self, file_name: str) -> FileEntry | None:
+        return self.files.get(file_name)
+
+    def get_block(self, block_hash: str) -> BlockEntry | None:
+        return self.blocks.get(block_hash)
+
+    def known_block(self, block_hash: str) -> BlockEntry | None:
+        # bloco referenciado ou ainda nao coletado: as replicas dele continuam nos datanodes
+        block = self.blocks.get(block_hash)
+        if block is not None:
+            return block
+        orphan = self.orphans.get(block_hash)
+        return orphan[0] if orphan is not None else None
+
+    def replica_count(self, entry: FileEntry) -> int:
+        # um arquivo em blocos tem tantas replicas quanto o seu bloco menos replicado
+        if entry.blocks is None:
+            return len(entry.replicas)
+        counts = [len(block.replicas) for block in map(self.blocks.get, entry.blocks) if block is not None]
+        return min(counts, default=0)
+
+    def names(self) -> list[str]:
+        with self.lock:
+            return list(self.files)
+
+    def entries(self) -> list[tuple[str, FileEntry]]:
+        with self.lock:
+            return list(self.files.items())
+
+    def block_entries(self) -> list[tuple[str, BlockEntry]]:
+        with self.lock:
+            return list(self.blocks.items())
+
+    def list_page(self, prefix: str, page_size: int, after: str = '') -> tuple[list[tuple[str, FileEntry]], str]:
+        # devolve ate page_size entradas com o prefixo, depois de 'after', e o token da proxima pagina ('' no fim)
+        with self.lock:
+            if after:
+                i = bisect.bisect_right(self.sorted_names, after)
+            else:
+                i = bisect.bisect_left(self.sorted_names, prefix)
+            page = []
+            while i < len(self.sorted_names) and len(page) < page_size:
+                name = self.sorted_names[i]
+                if not name.startswith(prefix):
+                    break
+                page.append((name, self.files[name]))
+                i += 1
+            has_more = i < len(self.sorted_names) and self.sorted_names[i].startswith(prefix)
+        next_token = page[-1][0] if page and has_more else ''
+        return page, next_token
+
+    def put(self, file_name: str, size: int, replicas: list[tuple[str, int]], checksum: str | None = None,
+            blocks: list[tuple[str, int, list[tuple[str, int]]]] | None = None, check=None) -> list[tuple[str, BlockEntry]] | None:
+        # blocks: [(sha256, size, replicas)] para arquivos guardados em blocos
+        # devolve os blocos que ficaram sem nenhuma referencia (vao para a coleta), ou None se check falhou
+        entry = FileEntry(size, list(replicas), checksum, [block[0] for block in blocks] if blocks is not None else None)
+        record = {'op': 'put', 'name': file_name, **entry.to_record()}
+        if blocks is not None:
+            record['blocks'] = [[block_hash, block_size, format_replicas(block_replicas)]
+                                for block_hash, block_size, block_replicas in blocks]
+        return self.append(record, lambda: self.apply_put(file_name, entry, blocks), check)
+
+    def delete(self, file_name: str) -> list[tuple[str, BlockEntry]]:
+        if file_name not in self.files:
+            return []
+        return self.append({'op': 'delete', 'name': file_name}, lambda: self.apply_delete(file_name))
+
+    def set_replicas(self, file_name: str, entry: FileEntry, replicas: list[tuple[str, int]]) -> bool:
+        # troca as replicas de um arquivo (reparo, rebalanceamento) se ele ainda e a versao lida antes da copia;
+        # False se foi sobrescrito ou apagado nesse meio tempo
+        record = {'op': 'replicas', 'name': file_name, 'replicas': format_replicas(replicas)}
+        return self.append(record, lambda: self.apply_replicas(entry, replicas),
+                           check=lambda: self.files.get(file_name) is entry) is not None
+
+    def set_block_replicas(self, block_hash: str, block: BlockEntry, replicas: list[tuple[str, int]]) -> bool:
+        record = {'op': 'block_replicas', 'hash': block_hash, 'replicas': format_replicas(replicas)}
+        return self.append(record, lambda: self.apply_replicas(block, replicas),
+                           check=lambda: self.blocks.get(block_hash) is block) is not None
+
+    def keep_orphan(self, block_hash: str) -> bool:
+        # bloco esperando a coleta que volta a ser pedido: adia a remocao para o cliente ter tempo de fazer o
+        # commit. O registro vai para o WAL para o worker que faz a coleta saber; False se ela ja apagou o bloco
+        return self.append({'op': 'keep_block', 'hash': block_hash}, lambda: self.apply_keep(block_hash),
+                           check=lambda: block_hash in self.orphans) is not None
+
+    def add_pending(self, blocks: list[tuple[str, int, list[tuple[str, int]]]]):
+        # [(sha256, size, destinos)] de um PUT_BLOCKS, gravados antes de responder ao cliente
+        record = {'op': 'pending_blocks', 'blocks': [[block_hash, block_size, format_replicas(replicas)]
+                                                     for block_hash, block_size, replicas in blocks]}
+        self.append(record, lambda: self.apply_pending(blocks))
+
+    def start_collect(self, grace_seconds: float) -> list[tuple[str, BlockEntry]]:
+        # blocos sem referencia ha mais de grace_seconds passam para a coleta e nao podem mais ser reaproveitados:
+        # um PUT_BLOCKS do mesmo hash, em qualquer processo, manda reenviar o bloco para outros datanodes.
+        # Destinos sem commit ha mais de grace_seconds (maior que a validade do token) tambem: o commit nao vem mais.
+        # Devolve esses blocos e os que ficaram de uma coleta anterior; quem chama apaga sem lock nenhum
+        with self.wal_locked(), self.lock:
+            self.catch_up()
+            now = time.time()
+            expired = [block_hash for block_hash, (_, since) in self.orphans.items() if since + grace_seconds < now]
+            unconfirmed = [block_hash for block_hash, (_, since) in self.pending.items() if since + grace_seconds < now]
+            if expired or unconfirmed:
+                self.write({'op': 'collect_blocks', 'hashes': expired, 'pending': unconfirmed})
+                self.apply_collect(expired, unconfirmed)
+            return list(self.collecting.items())
+
+    def drop_collected(self, hashes: list[str]) -> bool:
+        # blocos ja apagados de todas as replicas saem da coleta
+        return self.append({'op': 'drop_blocks', 'hashes': hashes}, lambda: self.apply_drop(hashes),
+                           check=lambda: any(block_hash in self.collecting for block_hash in hashes)) is not None
+
+    def collecting_replicas(self, block_hash: str) -> list[tuple[str, int]]:
+        block = self.collecting.get(block_hash)
+        return block.replicas if block is not None else []
+
+    def discarded_replicas(self, block_hash: str) -> list[tuple[str, int]]:
+        # datanodes de onde a coleta vai (ou pode vir a) apagar o bloco: copias novas nao vao para eles
+        pending = self.pending.get(block_hash)
+        return self.collecting_replicas(block_hash) + (pending[0].replicas if pending is not None else [])
+
+    def apply_keep(self, block_hash: str) -> bool:
+        orphan = self.orphans.get(block_hash)
+        if orphan is not None:
+            self.orphans[block_hash] = (orphan[0], time.time())
+        return True
+
+    def apply_pending(self, blocks: list) -> bool:
+        now = time.time()
+        for block_hash, block_size, replicas in blocks:
+            pending = self.pending.get(block_hash)
+            if pending is not None:
+                replicas = pending[0].replicas + [addr for addr in replicas if addr not in pending[0].replicas]
+            self.pending[block_hash] = (BlockEntry(block_size, list(replicas)), now)
+        return True
+
+    def apply_collect(self, hashes: list[str], pending: list[str] = ()) -> bool:
+        for waiting, expired in ((self.orphans, hashes), (self.pending, pending)):
+            for block_hash in expired:
+                entry = waiting.pop(block_hash, None)
+                if entry is None:
+                    continue
+                block = entry[0]
+                collecting = self.collecting.get(block_hash)
+                if collecting is not None:
+                    block = BlockEntry(block.size, collecting.replicas + [addr for addr in block.replicas
+                                                                          if addr not in collecting.replicas])
+                self.collecting[block_hash] = block
+        return True
+
+    def apply_drop(self, hashes: list[str]) -> bool:
+        for block_hash in hashes:
+            if self.collecting.pop(block_hash, None) is None:
+                self.orphans.pop(block_hash, None)  # WAL de antes da coleta em duas etapas
+        return True
+
+    def apply_replicas(self, entry: FileEntry | BlockEntry | None, replicas: list[tuple[str, int]]) -> bool:
+        if entry is not None:
+            entry.replicas = list(replicas)
+        return True
+
+    def apply_put(self, file_name: str, entry: FileEntry, blocks: list | None = None) -> list[tuple[str, BlockEntry]]:
+        # referencia os blocos novos antes de soltar os antigos: regravar o mesmo conteudo nao apaga nada
+        for block_hash, block_size, block_replicas in blocks or ():
+            block = self.blocks.get(block_hash)
+            if block is None:
+                block = self.blocks[block_hash] = BlockEntry(block_size, [])
+                self.orphans.pop(block_hash, None)
+            block.refs += 1
+            block.replicas.extend(addr for addr in block_replicas if addr not in block.replicas)
+            # destinos do PUT_BLOCKS que nao entraram nas replicas (cadeia que gravou menos copias) continuam
+            # esperando: outro upload do mesmo bloco ainda pode confirma-los, senao a coleta apaga o que sobrou
+            pending = self.pending.pop(block_hash, None)
+            if pending is not None:
+                leftover = [addr for addr in pending[0].replicas if addr not in block.replicas]
+                if leftover:
+                    self.pending[block_hash] = (BlockEntry(block_size, leftover), pending[1])
+        old = self.files.get(file_name)
+        if old is None and self.sorted_names is not None:
+            bisect.insort(self.sorted_names, file_name)
+        self.files[file_name] = entry
+        return self.release_blocks(old)
+
+    def apply_delete(self, file_name: str) -> list[tuple[str, BlockEntry]]:
+        old = self.files.pop(file_name, None)
+        if old is not None and self.sorted_names is not None:
+            i = bisect.bisect_left(self.sorted_names, file_name)
+            del self.sorted_names[i]
+        return self.release_blocks(old)
+
+    def release_blocks(self, entry: FileEntry | None) -> list[tuple[str, BlockEntry]]:
+        orphans = []
+        if entry is None or entry.blocks is None:
+            return orphans
+        for block_hash in entry.blocks:
+            block = self.blocks[block_hash]
+            block.refs -= 1
+            if block.refs == 0:
+                del self.blocks[block_hash]
+                self.orphans[block_hash] = (block, time.time())
+                orphans.append((block_hash, block))
+        return orphans
+
+    def block_records(self) -> dict:
+        return {block_hash: block.to_record() for block_hash, block in self.blocks.items()}
+
+    def waiting_records(self) -> dict:
+        # blocos a apagar dos datanodes: fora do snapshot eles seriam esquecidos no proximo restart
+        def waiting(entries):
+            return {block_hash: {**block.to_record(), 'since': since} for block_hash, (block, since) in entries.items()}
+
+        return {
+            'orphans': waiting(self.orphans),
+            'pending': waiting(self.pending),
+            'collecting': {block_hash: block.to_record() for block_hash, block in self.collecting.items()},
+        }
+
+    def append(self, record: dict, apply, check=None):
+        # check: condicao conferida com o lock antes de gravar; se falha nada e gravado e o resultado e None
+        with self.wal_locked():
+            with self.lock:
+                self.catch_up()
+                if check is not None and not check():
+                    return None
+                self.write(record)
+                result = apply()
+                should_snapshot = self.leader and self.ops_since_snapshot >= SNAPSHOT_EVERY_OPS and not self.snapshot_running
+        if should_snapshot:
+            t = threading.Thread(target=self.snapshot, daemon=True)
+            t.start()
+        return result
+
+    def write(self, record: dict):
+        # chamado com os locks do WAL e do estado
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        self.wal.write(line)
+        self.wal.flush()
+        if WAL_FSYNC:
+            with WAL_FSYNC_SECONDS.time(record['op']):
+                os.fsync(self.wal.fileno())
+        self.ops_since_snapshot += 1
+        if self.shared:
+            # o que foi gravado ja esta aplicado; ninguem mais grava enquanto temos o flock
+            self.wal_position = self.wal_reader.seek(0, os.SEEK_END)
+
+    def refresh(self):
+        # modo compartilhado: aplica o que os outros processos gravaram desde a ultima leitura. Sem nada novo
+        # custa um stat; o main chama antes de atender cada pedido
+        if not self.shared:
+            return
+        try:
+            stat = os.stat(self.path(WAL_FILE))
+        except FileNotFoundError:
+            return  # o lider esta trocando o WAL
+        if stat.st_ino == self.wal_inode and stat.st_size == self.wal_position:
+            return
+        with self.lock:
+            self.catch_up(truncate=False)
+
+    def catch_up(self, truncate: bool = True):
+        # chamado com o lock do estado e, com truncate, com o do WAL
+        if not self.shared:
+            return
+        while True:
+            data = self.wal_reader.read()
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                record = json.loads(line)
+                self.apply_record(record)
+                self.ops_since_snapshot += 1
+                if self.on_change is not None and 'name' in record:
+                    self.on_change(record['name'])
+            self.wal_position += end
+            if end < len(data):
+                # registro pela metade: outro processo ainda esta gravando ou, se temos o flock, sobra de um crash
+                self.wal_reader.seek(self.wal_position)
+                if truncate:
+                    os.truncate(self.path(WAL_FILE), self.wal_position)
+            try:
+                if os.stat(self.path(WAL_FILE)).st_ino == self.wal_inode:
+                    return
+            except FileNotFoundError:
+                return
+            # o lider trocou o WAL num snapshot: o antigo ja foi lido ate o fim, continua no comeco do novo
+            self.wal.close()
+            self.wal_reader.close()
+            self.open_wal(at_end=False)
+
+    def open_wal(self, at_end: bool = True):
+        self.wal = open(self.path(WAL_FILE), 'a', encoding='utf-8')
+        if self.shared:
+            self.wal_reader = open(self.path(WAL_FILE), 'rb', buffering=0)
+            self.wal_position = self.wal_reader.seek(0, os.SEEK_END) if at_end else 0
+            self.wal_inode = os.fstat(self.wal_reader.fileno()).st_ino
+
+    @contextlib.contextmanager
+    def locked(self, lock_file):
+        # flock entre os processos que compartilham o diretorio; sem efeito com um processo so
+        if lock_file is None:
+            yield
+            return
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def wal_locked(self):
+        with self.wal_lock, self.locked(self.wal_lock_file):
+            yield
+
+    def snapshot(self):
+        # so a troca do WAL acontece com o lock; o snapshot e escrito fora dele
+        with self.lock:
+            if self.snapshot_running:
+                return
+            self.snapshot_running = True
+        try:
+            with self.locked(self.snapshot_lock_file):
+                with self.wal_locked(), self.lock:
+                    self.catch_up()
+                    self.wal.close()
+                    os.replace(self.path(WAL_FILE), self.path(OLD_WAL_FILE))
+                    if self.shared:
+                        self.wal_reader.close()
+                    self.open_wal()
+                    files = dict(self.files)
+                    blocks = self.block_records()
+                    waiting = self.waiting_records()
+                    self.ops_since_snapshot = 0
+                self.write_snapshot(files, blocks, waiting)
+                os.remove(self.path(OLD_WAL_FILE))
+        finally:
+            with self.lock:
+                self.snapshot_running = False
+
+    def write_snapshot(self, files: dict, blocks: dict, waiting: dict):
+        start_time = time.time()
+        tmp_path = self.path(SNAPSHOT_FILE + '.tmp')
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'files': {name: entry.to_record() for name, entry in files.items()},
+            'blocks': blocks,
+            **waiting,
+        }
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path(SNAPSHOT_FILE))
+        log.info('Metadata snapshot with %s files written in %.4f seconds', len(files), time.time() - start_time)
+
+    def snapshot_loop(self):
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL_SECONDS)
+            self.refresh()
+            if self.ops_since_snapshot > 0:
+                self.snapshot()
+
+    def recover(self):
+        if os.path.exists(self.path(SNAPSHOT_FILE)):
+            with open(self.path(SNAPSHOT_FILE), 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') != SNAPSHOT_VERSION:
+                # snapshot antigo: so o dicionario nome -> registro
+                snapshot = {'files': snapshot, 'blocks': {}}
+            for block_hash, record in snapshot['blocks'].items():
+                self.blocks[block_hash] = BlockEntry.from_record(record)
+            for name, record in snapshot['files'].items():
+                entry = FileEntry.from_record(record)
+                self.files[name] = entry
+                for block_hash in entry.blocks or ():
+                    self.blocks[block_hash].refs += 1
+            for waiting, key in ((self.orphans, 'orphans'), (self.pending, 'pending')):
+                for block_hash, record in snapshot.get(key, {}).items():
+                    waiting[block_hash] = (BlockEntry.from_record(record), record['since'])
+            for block_hash, record in snapshot.get('collecting', {}).items():
+                self.collecting[block_hash] = BlockEntry.from_record(record)
+        # o WAL antigo so existe se um snapshot foi interrompido; reaplicar operacoes e idempotente
+        for wal_file in (OLD_WAL_FILE, WAL_FILE):
+            if os.path.exists(self.path(wal_file)):
+                self.replay(self.path(wal_file))
+
+    def replay(self, wal_path: str):
+        valid_bytes = 0
+        with open(wal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                self.apply_record(record)
+                valid_bytes += len(line)
+        if valid_bytes < os.path.getsize(wal_path):
+            # ultima linha incompleta de um crash durante a escrita; corta para os proximos appends
+            log.warning('Truncating incomplete record at the end of %s', wal_path)
+            with open(wal_path, 'r+b') as f:
+                f.truncate(valid_bytes)
+
+    def apply_record(self, record: dict):
+        if record['op'] == 'put':
+            blocks = record.get('blocks')
+            if blocks is not None:
+                blocks = [(block_hash, block_size, parse_replicas(block_replicas))
+                          for block_hash, block_size, block_replicas in blocks]
+            self.apply_put(record['name'], FileEntry.from_record(record), blocks)
+        elif record['op'] == 'delete':
+            self.apply_delete(record['name'])
+        elif record['op'] == 'replicas':
+            self.apply_replicas(self.files.get(record['name']), parse_replicas(record['replicas']))
+        elif record['op'] == 'block_replicas':
+            self.apply_replicas(self.blocks.get(record['hash']), parse_replicas(record['replicas']))
+        elif record['op'] == 'keep_block':
+            self.apply_keep(record['hash'])
+        elif record['op'] == 'pending_blocks':
+            self.apply_pending([(block_hash, block_size, parse_replicas(replicas))
+                                for block_hash, block_size, replicas in record['blocks']])
+        elif record['op'] == 'collect_blocks':
+            self.apply_collect(record['hashes'], record.get('pending', ()))
+        elif record['op'] == 'drop_blocks':
+            self.apply_drop(record['hashes'])
+
+    def migrate_legacy_entries(self) -> list[str]:
+        # formato antigo: um arquivo por imagem em main_dir com "SIZE,HOST:PORT,HOST:PORT"
+        legacy = [name for name in os.listdir(self.directory)
+                  if name not in RESERVED_FILES and os.path.isfile(self.path(name))]
+        for name in legacy:
+            with open(self.path(name), 'r') as f:
+                file_info = f.read().split(',', 1)
+            entry = FileEntry.from_record({'size': int(file_info[0]), 'replicas': file_info[1].split(',')})
+            self.apply_put(name, entry)
+        if legacy:
+            log.info('Migrated %s legacy metadata files from %s', len(legacy), self.directory)
+        return legacy
+
+def format_replicas(replicas: list[tuple[str, int]]) -> list[str]:
+    return [f'{host}:{port}' for host, port in replicas]
+
+def parse_replicas(addrs: list[str]) -> list[tuple[str, int]]:
+    replicas = []
+    for addr in addrs:
+        host, port = addr.rsplit(':', 1)
+        replicas.append((host, int(port)))
+    return replicas
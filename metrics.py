@@ -0,0 +1,270 @@
+import bisect
+import http.server
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+# metricas e logs de main e datanodes. Contadores e histogramas ficam em memoria no processo (um lock por
+# metrica, sem formatar nada no caminho dos dados) e saem no formato texto do Prometheus em
+# http://127.0.0.1:<porta do servico + METRICS_PORT_OFFSET>/metrics. O mesmo endpoint troca o nivel de log
+# com o processo rodando: POST /loglevel?level=DEBUG[&logger=main].
+METRICS_HOST = '127.0.0.1'
+# 0 desliga o endpoint
+METRICS_PORT_OFFSET = int(os.environ.get('MYGEOEYE_METRICS_PORT_OFFSET', 1000))
+
+LOG_LEVEL = os.environ.get('MYGEOEYE_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# limites (segundos) dos histogramas de latencia: de uma ida e volta em loopback a uma transferencia grande
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 300)
+
+registry = []
+registry_lock = threading.Lock()
+
+def register(metric):
+    with registry_lock:
+        registry.append(metric)
+    return metric
+
+def label_text(names, values, extra='') -> str:
+    pairs = [f'{name}="{escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        register(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{label_text(self.labels, key)} {value}' for key, value in values]
+        return lines
+
+class Gauge:
+    # valor lido na hora da coleta: function devolve um numero ou um dict {valores dos labels: numero}
+    def __init__(self, name: str, help: str, function, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+        register(self)
+
+    def render(self) -> list[str]:
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        lines += [f'{self.name}{label_text(self.labels, key)} {value}' for key, value in sorted(values.items())]
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # valores dos labels -> [contagem por bucket (o ultimo e +Inf), soma]
+        self.lock = threading.Lock()
+        register(self)
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *label_values) -> 'Timer':
+        return Timer(self, label_values)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self.series.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{label_text(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{label_text(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{label_text(self.labels, key)} {cumulative}')
+        return lines
+
+class Timer:
+    # with histograma.time(labels): observa a duracao do bloco, tambem quando ele termina com excecao
+    __slots__ = ('histogram', 'label_values', 'start')
+
+    def __init__(self, histogram: Histogram, label_values: tuple) -> None:
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+class Requests:
+    # pedidos de um servidor por comando: quantos, quantos terminaram com excecao e quanto tempo levaram.
+    # Comandos fora de commands contam como UNKNOWN (um cliente nao consegue criar series a vontade).
+    def __init__(self, prefix: str, commands) -> None:
+        self.commands = set(commands)
+        self.total = Counter(f'{prefix}_requests_total', 'Requests served, by command', ('command',))
+        self.errors = Counter(f'{prefix}_request_errors_total', 'Requests that ended with an exception, by command', ('command',))
+        self.seconds = Histogram(f'{prefix}_request_seconds', 'Time to serve a request, by command', ('command',))
+
+    def measure(self, command: str) -> 'RequestTimer':
+        return RequestTimer(self, command if command in self.commands else 'UNKNOWN')
+
+class RequestTimer:
+    __slots__ = ('requests', 'command', 'start')
+
+    def __init__(self, requests: Requests, command: str) -> None:
+        self.requests = requests
+        self.command = command
+
+    def __enter__(self):
+        self.requests.total.inc(self.command)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.requests.seconds.observe(time.perf_counter() - self.start, self.command)
+        if exc_type is not None:
+            self.requests.errors.inc(self.command)
+
+class Trace:
+    # fases em sequencia de uma transferencia: mark(fase) observa o tempo desde a marca anterior no
+    # histograma de fases (labels + fase) e, com DEBUG ligado, done() loga todas numa linha so
+    __slots__ = ('histogram', 'label_values', 'start', 'last', 'phases')
+
+    def __init__(self, histogram: Histogram, *label_values) -> None:
+        self.histogram = histogram
+        self.label_values = label_values
+        self.start = self.last = time.perf_counter()
+        self.phases = []
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.histogram.observe(now - self.last, *self.label_values, phase)
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def first_byte(self, chunks):
+        # repassa os chunks marcando first_byte quando chega o primeiro
+        chunks = iter(chunks)
+        for chunk in chunks:
+            self.mark('first_byte')
+            yield chunk
+            break
+        yield from chunks
+
+    async def first_byte_async(self, chunks):
+        first = True
+        async for chunk in chunks:
+            if first:
+                self.mark('first_byte')
+                first = False
+            yield chunk
+
+    def skip(self):
+        # o tempo desde a ultima marca nao entra em nenhuma fase (espera por outra parte do pedido)
+        self.last = time.perf_counter()
+
+    def done(self, log: logging.Logger, what: str):
+        if log.isEnabledFor(logging.DEBUG):
+            phases = ' '.join(f'{phase}={seconds * 1000:.3f}ms' for phase, seconds in self.phases)
+            log.debug('trace %s %s: %s total=%.3fms', what, '/'.join(map(str, self.label_values)), phases,
+                      (time.perf_counter() - self.start) * 1000)
+
+def render() -> str:
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+def configure_logging():
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+
+def set_level(level: str, logger: str = '') -> str:
+    level = level.upper()
+    if not isinstance(logging.getLevelName(level), int):
+        raise ValueError(f'unknown log level {level!r}')
+    logging.getLogger(logger or None).setLevel(level)
+    return level
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/metrics':
+            self.reply(200, render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif url.path == '/loglevel':
+            query = dict(urllib.parse.parse_qsl(url.query))
+            self.reply(200, logging.getLevelName(logging.getLogger(query.get('logger') or None).getEffectiveLevel()) + '\n')
+        else:
+            self.reply(404, 'not found\n')
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/loglevel':
+            self.reply(404, 'not found\n')
+            return
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            level = set_level(query.get('level', ''), query.get('logger', ''))
+        except ValueError as e:
+            self.reply(400, f'{e}\n')
+            return
+        logging.getLogger('metrics').info('Log level of %s set to %s', query.get('logger') or 'root', level)
+        self.reply(200, level + '\n')
+
+    def reply(self, status: int, body: str, content_type: str = 'text/plain; charset=utf-8'):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # coletas a cada poucos segundos nao vao para o log
+        pass
+
+def serve(service_port: int):
+    # endpoint do processo numa thread de fundo; uma porta ocupada so desliga as metricas
+    if not METRICS_PORT_OFFSET:
+        return None
+    port = service_port + METRICS_PORT_OFFSET
+    try:
+        server = http.server.ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+    except OSError as e:
+        logging.getLogger('metrics').warning('Could not serve metrics on %s:%s: %s', METRICS_HOST, port, e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.getLogger('metrics').info('Metrics on http://%s:%s/metrics', METRICS_HOST, port)
+    return server
@@ -0,0 +1,135 @@
+import random
+import threading
+import time
+import logging
+
+log = logging.getLogger('placement')
+
+# escolha de datanodes para gravacao e leitura a partir dos heartbeats (espaco livre, transferencias
+# em andamento e taxa recente de cada datanode), com power-of-two-choices em vez de sorteio puro
+MIN_FREE_BYTES = 1024 * 1024 * 1024  # reserva que nao entra na conta de espaco livre
+DEFAULT_TRANSFER_RATE = 50 * 1024 * 1024  # bytes/s assumido para quem ainda nao reportou taxa
+# falhas seguidas (heartbeats ou leituras) ate um datanode ser tratado como fora do ar; o proximo heartbeat
+# que responde traz ele de volta
+DOWN_AFTER_FAILURES = 3
+
+class DatanodeLoad:
+    __slots__ = ('free_bytes', 'inflight', 'rate', 'pending', 'updated', 'failures', 'down_since')
+
+    def __init__(self) -> None:
+        self.free_bytes = None  # desconhecido ate o primeiro heartbeat
+        self.inflight = 0
+        self.rate = 0.0  # taxa media por transferencia, em bytes/s
+        # escolhas feitas desde o ultimo heartbeat: sem isso todo mundo iria para o mesmo datanode
+        # ate a proxima atualizacao
+        self.pending = 0
+        self.updated = 0.0
+        self.failures = 0
+        self.down_since = None  # quando foi dado como fora do ar; None se esta vivo
+
+class Placement:
+    def __init__(self, workers: list[tuple[str, int]]) -> None:
+        self.workers = list(workers)
+        self.loads = {addr: DatanodeLoad() for addr in self.workers}
+        self.lock = threading.Lock()
+
+    def update(self, addr: tuple[str, int], free_bytes: int, inflight: int, rate: float):
+        with self.lock:
+            load = self.loads.get(addr)
+            if load is None:
+                return  # tirado de workers.txt enquanto o heartbeat estava em andamento
+            load.free_bytes = free_bytes
+            load.inflight = inflight
+            load.rate = rate
+            load.pending = 0
+            load.updated = time.time()
+            load.failures = 0
+            if load.down_since is not None:
+                log.info('Datanode %s is back up after %.0f seconds', addr, load.updated - load.down_since)
+                load.down_since = None
+
+    def failed(self, addr: tuple[str, int]):
+        with self.lock:
+            load = self.loads.get(addr)
+            if load is None:
+                return
+            load.failures += 1
+            if load.failures >= DOWN_AFTER_FAILURES and load.down_since is None:
+                load.down_since = time.time()
+                log.warning('Datanode %s is down after %s failures', addr, load.failures)
+
+    def alive(self, addr: tuple[str, int]) -> bool:
+        # datanodes fora de workers.txt nao contam como vivos
+        load = self.loads.get(addr)
+        return load is not None and load.down_since is None
+
+    def down_for(self, addr: tuple[str, int]) -> float:
+        # segundos desde que o datanode caiu (0 se esta vivo); datanodes fora de workers.txt contam como perdidos
+        if addr not in self.loads:
+            return float('inf')
+        down_since = self.loads[addr].down_since
+        return 0.0 if down_since is None else time.time() - down_since
+
+    def add_worker(self, addr: tuple[str, int]):
+        with self.lock:
+            if addr not in self.workers:
+                self.workers.append(addr)
+                self.loads.setdefault(addr, DatanodeLoad())
+
+    def remove_worker(self, addr: tuple[str, int]):
+        # sai da escolha de destinos; as replicas dele passam a contar como perdidas (down_for infinito)
+        with self.lock:
+            if addr in self.workers:
+                self.workers.remove(addr)
+            self.loads.pop(addr, None)
+
+    def score(self, addr: tuple[str, int]) -> float:
+        # tempo esperado para uma transferencia nova: fila estimada dividida pela taxa do datanode
+        # chamado com lock
+        load = self.loads.get(addr)
+        if load is None:
+            return 1 / DEFAULT_TRANSFER_RATE
+        return (load.inflight + load.pending + 1) / (load.rate or DEFAULT_TRANSFER_RATE)
+
+    def has_space(self, addr: tuple[str, int], size: int) -> bool:
+        load = self.loads.get(addr)
+        return load is None or load.free_bytes is None or load.free_bytes - MIN_FREE_BYTES >= size
+
+    def pick(self, candidates: list[tuple[str, int]]) -> tuple[str, int]:
+        # power-of-two-choices: sorteia dois e fica com o menos carregado; chamado com lock
+        if len(candidates) == 1:
+            choice = candidates[0]
+        else:
+            a, b = random.sample(candidates, 2)
+            choice = a if self.score(a) <= self.score(b) else b
+        load = self.loads.get(choice)
+        if load is not None:
+            load.pending += 1
+        return choice
+
+    def choose_targets(self, count: int, size: int, exclude: list[tuple[str, int]] = ()) -> list[tuple[str, int]]:
+        # datanodes vivos para as replicas de um arquivo (ou bloco) novo, o primeiro e a cabeca da cadeia;
+        # exclude: datanodes que ja tem uma replica
+        with self.lock:
+            live = [addr for addr in self.workers if addr not in exclude and self.alive(addr)]
+            candidates = [addr for addr in live if self.has_space(addr, size)]
+            if not candidates:
+                log.warning('No datanode reports %s free bytes, placing anyway', size)
+                candidates = live or [addr for addr in self.workers if addr not in exclude]
+            targets = []
+            while candidates and len(targets) < count:
+                choice = self.pick(candidates)
+                candidates.remove(choice)
+                targets.append(choice)
+        return targets
+
+    def choose_replica(self, replicas: list[tuple[str, int]]) -> tuple[str, int]:
+        # so replicas vivas, a menos que nenhuma esteja
+        with self.lock:
+            return self.pick([addr for addr in replicas if self.alive(addr)] or replicas)
+
+    def rank(self, replicas: list[tuple[str, int]]) -> list[tuple[str, int]]:
+        # replicas com a escolhida para leitura na frente e as fora do ar no fim; o resto fica como alternativa
+        first = self.choose_replica(replicas)
+        others = [addr for addr in replicas if addr != first]
+        return [first] + [addr for addr in others if self.alive(addr)] + [addr for addr in others if not self.alive(addr)]
@@ -0,0 +1,93 @@
+import collections
+import random
+from placement import Placement
+
+# Simulates reads and writes against datanodes of different speeds and compares tail latency
+# of random replica choice against the heartbeat-fed power-of-two-choices in placement.py.
+# Each datanode serves its transfers in FIFO order; heartbeats report queue length and rate
+# every HEARTBEAT_INTERVAL seconds of simulated time, so the load information is stale in between.
+
+DATANODE_RATES = [100, 100, 100, 100, 100, 100, 60, 60]  # MiB/s
+NUM_FILES = 2000
+NUM_REQUESTS = 200000
+READ_FRACTION = 0.8
+REPLICATION_FACTOR = 2
+UTILIZATION = 0.6
+HEARTBEAT_INTERVAL = 2.0
+SEED = 42
+
+def file_size_mib(rng):
+    # a maioria das imagens e pequena, algumas sao bem grandes
+    return min(rng.lognormvariate(0, 1.2), 200)
+
+class Simulation:
+    def __init__(self, policy, seed):
+        self.policy = policy
+        self.rng = random.Random(seed)
+        self.addrs = [('10.0.0.1', 7000 + i) for i in range(len(DATANODE_RATES))]
+        self.rates = dict(zip(self.addrs, DATANODE_RATES))
+        self.free_at = {addr: 0.0 for addr in self.addrs}
+        self.queues = {addr: collections.deque() for addr in self.addrs}  # instantes de termino
+        self.placement = Placement(self.addrs)
+        self.files = [(file_size_mib(self.rng), self.rng.sample(self.addrs, REPLICATION_FACTOR)) for _ in range(NUM_FILES)]
+
+    def queue_length(self, addr, now):
+        queue = self.queues[addr]
+        while queue and queue[0] <= now:
+            queue.popleft()
+        return len(queue)
+
+    def heartbeat(self, now):
+        for addr in self.addrs:
+            self.placement.update(addr, 1 << 40, self.queue_length(addr, now), self.rates[addr] * 1024 * 1024)
+
+    def serve(self, addr, now, size):
+        start = max(now, self.free_at[addr])
+        finish = start + size / self.rates[addr]
+        self.free_at[addr] = finish
+        self.queues[addr].append(finish)
+        return finish
+
+    def choose_replica(self, replicas):
+        if self.policy == 'random':
+            return self.rng.choice(replicas)
+        return self.placement.choose_replica(replicas)
+
+    def choose_targets(self, size):
+        if self.policy == 'random':
+            return self.rng.sample(self.addrs, REPLICATION_FACTOR)
+        return self.placement.choose_targets(REPLICATION_FACTOR, int(size * 1024 * 1024))
+
+    def run(self):
+        mean_size = sum(size for size, _ in self.files) / len(self.files)
+        mean_work = mean_size * (READ_FRACTION + (1 - READ_FRACTION) * REPLICATION_FACTOR)
+        arrival_rate = UTILIZATION * sum(DATANODE_RATES) / mean_work
+        now = 0.0
+        next_heartbeat = 0.0
+        latencies = []
+        for _ in range(NUM_REQUESTS):
+            now += self.rng.expovariate(arrival_rate)
+            while next_heartbeat <= now:
+                self.heartbeat(next_heartbeat)
+                next_heartbeat += HEARTBEAT_INTERVAL
+            if self.rng.random() < READ_FRACTION:
+                size, replicas = self.rng.choice(self.files)
+                finish = self.serve(self.choose_replica(replicas), now, size)
+            else:
+                size = file_size_mib(self.rng)
+                finish = max(self.serve(addr, now, size) for addr in self.choose_targets(size))
+            latencies.append(finish - now)
+        return sorted(latencies)
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+if __name__ == '__main__':
+    results = {}
+    for policy in ('random', 'power-of-two'):
+        latencies = Simulation(policy, SEED).run()
+        results[policy] = latencies
+        print(f"{policy:>13}: p50 {percentile(latencies, 0.5):.3f}s  p99 {percentile(latencies, 0.99):.3f}s  "
+              f"p999 {percentile(latencies, 0.999):.3f}s  max {latencies[-1]:.3f}s")
+    for p in (0.99, 0.999):
+        print(f"p{str(p)[2:]} improvement over random: {percentile(results['random'], p) / percentile(results['power-of-two'], p):.2f}x")
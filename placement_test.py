@@ -0,0 +1,122 @@
+import collections
+import unittest
+import placement
+from placement import Placement, DOWN_AFTER_FAILURES, MIN_FREE_BYTES
+
+# Replica placement spreads writes and reads by the load the heartbeats report and never sends them
+# to datanodes that are down, full or gone from workers.txt while another choice exists.
+# Tail latency of the policy is simulated in placement_bench.py.
+#
+#     python3 -m unittest placement_test
+
+ADDRS = [('10.0.0.1', 7000 + i) for i in range(5)]
+ROUNDS = 500
+
+class PlacementTest(unittest.TestCase):
+    def setUp(self):
+        self.placement = Placement(ADDRS)
+        self.heartbeat()
+
+    def heartbeat(self, inflight: dict | None = None, rate: dict | None = None):
+        # zera as escolhas pendentes, como um heartbeat de cada datanode
+        for addr in ADDRS:
+            self.placement.update(addr, 1 << 40, (inflight or {}).get(addr, 0),
+                                  (rate or {}).get(addr, placement.DEFAULT_TRANSFER_RATE))
+
+    def take_down(self, addr):
+        for _ in range(DOWN_AFTER_FAILURES):
+            self.placement.failed(addr)
+
+    def test_down_after_failures(self):
+        for _ in range(DOWN_AFTER_FAILURES - 1):
+            self.placement.failed(ADDRS[0])
+        self.assertTrue(self.placement.alive(ADDRS[0]))
+        self.placement.failed(ADDRS[0])
+        self.assertFalse(self.placement.alive(ADDRS[0]))
+        self.placement.update(ADDRS[0], 1 << 40, 0, placement.DEFAULT_TRANSFER_RATE)
+        self.assertTrue(self.placement.alive(ADDRS[0]))
+
+    def test_distinct_targets(self):
+        for _ in range(ROUNDS):
+            targets = self.placement.choose_targets(3, 1024)
+            self.assertEqual(len(targets), 3)
+            self.assertEqual(len(set(targets)), 3)
+        # mais replicas que datanodes: um de cada
+        self.assertEqual(sorted(self.placement.choose_targets(len(ADDRS) + 2, 1024)), sorted(ADDRS))
+
+    def test_targets_skip_down_nodes(self):
+        down = {ADDRS[0], ADDRS[3]}
+        for addr in down:
+            self.take_down(addr)
+        for _ in range(ROUNDS):
+            targets = self.placement.choose_targets(3, 1024)
+            self.assertEqual(len(targets), 3)
+            self.assertEqual(len(set(targets)), 3)
+            self.assertFalse(down & set(targets))
+
+    def test_targets_respect_exclude(self):
+        for _ in range(ROUNDS):
+            targets = self.placement.choose_targets(2, 1024, exclude=ADDRS[:2])
+            self.assertFalse(set(ADDRS[:2]) & set(targets))
+
+    def test_targets_skip_full_nodes(self):
+        self.placement.update(ADDRS[1], MIN_FREE_BYTES + 10, 0, placement.DEFAULT_TRANSFER_RATE)
+        for _ in range(ROUNDS):
+            self.assertNotIn(ADDRS[1], self.placement.choose_targets(2, 1024))
+        # o que cabe no espaco livre ainda vai para ele
+        self.assertIn(ADDRS[1], self.placement.choose_targets(len(ADDRS), 10))
+
+    def test_no_room_anywhere(self):
+        # sem espaco em nenhum datanode ainda grava, em vez de falhar o upload
+        for addr in ADDRS:
+            self.placement.update(addr, MIN_FREE_BYTES, 0, placement.DEFAULT_TRANSFER_RATE)
+        self.assertEqual(len(self.placement.choose_targets(2, 1024)), 2)
+
+    def test_busiest_replica_never_read(self):
+        # power-of-two-choices: o mais carregado perde qualquer comparacao
+        for _ in range(ROUNDS):
+            self.heartbeat(inflight={ADDRS[0]: 5})
+            self.assertNotEqual(self.placement.choose_replica(ADDRS[:3]), ADDRS[0])
+
+    def test_slowest_replica_never_read(self):
+        for _ in range(ROUNDS):
+            self.heartbeat(rate={ADDRS[0]: placement.DEFAULT_TRANSFER_RATE / 10})
+            self.assertNotEqual(self.placement.choose_replica(ADDRS[:3]), ADDRS[0])
+
+    def test_choices_count_until_next_heartbeat(self):
+        # com a mesma carga, as escolhas desde o ultimo heartbeat dividem as leituras entre as replicas
+        counts = collections.Counter(self.placement.choose_replica(ADDRS[:2]) for _ in range(100))
+        self.assertEqual(counts[ADDRS[0]], 50)
+        self.assertEqual(counts[ADDRS[1]], 50)
+
+    def test_replica_skips_down_nodes(self):
+        self.take_down(ADDRS[0])
+        replicas = ADDRS[:3]
+        for _ in range(ROUNDS):
+            self.assertNotEqual(self.placement.choose_replica(replicas), ADDRS[0])
+            self.assertEqual(self.placement.rank(replicas)[-1], ADDRS[0])
+        # sem nenhuma replica viva ainda devolve uma delas
+        self.take_down(ADDRS[1])
+        self.take_down(ADDRS[2])
+        self.assertIn(self.placement.choose_replica(replicas), replicas)
+
+    def test_removed_worker(self):
+        self.placement.remove_worker(ADDRS[2])
+        self.assertEqual(self.placement.down_for(ADDRS[2]), float('inf'))
+        self.assertFalse(self.placement.alive(ADDRS[2]))
+        # um heartbeat que ja estava em andamento nao traz o datanode de volta
+        self.placement.update(ADDRS[2], 1 << 40, 0, placement.DEFAULT_TRANSFER_RATE)
+        self.placement.failed(ADDRS[2])
+        for _ in range(ROUNDS):
+            self.assertNotIn(ADDRS[2], self.placement.choose_targets(4, 1024))
+            self.assertNotEqual(self.placement.choose_replica(ADDRS[1:3]), ADDRS[2])
+        self.placement.add_worker(ADDRS[2])
+        self.assertTrue(self.placement.alive(ADDRS[2]))
+
+    def test_rank(self):
+        for _ in range(ROUNDS):
+            ranked = self.placement.rank(ADDRS[:3])
+            self.assertEqual(sorted(ranked), sorted(ADDRS[:3]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,53 +1,406 @@
-import time
-from client import Client
+import argparse
 import concurrent.futures
+import json
+import math
 import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from client import Client
+
+# Load generator and benchmark harness. Each run starts its own Main and N datanodes on loopback ports in a
+# scratch directory, uploads the read set, then drives an open-loop workload: arrivals follow a Poisson
+# process at a fixed rate decided up front from the seed, independent of how fast the cluster answers, and
+# latency is measured from the scheduled arrival (time spent queued behind a slow cluster counts).
+# Results (p50/p90/p99/p999 latency, throughput and errors per operation) go out as JSON, one entry per mode:
+#
+#   python3 scale_test.py --rate 20 --duration 60 --sizes lognormal:1MiB:1 --mix read=80,write=15,delete=5
+#   python3 scale_test.py --modes threaded,async,async+direct --output results.json
+#   python3 scale_test.py --server-dir ../old-checkout      # servers of another release, this client
+#
+# Modes are '+'-joined options: async (Main and datanodes with --async), direct, striped and blocks
+# (client modes), compress (datanodes --compress and client compress=True), no-sendfile, workers (Main with
+# --main-workers processes); 'threaded' is none.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MAIN_PORT = 15555
+DATANODE_BASE_PORT = 16000
+STARTUP_TIMEOUT_SECONDS = 15
+MODE_OPTIONS = ('threaded', 'async', 'direct', 'striped', 'blocks', 'compress', 'no-sendfile', 'workers')
+OPERATIONS = ('read', 'write', 'delete')
+PERCENTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99, 'p999': 0.999}
+
+# os bytes enviados sao recortados deste buffer aleatorio (repetido em arquivos maiores)
+PAYLOAD_BYTES = 64 * 1024 * 1024
+
+# Main sem o bloco __main__ para escolher a porta (sem --workers funciona com versoes antigas de main.py)
+MAIN_SCRIPT = '''
+import sys, main
+host, port, replication, flags = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4:]
+if '--workers' in flags:
+    main.serve_workers(host, port, replication, int(flags[flags.index('--workers') + 1]), '--async' in flags)
+else:
+    s = main.Main(host, port, replication)
+    s.start_async() if '--async' in flags else s.start()
+'''
+
+UNITS = {'': 1, 'b': 1, 'kb': 1000, 'mb': 1000 ** 2, 'gb': 1000 ** 3, 'kib': 1024, 'mib': 1024 ** 2, 'gib': 1024 ** 3}
+
+def parse_size(text: str) -> int:
+    match = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]*)\s*', text)
+    if not match or match.group(2).lower() not in UNITS:
+        raise ValueError(f'invalid size {text!r}')
+    return int(float(match.group(1)) * UNITS[match.group(2).lower()])
+
+class SizeDistribution:
+    # fixed:SIZE | uniform:MIN:MAX | lognormal:MEDIAN:SIGMA | choice:SIZE@WEIGHT,SIZE@WEIGHT,...
+    def __init__(self, spec: str, max_size: int) -> None:
+        self.spec = spec
+        self.max_size = max_size
+        kind, _, args = spec.partition(':')
+        if kind == 'fixed':
+            size = parse_size(args)
+            self.draw = lambda rng: size
+        elif kind == 'uniform':
+            low, high = (parse_size(arg) for arg in args.split(':'))
+            self.draw = lambda rng: rng.randint(low, high)
+        elif kind == 'lognormal':
+            median, sigma = args.split(':')
+            mu, sigma = math.log(parse_size(median)), float(sigma)
+            self.draw = lambda rng: int(rng.lognormvariate(mu, sigma))
+        elif kind == 'choice':
+            sizes, weights = [], []
+            for item in args.split(','):
+                size, _, weight = item.partition('@')
+                sizes.append(parse_size(size))
+                weights.append(float(weight or 1))
+            self.draw = lambda rng: rng.choices(sizes, weights)[0]
+        else:
+            raise ValueError(f'invalid size distribution {spec!r}')
+
+    def sample(self, rng: random.Random) -> int:
+        return max(1, min(self.max_size, self.draw(rng)))
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for item in text.split(','):
+        op, _, weight = item.partition('=')
+        if op not in OPERATIONS:
+            raise ValueError(f'unknown operation {op!r} in mix')
+        mix[op] = float(weight)
+    return mix
+
+def parse_mode(mode: str) -> set[str]:
+    options = set(mode.split('+')) - {'threaded'}
+    unknown = options - set(MODE_OPTIONS)
+    if unknown:
+        raise ValueError(f'unknown mode options {sorted(unknown)}')
+    return options
+
+def make_schedule(seed: int, rate: float, duration: float, mix: dict[str, float], sizes: SizeDistribution,
+                  read_set: list[tuple[str, int]]) -> list:
+    # (instante, operacao, tamanho, arquivo lido): o mesmo seed gera a mesma carga em todos os modos
+    rng = random.Random(seed)
+    ops, weights = zip(*mix.items())
+    schedule = []
+    t = rng.expovariate(rate)
+    while t < duration:
+        op = rng.choices(ops, weights)[0]
+        target, size = rng.choice(read_set) if op == 'read' else (None, 0)
+        if op == 'write':
+            size = sizes.sample(rng)
+        schedule.append((t, op, size, target))
+        t += rng.expovariate(rate)
+    return schedule
+
+class Cluster:
+    # Main e datanodes em processos proprios, cada um no seu diretorio (main_dir, datanode_dir sao relativos)
+    def __init__(self, directory: str, server_dir: str, datanodes: int, replication: int, options: set[str], log_level: str,
+                 main_workers: int = 1) -> None:
+        self.directory = directory
+        self.server_dir = server_dir
+        self.datanode_addrs = [('127.0.0.1', DATANODE_BASE_PORT + i + 1) for i in range(datanodes)]
+        self.replication = replication
+        self.options = options
+        self.main_workers = main_workers
+        # main e datanodes precisam do mesmo segredo para os tokens (tokens.py); sem um configurado, sorteia um por execucao
+        secret = os.environ.get('MYGEOEYE_SECRET') or os.urandom(16).hex()
+        self.env = dict(os.environ, PYTHONPATH=server_dir, MYGEOEYE_LOG_LEVEL=log_level, MYGEOEYE_SECRET=secret)
+        self.processes = []
+
+    def start(self):
+        datanode_flags = [flag for flag in ('--async', '--compress', '--no-sendfile') if flag[2:] in self.options]
+        for i, (host, port) in enumerate(self.datanode_addrs):
+            self.spawn(f'dn{i + 1}', [os.path.join(self.server_dir, 'datanode.py'), host, str(port)] + datanode_flags)
+        main_dir = os.path.join(self.directory, 'main', 'main_dir')
+        os.makedirs(main_dir)
+        with open(os.path.join(main_dir, 'workers.txt'), 'w') as f:
+            f.writelines(f'{host} {port}\n' for host, port in self.datanode_addrs)
+        for addr in self.datanode_addrs:
+            wait_for_port(addr)
+        main_flags = ['--async'] if 'async' in self.options else []
+        if 'workers' in self.options:
+            main_flags += ['--workers', str(self.main_workers)]
+        self.spawn('main', ['-c', MAIN_SCRIPT, '127.0.0.1', str(MAIN_PORT), str(self.replication)] + main_flags)
+        wait_for_port(('127.0.0.1', MAIN_PORT))
+
+    def spawn(self, name: str, args: list[str]):
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'log.txt'), 'wb') as log:
+            self.processes.append(subprocess.Popen([sys.executable] + args, cwd=directory, env=self.env,
+                                                   stdout=log, stderr=subprocess.STDOUT))
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+def wait_for_port(addr: tuple[str, int]):
+    deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+    while True:
+        try:
+            socket.create_connection(addr, timeout=1).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise RuntimeError(f'{addr[0]}:{addr[1]} did not start in {STARTUP_TIMEOUT_SECONDS} seconds')
+            time.sleep(0.05)
+
+class Workload:
+    # executa uma agenda com um pool de threads; cada resultado e (operacao, inicio agendado, latencia, bytes, erro)
+    def __init__(self, client, payload: bytes, concurrency: int, drain_timeout: float) -> None:
+        self.client = client
+        self.payload = payload
+        self.concurrency = concurrency
+        self.drain_timeout = drain_timeout
+        self.written = []  # arquivos gravados nesta execucao: os unicos que os deletes apagam
+        self.lock = threading.Lock()
+
+    def run(self, schedule: list, name_prefix: str, seed: int) -> list:
+        rng = random.Random(seed)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        futures = []
+        start = time.perf_counter()
+        for index, (t, op, size, target) in enumerate(schedule):
+            delay = start + t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(self.execute, start + t, t, op, size, target, f'{name_prefix}_{index}.bin', rng))
+        done, not_done = concurrent.futures.wait(futures, timeout=self.drain_timeout)
+        for future in not_done:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        results = [future.result() for future in done]
+        # o que nao terminou ate o fim do prazo conta como erro, com a latencia ate o prazo
+        end = time.perf_counter()
+        for future, (t, op, size, _) in zip(futures, schedule):
+            if future in not_done:
+                results.append((op, t, end - start - t, 0, 'timeout'))
+        return results
+
+    def execute(self, scheduled: float, t: float, op: str, size: int, target: str | None, name: str, rng: random.Random):
+        num_bytes = 0
+        error = None
+        try:
+            if op == 'read':
+                self.client.download_image(target)
+                num_bytes = size
+            elif op == 'write':
+                self.write(name, size)
+                num_bytes = size
+            else:
+                with self.lock:
+                    victim = self.written.pop(rng.randrange(len(self.written))) if self.written else None
+                if victim is None:
+                    error = 'nothing to delete'
+                else:
+                    self.client.delete_image(victim)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        return op, t, time.perf_counter() - scheduled, num_bytes, error
+
+    def write(self, name: str, size: int):
+        path = f'client_dir/{name}'
+        write_file(path, self.payload, size)
+        try:
+            self.client.upload_image(path)
+        finally:
+            os.remove(path)
+        with self.lock:
+            self.written.append(name)
+
+def write_file(path: str, payload: bytes, size: int):
+    view = memoryview(payload)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            piece = view[:min(remaining, len(view))]
+            f.write(piece)
+            remaining -= len(piece)
+
+def make_client(options: set[str]) -> Client:
+    return Client('127.0.0.1', MAIN_PORT, direct='direct' in options or 'striped' in options, striped='striped' in options,
+                  blocks='blocks' in options, compress='compress' in options)
+
+def run_process(args: argparse.Namespace, options: set[str], read_set: list[tuple[str, int]], process_index: int) -> list:
+    # um processo gerador: rate/processes da carga, com o proprio seed e os proprios nomes de arquivo
+    client = make_client(options)
+    payload = payload_bytes(args.seed)
+    seed = args.seed + process_index
+    schedule = make_schedule(seed, args.rate / args.processes, args.warmup + args.duration, parse_mix(args.mix),
+                             SizeDistribution(args.sizes, args.max_size), read_set)
+    workload = Workload(client, payload, args.concurrency, args.warmup + args.duration + args.drain_timeout)
+    return workload.run(schedule, f'bench_{process_index}', seed)
+
+def payload_bytes(seed: int) -> bytes:
+    return random.Random(seed).randbytes(PAYLOAD_BYTES)
+
+def preload(args: argparse.Namespace, options: set[str]) -> list[tuple[str, int]]:
+    # arquivos que as leituras pedem (nome, tamanho), gravados antes da medida
+    client = make_client(options)
+    rng = random.Random(args.seed - 1)
+    sizes = SizeDistribution(args.read_sizes or args.sizes, args.max_size)
+    payload = payload_bytes(args.seed)
+    paths, read_set = [], []
+    for i in range(args.files):
+        path = f'client_dir/read_{i}.bin'
+        size = sizes.sample(rng)
+        write_file(path, payload, size)
+        paths.append(path)
+        read_set.append((os.path.basename(path), size))
+    failed = {path: error for path, error in client.upload_many(paths).items() if error is not None}
+    for path in paths:
+        os.remove(path)
+    if failed:
+        raise RuntimeError(f'{len(failed)} preload uploads failed, first: {next(iter(failed.values()))!r}')
+    return read_set
+
+def percentile(values: list[float], q: float) -> float:
+    # nearest-rank sobre valores ordenados
+    return values[max(0, min(len(values) - 1, math.ceil(q * len(values)) - 1))]
+
+def summarize(results: list, warmup: float, duration: float) -> dict:
+    measured = [r for r in results if r[1] >= warmup]
+    summary = {}
+    for op in OPERATIONS + ('all',):
+        selected = [r for r in measured if op in ('all', r[0])]
+        if not selected:
+            continue
+        ok = sorted(r[2] for r in selected if r[4] is None)
+        errors = {}
+        for r in selected:
+            if r[4] is not None:
+                errors[r[4]] = errors.get(r[4], 0) + 1
+        entry = {
+            'offered': len(selected),
+            'completed': len(ok),
+            'errors': sum(errors.values()),
+            'offered_ops_per_second': len(selected) / duration,
+            'throughput_ops_per_second': len(ok) / duration,
+            'throughput_mib_per_second': sum(r[3] for r in selected if r[4] is None) / duration / (1024 * 1024),
+        }
+        if ok:
+            entry['latency_seconds'] = {
+                **{name: percentile(ok, q) for name, q in PERCENTILES.items()},
+                'mean': sum(ok) / len(ok),
+                'max': ok[-1],
+            }
+        if errors:
+            entry['error_counts'] = dict(sorted(errors.items(), key=lambda item: -item[1])[:10])
+        summary[op] = entry
+    return summary
+
+def run_mode(args: argparse.Namespace, mode: str) -> dict:
+    options = parse_mode(mode)
+    directory = tempfile.mkdtemp(prefix='mygeoeye-bench-', dir=args.work_dir)
+    cluster = Cluster(directory, args.server_dir, args.datanodes, args.replication, options, args.log_level, args.main_workers)
+    cwd = os.getcwd()
+    try:
+        cluster.start()
+        os.makedirs(os.path.join(directory, 'client'))
+        os.chdir(os.path.join(directory, 'client'))
+        read_set = preload(args, options)
+        print(f'# {mode}: {len(read_set)} files loaded, running {args.rate} ops/s for {args.warmup + args.duration} seconds', file=sys.stderr)
+        if args.processes == 1:
+            results = run_process(args, options, read_set, 0)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes) as pool:
+                results = []
+                for part in pool.map(run_process, *zip(*[(args, options, read_set, i) for i in range(args.processes)])):
+                    results += part
+    finally:
+        os.chdir(cwd)
+        cluster.stop()
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {'mode': mode, 'results': summarize(results, args.warmup, args.duration)}
+
+def server_version(server_dir: str) -> str | None:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=server_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
 
-def download_image(client, file_name):
-    print(f"Starting download of {file_name}")
-    download_time = client.download_image(file_name)
-    print(f"Finished download of {file_name} in {download_time:.4f} seconds")
-    return download_time
-
-def run_test(num_images_per_second, duration_seconds, num_datanodes):
-    print(f"\nStarting test with {num_images_per_second} images/second and {num_datanodes} datanodes")
-    client = Client('localhost', 5555)
-    
-    # Ensure test images exist
-    print("Preparing test images...")
-    for i in range(num_images_per_second):
-        if not os.path.exists(f'client_dir/test_image_{i}.jpg'):
-            print(f"Creating test_image_{i}.jpg")
-            with open(f'client_dir/test_image_{i}.jpg', 'wb') as f:
-                f.write(os.urandom(1024 * 1024))  # 1MB random data
-        print(f"Uploading test_image_{i}.jpg")
-        client.upload_image(f'client_dir/test_image_{i}.jpg')
-    
-    print(f"Starting download test for {duration_seconds} seconds")
-    start_time = time.time()
-    end_time = start_time + duration_seconds
-    
-    download_times = []
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_images_per_second) as executor:
-        iteration = 0
-        while time.time() < end_time:
-            print(f"Test iteration {iteration}")
-            futures = [executor.submit(download_image, client, f'test_image_{i}.jpg') for i in range(num_images_per_second)]
-            for future in concurrent.futures.as_completed(futures):
-                download_times.append(future.result())
-            time.sleep(1)
-            iteration += 1
-    
-    avg_download_time = sum(download_times) / len(download_times)
-    print(f"\nTest results for {num_images_per_second} images/second with {num_datanodes} datanodes:")
-    print(f"Average download time: {avg_download_time:.4f} seconds")
-    print(f"Total images downloaded: {len(download_times)}")
-    print(f"Test duration: {time.time() - start_time:.2f} seconds")
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Open-loop benchmark of a local MyGeoEye cluster')
+    parser.add_argument('--modes', default='threaded', help="comma-separated modes, e.g. 'threaded,async,async+direct'")
+    parser.add_argument('--datanodes', type=int, default=3)
+    parser.add_argument('--replication', type=int, default=2)
+    parser.add_argument('--main-workers', type=int, default=os.cpu_count(), help="Main processes in the 'workers' modes")
+    parser.add_argument('--rate', type=float, default=20, help='offered operations per second (all processes)')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load before the measurement')
+    parser.add_argument('--mix', default='read=80,write=15,delete=5')
+    parser.add_argument('--sizes', default='fixed:1MiB', help='size distribution of writes (and of the read set)')
+    parser.add_argument('--read-sizes', help='size distribution of the read set, if different')
+    parser.add_argument('--max-size', type=parse_size, default=parse_size('256MiB'))
+    parser.add_argument('--files', type=int, default=50, help='files uploaded before the run for reads')
+    parser.add_argument('--concurrency', type=int, default=64, help='operations in flight per process')
+    parser.add_argument('--processes', type=int, default=1, help='load generator processes')
+    parser.add_argument('--drain-timeout', type=float, default=60, help='seconds to wait for late operations')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server-dir', default=REPO_DIR, help='checkout whose main.py/datanode.py are benchmarked')
+    parser.add_argument('--work-dir', default=None, help='where the scratch cluster directories go')
+    parser.add_argument('--log-level', default='WARNING', help='MYGEOEYE_LOG_LEVEL of the servers')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directories (server logs)')
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args(argv)
+    args.server_dir = os.path.abspath(args.server_dir)
+    if args.work_dir:
+        args.work_dir = os.path.abspath(args.work_dir)
+    # valida tudo antes de subir o primeiro cluster
+    for mode in args.modes.split(','):
+        parse_mode(mode)
+    parse_mix(args.mix)
+    SizeDistribution(args.sizes, args.max_size)
+    return args
 
 if __name__ == '__main__':
-    print("Starting scale test")
-    for num_datanodes in [2, 4]:
-        for images_per_second in [1, 5, 10]:
-            run_test(images_per_second, 60, num_datanodes)
-    print("Scale test completed")
+    args = parse_args()
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'keep', 'work_dir')},
+        'server_version': server_version(args.server_dir),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'runs': [run_mode(args, mode) for mode in args.modes.split(',')],
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
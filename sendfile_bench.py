@@ -0,0 +1,72 @@
+import os
+import socket
+import threading
+import time
+from datanode import Datanode, CONTROL_MSG_SIZE_BYTES
+from tokens import make_token
+
+# Compares datanode download throughput with sendfile(2) against the chunked read/sendall loop (--no-sendfile).
+# sendfile_test.py checks that both modes send the same bytes.
+# Runs a datanode in-process on loopback and drains the socket as fast as possible.
+
+TEST_FILE_NAME = 'sendfile_test.bin'
+TEST_FILE_SIZE = 256 * 1024 * 1024
+NUM_DOWNLOADS = 5
+
+def start_datanode(port, use_sendfile):
+    datanode = Datanode('127.0.0.1', port, use_sendfile)
+    t = threading.Thread(target=datanode.start, daemon=True)
+    t.start()
+    time.sleep(0.2)
+    return datanode
+
+def download(port, file_name):
+    buf = bytearray(1024 * 1024)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.connect(('127.0.0.1', port))
+        s.sendall(f'DOWNLOAD${file_name}${make_token("DOWNLOAD", file_name)}'.ljust(CONTROL_MSG_SIZE_BYTES, ' ').encode())
+        header = b''
+        while len(header) < CONTROL_MSG_SIZE_BYTES:
+            header += s.recv(CONTROL_MSG_SIZE_BYTES - len(header))
+        file_size = int(header.decode().strip().split('$')[0])
+        s.sendall('READY'.ljust(CONTROL_MSG_SIZE_BYTES, ' ').encode())
+        bytes_recvd = 0
+        while bytes_recvd < file_size:
+            n = s.recv_into(buf)
+            if n == 0:
+                break
+            bytes_recvd += n
+    return bytes_recvd
+
+def run_test(port, use_sendfile):
+    mode = 'sendfile' if use_sendfile else 'buffered'
+    datanode = start_datanode(port, use_sendfile)
+    print(f"\nStarting {mode} test ({datanode.use_sendfile=})")
+    download(port, TEST_FILE_NAME)  # warm the page cache
+
+    cpu_start = time.process_time()
+    start_time = time.time()
+    total_bytes = 0
+    for _ in range(NUM_DOWNLOADS):
+        total_bytes += download(port, TEST_FILE_NAME)
+    elapsed = time.time() - start_time
+    cpu_time = time.process_time() - cpu_start
+
+    throughput = total_bytes / elapsed / (1024 * 1024)
+    print(f"{mode}: {total_bytes} bytes in {elapsed:.4f} seconds, {throughput:.1f} MiB/s, {cpu_time:.4f} s of process CPU")
+    return throughput
+
+if __name__ == '__main__':
+    if not os.path.exists('datanode_dir/'):
+        os.makedirs('datanode_dir/')
+    file_path = f'datanode_dir/{TEST_FILE_NAME}'
+    if not os.path.exists(file_path) or os.path.getsize(file_path) != TEST_FILE_SIZE:
+        print(f"Creating {file_path}")
+        with open(file_path, 'wb') as f:
+            for _ in range(TEST_FILE_SIZE // (1024 * 1024)):
+                f.write(os.urandom(1024 * 1024))
+
+    buffered = run_test(6001, use_sendfile=False)
+    zero_copy = run_test(6002, use_sendfile=True)
+    print(f"\nsendfile speedup over the buffered loop: {zero_copy / buffered:.2f}x")
+    os.remove(file_path)
@@ -0,0 +1,116 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import wire
+import datanode
+from datanode import Datanode
+from tokens import make_token
+
+# Downloads served with sendfile(2) and with the chunked loop (--no-sendfile) must deliver the same bytes,
+# for whole files and for ranges. Throughput is compared in sendfile_bench.py.
+#
+#     python3 -m unittest sendfile_test
+
+TEST_FILE_NAME = 'sendfile_test.bin'
+TEST_FILE_SIZE = 3 * wire.CHUNK_SIZE_BYTES + 12345  # o ultimo chunk fica pela metade
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_datanode(use_sendfile: bool) -> int:
+    port = free_port()
+    threading.Thread(target=Datanode('127.0.0.1', port, use_sendfile).start, daemon=True).start()
+    for _ in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return port
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError(f'datanode on port {port} did not start')
+
+def download(port: int, file_name: str, offset: int | None = None, length: int | None = None) -> bytes:
+    with wire.connect(('127.0.0.1', port)) as s:
+        return download_over(s, file_name, offset, length)
+
+def download_over(s: socket.socket, file_name: str, offset: int | None = None, length: int | None = None) -> bytes:
+    # o datanode atende varios pedidos na mesma conexao
+    token = make_token('DOWNLOAD', file_name)
+    if offset is None:
+        wire.send_control(s, f'DOWNLOAD${file_name}${token}')
+    else:
+        wire.send_control(s, f'DOWNLOAD${file_name}${offset}${length}${token}')
+    file_size = int(wire.recv_control(s)[0])
+    wire.send_control(s, 'READY')
+    return wire.recvall(s, file_size)
+
+@unittest.skipUnless(datanode.SENDFILE_SUPPORTED, 'no sendfile(2) on this platform')
+class SendfileTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # os datanodes usam datanode_dir/ relativo ao diretorio atual
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.chdir(cls.tmp.name)
+        cls.sendfile_port = start_datanode(use_sendfile=True)
+        cls.buffered_port = start_datanode(use_sendfile=False)
+        cls.data = os.urandom(TEST_FILE_SIZE)
+        with open(f'datanode_dir/{TEST_FILE_NAME}', 'wb') as f:
+            f.write(cls.data)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        cls.tmp.cleanup()
+
+    def test_whole_file(self):
+        self.assertEqual(download(self.sendfile_port, TEST_FILE_NAME), self.data)
+        self.assertEqual(download(self.buffered_port, TEST_FILE_NAME), self.data)
+
+    def test_ranges(self):
+        for offset, length in ((0, 1), (1000, wire.CHUNK_SIZE_BYTES), (TEST_FILE_SIZE - 10, 100)):
+            expected = self.data[offset:offset + length]
+            self.assertEqual(download(self.sendfile_port, TEST_FILE_NAME, offset, length), expected)
+            self.assertEqual(download(self.buffered_port, TEST_FILE_NAME, offset, length), expected)
+
+    def test_repeated_downloads(self):
+        # cada download abre o arquivo de novo: nada do anterior (offset, buffer) vaza para o proximo
+        for _ in range(3):
+            self.assertEqual(download(self.sendfile_port, TEST_FILE_NAME), self.data)
+
+    def test_persistent_connection(self):
+        # varios downloads na mesma conexao, como os do pool do main
+        for port in (self.sendfile_port, self.buffered_port):
+            with wire.connect(('127.0.0.1', port)) as s:
+                for _ in range(3):
+                    self.assertEqual(download_over(s, TEST_FILE_NAME), self.data)
+
+    def test_nothing_to_send(self):
+        # arquivo vazio e intervalo alem do fim: zero bytes, e a conexao continua servindo
+        open('datanode_dir/empty.bin', 'wb').close()
+        for port in (self.sendfile_port, self.buffered_port):
+            with wire.connect(('127.0.0.1', port)) as s:
+                self.assertEqual(download_over(s, 'empty.bin'), b'')
+                self.assertEqual(download_over(s, TEST_FILE_NAME, TEST_FILE_SIZE + 5, 10), b'')
+                self.assertEqual(download_over(s, TEST_FILE_NAME), self.data)
+
+    def test_failed_request(self):
+        # arquivo inexistente ou campos malformados: ERROR em vez de conexao derrubada, e o datanode continua servindo
+        for port in (self.sendfile_port, self.buffered_port):
+            for msg in (f'DOWNLOAD$missing.bin${make_token("DOWNLOAD", "missing.bin")}',
+                        f'DOWNLOAD${TEST_FILE_NAME}$x$1${make_token("DOWNLOAD", TEST_FILE_NAME)}'):
+                with wire.connect(('127.0.0.1', port)) as s:
+                    wire.send_control(s, msg)
+                    self.assertEqual(wire.recv_control(s)[0], 'ERROR')
+            self.assertEqual(download(port, TEST_FILE_NAME), self.data)
+
+    def test_mode(self):
+        self.assertTrue(Datanode('127.0.0.1', 0, use_sendfile=True).use_sendfile)
+        self.assertFalse(Datanode('127.0.0.1', 0, use_sendfile=False).use_sendfile)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import io
+import os
+import shutil
+import threading
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+import compression
+
+# derivados das imagens para visualizadores de mapa (TILE/THUMBNAIL): gerados pelo datanode no primeiro
+# pedido (ou logo depois do upload, em prerender) e guardados em DERIVED_DIR para os pedidos seguintes.
+# Piramide: o nivel 0 e a resolucao original e cada nivel tem metade da largura e da altura do anterior;
+# o tile X, Y de um nivel cobre os pixels [X*TILE_SIZE, (X+1)*TILE_SIZE) x [Y*TILE_SIZE, (Y+1)*TILE_SIZE)
+# desse nivel (tiles da borda direita e de baixo podem ser menores).
+AVAILABLE = Image is not None
+
+DERIVED_DIR = 'datanode_dir/derived'
+TILE_SIZE = 256
+TILE_FORMAT = 'PNG'
+THUMBNAIL_SIZE = 256
+MAX_THUMBNAIL_SIZE = 2048
+
+# num tile que falta o datanode gera o bloco de METATILE x METATILE tiles em volta dele: decodificar a imagem
+# custa muito mais que recortar, e os vizinhos costumam ser os proximos pedidos
+METATILE = 8
+RENDER_LOCK_STRIPES = 64
+
+# prerender depois do upload: miniatura e os niveis com ate PRERENDER_MAX_TILES tiles (os primeiros que um
+# visualizador pede), so para arquivos com extensao de imagem
+PRERENDER_MAX_TILES = 64
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.jpg', '.jpeg', '.png', '.jp2', '.bmp', '.gif', '.webp')
+
+# cenas de satelite passam do limite padrao do Pillow contra "decompression bombs"
+MAX_IMAGE_PIXELS = 1 << 32
+if AVAILABLE:
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# dois pedidos para o mesmo metatile: o segundo espera o primeiro e encontra os tiles prontos
+render_locks = [threading.Lock() for _ in range(RENDER_LOCK_STRIPES)]
+
+def render_lock(*key) -> threading.Lock:
+    return render_locks[hash(key) % RENDER_LOCK_STRIPES]
+
+def is_image(file_name: str) -> bool:
+    return file_name.lower().endswith(IMAGE_EXTENSIONS)
+
+def derived_dir(file_path: str, file_name: str) -> str:
+    # um diretorio por versao do arquivo: derivados de um arquivo sobrescrito nunca sao servidos
+    st = os.stat(file_path)
+    directory = f'{DERIVED_DIR}/{file_name}/{st.st_mtime_ns}-{st.st_size}'
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def discard(file_name: str):
+    shutil.rmtree(f'{DERIVED_DIR}/{file_name}', ignore_errors=True)
+
+def open_image(file_path: str):
+    # imagens gravadas comprimidas (datanode --compress) sao descomprimidas em memoria
+    codec, size = compression.stored_info(file_path)
+    if codec is None:
+        return Image.open(file_path)
+    with open(file_path, 'rb') as f:
+        f.seek(compression.STORED_HEADER.size)
+        data = b''.join(compression.read_frames(f, codec, size))
+    return Image.open(io.BytesIO(data))
+
+def normalize(img):
+    # modos que PNG e Image.reduce aceitam; paletas e canais alfa viram RGBA
+    if img.mode in ('L', 'RGB', 'RGBA'):
+        return img
+    return img.convert('RGBA' if 'A' in img.mode or 'transparency' in img.info else 'RGB')
+
+def save(img, path: str):
+    # temporario + rename: um pedido simultaneo nunca le um tile pela metade
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        img.save(tmp_path, TILE_FORMAT)
+        os.replace(tmp_path, path)
+    except BaseException:
+        discard_file(tmp_path)
+        raise
+
+def discard_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def image_size(file_path: str, directory: str) -> tuple[int, int]:
+    # guardado junto dos derivados: pedidos fora da imagem sao recusados sem abrir o arquivo de novo
+    info_path = f'{directory}/size'
+    try:
+        with open(info_path) as f:
+            width, height = f.read().split()
+        return int(width), int(height)
+    except FileNotFoundError:
+        pass
+    with open_image(file_path) as img:
+        width, height = img.size
+    save_size(directory, width, height)
+    return width, height
+
+def save_size(directory: str, width: int, height: int):
+    tmp_path = f'{directory}/size.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(f'{width} {height}')
+    os.replace(tmp_path, f'{directory}/size')
+
+def level_size(width: int, height: int, level: int) -> tuple[int, int]:
+    scale = 1 << level
+    return -(-width // scale), -(-height // scale)
+
+def max_level(width: int, height: int) -> int:
+    # primeiro nivel em que a imagem inteira cabe em um tile
+    level = 0
+    while max(level_size(width, height, level)) > TILE_SIZE:
+        level += 1
+    return level
+
+def tile_path(directory: str, level: int, x: int, y: int) -> str:
+    return f'{directory}/tile_{level}_{x}_{y}.png'
+
+def tile(file_path: str, file_name: str, level: int, x: int, y: int) -> str:
+    # caminho do tile guardado, gerando o metatile dele se ainda nao existe
+    directory = derived_dir(file_path, file_name)
+    path = tile_path(directory, level, x, y)
+    if os.path.exists(path):
+        return path
+    width, height = image_size(file_path, directory)
+    if not 0 <= level <= max_level(width, height):
+        raise ValueError('tile out of range')
+    level_width, level_height = level_size(width, height, level)
+    if not 0 <= x * TILE_SIZE < level_width or not 0 <= y * TILE_SIZE < level_height:
+        raise ValueError('tile out of range')
+    with render_lock(directory, level, x // METATILE, y // METATILE):
+        if not os.path.exists(path):
+            with open_image(file_path) as img:
+                render_metatile(normalize(img), directory, level, x // METATILE, y // METATILE)
+    return path
+
+def render_metatile(img, directory: str, level: int, mx: int, my: int):
+    # reduz so o trecho da imagem original coberto pelo metatile e recorta os tiles dele
+    scale = 1 << level
+    span = TILE_SIZE * METATILE * scale
+    box = (mx * span, my * span, min(img.width, (mx + 1) * span), min(img.height, (my + 1) * span))
+    region = img.reduce(scale, box) if scale > 1 else img.crop(box)
+    for ty in range(-(-region.height // TILE_SIZE)):
+        for tx in range(-(-region.width // TILE_SIZE)):
+            piece = region.crop((tx * TILE_SIZE, ty * TILE_SIZE,
+                                 min(region.width, (tx + 1) * TILE_SIZE), min(region.height, (ty + 1) * TILE_SIZE)))
+            save(piece, tile_path(directory, level, mx * METATILE + tx, my * METATILE + ty))
+
+def thumbnail(file_path: str, file_name: str, size: int = THUMBNAIL_SIZE) -> str:
+    # miniatura com o lado maior de size pixels, mantendo a proporcao
+    if not 0 < size <= MAX_THUMBNAIL_SIZE:
+        raise ValueError('invalid thumbnail size')
+    directory = derived_dir(file_path, file_name)
+    path = f'{directory}/thumbnail_{size}.png'
+    if os.path.exists(path):
+        return path
+    with render_lock(directory, 'thumbnail', size):
+        if not os.path.exists(path):
+            with open_image(file_path) as img:
+                render_thumbnail(img, path, size)
+    return path
+
+def render_thumbnail(img, path: str, size: int):
+    # thumbnail() usa draft() antes de decodificar: JPEGs grandes sao lidos ja reduzidos
+    img.thumbnail((size, size))
+    save(normalize(img), path)
+
+def prerender(file_path: str, file_name: str):
+    # uma decodificacao so para a miniatura e os niveis de baixa resolucao
+    directory = derived_dir(file_path, file_name)
+    with open_image(file_path) as img:
+        img = normalize(img)
+        width, height = img.size
+        top = max_level(width, height)
+        for level in range(top, -1, -1):
+            level_width, level_height = level_size(width, height, level)
+            columns, rows = -(-level_width // TILE_SIZE), -(-level_height // TILE_SIZE)
+            if columns * rows > PRERENDER_MAX_TILES:
+                break
+            for my in range(-(-rows // METATILE)):
+                for mx in range(-(-columns // METATILE)):
+                    render_metatile(img, directory, level, mx, my)
+        render_thumbnail(img, f'{directory}/thumbnail_{THUMBNAIL_SIZE}.png', THUMBNAIL_SIZE)
+    save_size(directory, width, height)
@@ -0,0 +1,39 @@
+import hashlib
+import hmac
+import logging
+import os
+import time
+
+# Tokens de acesso compartilhados por main (que emite) e datanodes (que conferem):
+#     EXPIRY:HMAC-SHA256(segredo, OP$FILENAME$EXPIRY)
+# O segredo vem de MYGEOEYE_SECRET e tem que ser o mesmo em todos os processos. Sem ele cada processo
+# sorteia o seu: main e datanodes no mesmo processo (testes) se entendem, e nenhum token pode ser forjado
+# a partir do codigo; processos separados precisam da variavel (require_secret).
+
+log = logging.getLogger('tokens')
+
+SECRET_CONFIGURED = bool(os.environ.get('MYGEOEYE_SECRET'))
+TOKEN_SECRET = os.environ['MYGEOEYE_SECRET'].encode() if SECRET_CONFIGURED else os.urandom(32)
+TOKEN_TTL_SECONDS = 300
+
+def require_secret():
+    # chamado no inicio de main.py e datanode.py: sem segredo comum nenhum token do main valeria nos datanodes
+    if not SECRET_CONFIGURED:
+        log.critical('MYGEOEYE_SECRET is not set: refusing to start (main and datanodes must share it)')
+        raise SystemExit(1)
+
+def make_token(op: str, file_name: str) -> str:
+    expiry = int(time.time()) + TOKEN_TTL_SECONDS
+    return f'{expiry}:{sign(op, file_name, expiry)}'
+
+def check_token(token: str, op: str, file_name: str) -> bool:
+    try:
+        expiry, digest = token.split(':')
+        if int(expiry) < time.time():
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, sign(op, file_name, expiry))
+
+def sign(op: str, file_name: str, expiry) -> str:
+    return hmac.new(TOKEN_SECRET, f'{op}${file_name}${expiry}'.encode(), hashlib.sha256).hexdigest()
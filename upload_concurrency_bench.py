@@ -0,0 +1,82 @@
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from datanode import Datanode, CONTROL_MSG_SIZE_BYTES
+from tokens import make_token
+
+# Measures aggregate upload throughput of one datanode as the number of simultaneous clients grows.
+# The datanode runs in its own process on loopback; each client thread uploads distinct files.
+# Clients are paced to CLIENT_RATE bytes/s to stand in for clients on slower links than loopback,
+# so the result shows whether one upload waits for another (set it to 0 for unpaced clients).
+
+DATANODE_PORT = 6003
+FILE_SIZE = 16 * 1024 * 1024
+UPLOADS_PER_CLIENT = 4
+CLIENT_COUNTS = [1, 2, 4, 8, 16]
+SEND_CHUNK_SIZE = 256 * 1024
+CLIENT_RATE = 32 * 1024 * 1024
+
+def run_datanode(port):
+    Datanode('127.0.0.1', port).start()
+
+def send_control(s, msg):
+    s.sendall(msg.ljust(CONTROL_MSG_SIZE_BYTES, ' ').encode())
+
+def recv_control(s):
+    msg = b''
+    while len(msg) < CONTROL_MSG_SIZE_BYTES:
+        chunk = s.recv(CONTROL_MSG_SIZE_BYTES - len(msg))
+        if not chunk:
+            raise ConnectionError('connection closed by peer')
+        msg += chunk
+    return msg.decode().strip().split('$')
+
+def upload(file_name, data):
+    with socket.create_connection(('127.0.0.1', DATANODE_PORT)) as s:
+        send_control(s, f'UPLOAD${file_name}${len(data)}$${make_token("UPLOAD", file_name)}')
+        if recv_control(s)[0] != 'READY':
+            raise RuntimeError(f'datanode refused {file_name}')
+        view = memoryview(data)
+        for offset in range(0, len(data), SEND_CHUNK_SIZE):
+            s.sendall(view[offset:offset + SEND_CHUNK_SIZE])
+            if CLIENT_RATE:
+                # como um enlace lento: tempo perdido esperando o datanode nao e recuperado depois
+                time.sleep(SEND_CHUNK_SIZE / CLIENT_RATE)
+        if recv_control(s)[0] != 'DONE':
+            raise RuntimeError(f'upload of {file_name} failed')
+
+def client(client_id, data):
+    for i in range(UPLOADS_PER_CLIENT):
+        upload(f'concurrency_test_{client_id}_{i}.bin', data)
+
+def run_test(num_clients, data):
+    threads = [threading.Thread(target=client, args=(i, data)) for i in range(num_clients)]
+    start_time = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start_time
+    total_bytes = num_clients * UPLOADS_PER_CLIENT * len(data)
+    throughput = total_bytes / elapsed / (1024 * 1024)
+    print(f"{num_clients:>3} clients: {total_bytes} bytes in {elapsed:.4f} seconds, {throughput:.1f} MiB/s")
+    return throughput
+
+if __name__ == '__main__':
+    datanode = multiprocessing.Process(target=run_datanode, args=(DATANODE_PORT,), daemon=True)
+    datanode.start()
+    time.sleep(0.5)
+    data = os.urandom(FILE_SIZE)
+    try:
+        baseline = None
+        for num_clients in CLIENT_COUNTS:
+            throughput = run_test(num_clients, data)
+            baseline = baseline or throughput
+        print(f"\n{CLIENT_COUNTS[-1]} clients vs 1 client: {throughput / baseline:.2f}x throughput")
+    finally:
+        datanode.terminate()
+        for name in os.listdir('datanode_dir'):
+            if name.startswith('concurrency_test_'):
+                os.remove(f'datanode_dir/{name}')
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+import datanode
+import wire
+from tokens import make_token
+from sendfile_test import start_datanode
+
+# Simultaneous uploads to one datanode must not wait for each other's locks nor mix their bytes:
+# each file ends up whole, uploads of the same name leave one complete version and no temporary file
+# is left behind. Throughput as clients are added is measured in upload_concurrency_bench.py.
+#
+#     python3 -m unittest upload_concurrency_test
+
+NUM_CLIENTS = 8
+FILE_SIZE = 2 * wire.CHUNK_SIZE_BYTES + 777
+
+def upload(port: int, file_name: str, data: bytes):
+    with wire.connect(('127.0.0.1', port)) as s:
+        wire.send_control(s, f'UPLOAD${file_name}${len(data)}$${make_token("UPLOAD", file_name)}')
+        if wire.recv_control(s)[0] != 'READY':
+            raise RuntimeError(f'datanode refused {file_name}')
+        # em pedacos pequenos, para os uploads se intercalarem
+        for offset in range(0, len(data), 64 * 1024):
+            s.sendall(data[offset:offset + 64 * 1024])
+        if wire.recv_control(s)[0] != 'DONE':
+            raise RuntimeError(f'upload of {file_name} failed')
+
+def upload_all(port: int, uploads: list[tuple[str, bytes]]):
+    errors = []
+
+    def run(file_name, data):
+        try:
+            upload(port, file_name, data)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=item) for item in uploads]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+class UploadConcurrencyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.chdir(cls.tmp.name)
+        cls.port = start_datanode(use_sendfile=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        cls.tmp.cleanup()
+
+    def temp_files(self) -> list[str]:
+        return os.listdir(datanode.PARTIAL_DIR)
+
+    def assertNoTempFiles(self):
+        self.assertEqual(self.temp_files(), [])
+
+    def test_distinct_files(self):
+        uploads = [(f'distinct_{i}.bin', os.urandom(FILE_SIZE)) for i in range(NUM_CLIENTS)]
+        self.assertEqual(upload_all(self.port, uploads), [])
+        for file_name, data in uploads:
+            with open(f'datanode_dir/{file_name}', 'rb') as f:
+                self.assertEqual(f.read(), data, file_name)
+        self.assertNoTempFiles()
+
+    def test_same_file(self):
+        versions = [os.urandom(FILE_SIZE) for _ in range(NUM_CLIENTS)]
+        self.assertEqual(upload_all(self.port, [('same.bin', data) for data in versions]), [])
+        with open('datanode_dir/same.bin', 'rb') as f:
+            self.assertIn(f.read(), versions)
+        self.assertNoTempFiles()
+
+    def test_interrupted_upload(self):
+        # conexao fechada no meio: nem o arquivo pela metade nem o temporario ficam no datanode
+        with wire.connect(('127.0.0.1', self.port)) as s:
+            wire.send_control(s, f'UPLOAD$partial.bin${FILE_SIZE}$${make_token("UPLOAD", "partial.bin")}')
+            self.assertEqual(wire.recv_control(s)[0], 'READY')
+            s.sendall(os.urandom(FILE_SIZE // 2))
+        # o datanode limpa quando percebe o fim da conexao
+        for _ in range(50):
+            if not self.temp_files():
+                break
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists('datanode_dir/partial.bin'))
+        self.assertNoTempFiles()
+
+    def test_restart_discards_only_temp_files(self):
+        # no inicio so o que esta em PARTIAL_DIR e apagado; uma imagem chamada foo.tmp fica
+        with open(f'{datanode.PARTIAL_DIR}/12345', 'wb') as f:
+            f.write(b'partial')
+        with open('datanode_dir/user.tmp', 'wb') as f:
+            f.write(b'image')
+        datanode.Datanode('127.0.0.1', 0)
+        self.assertNoTempFiles()
+        self.assertTrue(os.path.exists('datanode_dir/user.tmp'))
+
+if __name__ == '__main__':
+    unittest.main()
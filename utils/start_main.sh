@@ -7,6 +7,11 @@ echo "Starting Main server on $HOST:$PORT..."
 echo Killing previous process
 pkill -f main.py
 
+# segredo dos tokens, o mesmo no main e nos datanodes (update_all copia main_dir/secret.txt)
+if [ -z "$MYGEOEYE_SECRET" ] && [ -f main_dir/secret.txt ]; then
+    export MYGEOEYE_SECRET=$(cat main_dir/secret.txt)
+fi
+
 echo Starting main.py
 python3 main.py &
 disown
@@ -3,7 +3,17 @@
 for ip in $(cat main_dir/workers.txt| cut -f 1 -d " "); do
     expect utils/update_host.exp main.py $ip
     expect utils/update_host.exp datanode.py $ip
+    expect utils/update_host.exp metadata.py $ip
+    expect utils/update_host.exp cache.py $ip
+    expect utils/update_host.exp placement.py $ip
+    expect utils/update_host.exp checksum.py $ip
+    expect utils/update_host.exp wire.py $ip
+    expect utils/update_host.exp compression.py $ip
+    expect utils/update_host.exp tiles.py $ip
+    expect utils/update_host.exp metrics.py $ip
+    expect utils/update_host.exp tokens.py $ip
     expect utils/update_host.exp main_dir/workers.txt $ip
+    expect utils/update_host.exp main_dir/secret.txt $ip
 
     expect utils/update_host.exp update_all $ip
     expect utils/update_host.exp utils/update_all.sh $ip
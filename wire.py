@@ -0,0 +1,145 @@
+import os
+import socket
+import struct
+import weakref
+
+# Enquadramento das mensagens de controle e caminho de recepcao compartilhado por main, datanode e cliente.
+#
+# Formato texto (original): mensagem '$'-separada, preenchida com espacos ate CONTROL_MSG_SIZE_BYTES.
+# Formato binario: byte BINARY_MAGIC, tamanho (uint32 big-endian) e a mesma mensagem '$'-separada.
+# Nenhuma mensagem texto comeca com NUL, entao quem recebe reconhece o formato pelo primeiro byte
+# e passa a responder nele na mesma conexao: clientes antigos continuam falando texto.
+CONTROL_MSG_SIZE_BYTES = 1024
+BINARY_MAGIC = 0
+BINARY_HEADER = struct.Struct('!BI')
+# mensagens de controle sao curtas (listas e corpos grandes vao depois, como bytes): um tamanho maior que isso
+# e lixo ou ataque, e nao chega a ser alocado
+MAX_CONTROL_MSG_BYTES = 64 * 1024
+
+# conexoes abertas por este processo usam o formato binario, a menos que MYGEOEYE_PROTOCOL=text
+# (para falar com servidores antigos)
+USE_BINARY = os.environ.get('MYGEOEYE_PROTOCOL', 'binary') != 'text'
+
+# tamanho dos chunks de dados e dos buffers de socket; SOCKET_BUFFER_BYTES=0 deixa o ajuste automatico do kernel
+CHUNK_SIZE_BYTES = int(os.environ.get('MYGEOEYE_CHUNK_SIZE', 256 * 1024))
+SOCKET_BUFFER_BYTES = int(os.environ.get('MYGEOEYE_SOCKET_BUFFER', 0))
+
+binary_conns = weakref.WeakSet()  # conexoes que falam o formato binario
+
+def tune(conn: socket.socket) -> socket.socket:
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if SOCKET_BUFFER_BYTES:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_BYTES)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+    return conn
+
+def prepare(conn: socket.socket, binary: bool = USE_BINARY) -> socket.socket:
+    # socket de saida ainda nao conectado (buffers precisam ser ajustados antes do connect)
+    tune(conn)
+    if binary:
+        binary_conns.add(conn)
+    return conn
+
+def connect(addr: tuple[str, int], timeout: float | None = None, binary: bool = USE_BINARY) -> socket.socket:
+    conn = prepare(socket.socket(socket.AF_INET, socket.SOCK_STREAM), binary)
+    try:
+        conn.settimeout(timeout)
+        conn.connect(addr)
+        conn.settimeout(None)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+def encode_control(conn: socket.socket, msg: str) -> bytes:
+    payload = msg.encode()
+    if conn in binary_conns:
+        return BINARY_HEADER.pack(BINARY_MAGIC, len(payload)) + payload
+    return payload.ljust(CONTROL_MSG_SIZE_BYTES, b' ')
+
+def decode_header(conn: socket.socket, header: bytes) -> int:
+    # devolve quantos bytes ainda faltam da mensagem que comeca com header
+    magic, length = BINARY_HEADER.unpack(header)
+    if magic == BINARY_MAGIC:
+        if length > MAX_CONTROL_MSG_BYTES:
+            raise ConnectionError(f'control message of {length} bytes exceeds {MAX_CONTROL_MSG_BYTES}')
+        binary_conns.add(conn)
+        return length
+    return CONTROL_MSG_SIZE_BYTES - BINARY_HEADER.size
+
+def decode_control(conn: socket.socket, header: bytes, payload: bytes) -> list[str]:
+    if conn in binary_conns:
+        return payload.decode().split('$')
+    return (header + payload).decode().strip().split('$')
+
+def send_control(conn: socket.socket, msg: str):
+    conn.sendall(encode_control(conn, msg))
+
+def recv_control(conn: socket.socket) -> list[str]:
+    header = recvall(conn, BINARY_HEADER.size)
+    return decode_control(conn, header, recvall(conn, decode_header(conn, header)))
+
+async def send_control_async(loop, conn: socket.socket, msg: str):
+    await loop.sock_sendall(conn, encode_control(conn, msg))
+
+async def recv_control_async(loop, conn: socket.socket) -> list[str]:
+    header = await recvall_async(loop, conn, BINARY_HEADER.size)
+    return decode_control(conn, header, await recvall_async(loop, conn, decode_header(conn, header)))
+
+def recv_into(conn: socket.socket, view: memoryview):
+    # preenche view inteira
+    bytes_recvd = 0
+    while bytes_recvd < len(view):
+        n = conn.recv_into(view[bytes_recvd:])
+        if n == 0:
+            raise ConnectionError('connection closed by peer')
+        bytes_recvd += n
+
+def recvall(conn: socket.socket, msg_size: int) -> bytes:
+    buf = bytearray(msg_size)
+    recv_into(conn, memoryview(buf))
+    return bytes(buf)
+
+async def recvall_async(loop, conn: socket.socket, msg_size: int) -> bytes:
+    buf = bytearray(msg_size)
+    view = memoryview(buf)
+    bytes_recvd = 0
+    while bytes_recvd < msg_size:
+        n = await loop.sock_recv_into(conn, view[bytes_recvd:])
+        if n == 0:
+            raise ConnectionError('connection closed by peer')
+        bytes_recvd += n
+    return bytes(buf)
+
+def recv_chunks(conn: socket.socket, size: int, buf: bytearray | None = None):
+    # gera os proximos size bytes em fatias de um buffer preallocado; cada fatia so vale ate a proxima
+    # iteracao (quem precisa guardar copia com bytes())
+    view = memoryview(buf if buf is not None else bytearray(min(CHUNK_SIZE_BYTES, size) or 1))
+    remaining = size
+    while remaining:
+        n = conn.recv_into(view[:min(len(view), remaining)])
+        if n == 0:
+            raise ConnectionError('connection closed by peer')
+        remaining -= n
+        yield view[:n]
+
+async def recv_chunks_async(loop, conn: socket.socket, size: int, buf: bytearray | None = None):
+    view = memoryview(buf if buf is not None else bytearray(min(CHUNK_SIZE_BYTES, size) or 1))
+    remaining = size
+    while remaining:
+        n = await loop.sock_recv_into(conn, view[:min(len(view), remaining)])
+        if n == 0:
+            raise ConnectionError('connection closed by peer')
+        remaining -= n
+        yield view[:n]
+
+def read_chunks(f, size: int, buf: bytearray | None = None):
+    # mesmo esquema de recv_chunks para ler de um arquivo
+    view = memoryview(buf if buf is not None else bytearray(min(CHUNK_SIZE_BYTES, size) or 1))
+    remaining = size
+    while remaining:
+        n = f.readinto(view[:min(len(view), remaining)])
+        if not n:
+            return
+        remaining -= n
+        yield view[:n]